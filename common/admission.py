@@ -0,0 +1,205 @@
+import math
+import json
+import inspect
+import time
+import threading
+import cherrypy
+from .json_stream import afterBody
+
+"""
+Admission control
+--------------------------------------------------------------------------
+Limits the number of requests processed at the same time by a web service.
+Excess requests wait in a short queue; when the queue is full (or the wait
+is too long) they are rejected with 429 and a 'Retry-After' header, telling
+the clients when to try again - so that, after a restart, the registration
+storm is spread over time instead of overloading the catalog.
+--------------------------------------------------------------------------
+"""
+
+
+def admitted(handler):
+    """
+    Decorator for the REST handlers (GET, POST, PUT, ...) of a web service
+    having an `admission` attribute (AdmissionControl object): the request
+    is only processed if admitted, else the response is 429.
+    Endpoints (first element of the URI) in `admission.exempt` are always
+    processed; the ones in `admission.long_polling` are limited by their
+    own counter, as they hold a thread for long but do little work.
+    If the handler returns a generator (streamed body), the slot is only
+    released once the body has been sent. The handler can release it 
+    earlier with `admission.leave()` (e.g., before calling other services).
+    """
+    def wrapper(self, *uri, **params):
+        endpoint = str(uri[0]) if len(uri) >= 1 else ""
+        if endpoint in self.admission.exempt:
+            return handler(self, *uri, **params)
+        if endpoint in self.admission.long_polling:
+            if not self.admission.acquireLong():
+                return tooManyRequests(self.admission.long_retry_after)
+            try:
+                out = handler(self, *uri, **params)
+            except:
+                self.admission.releaseLong()
+                raise
+            if inspect.isgenerator(out):
+                return afterBody(out, self.admission.releaseLong)
+            self.admission.releaseLong()
+            return out
+        if not self.admission.acquire():
+            return tooManyRequests(self.admission.retryAfter())
+        slot = self.admission.enter(time.perf_counter())
+        release = lambda: self.admission.leave(slot)
+        try:
+            out = handler(self, *uri, **params)
+        except:
+            release()
+            raise
+        if inspect.isgenerator(out):
+            return afterBody(out, release)
+        release()
+        return out
+
+    wrapper.__name__ = handler.__name__
+    wrapper.__doc__ = handler.__doc__
+    return wrapper
+
+
+def tooManyRequests(retry_after):
+    # Body of a rejected request (429) - not raised as HTTPError, which
+    # would drop the Retry-After header
+    cherrypy.response.status = 429
+    cherrypy.response.headers["Retry-After"] = str(retry_after)
+    return json.dumps({"status": "FAILURE", "msg": "Too many requests - retry later"})
+
+
+class AdmissionControl():
+    """
+    AdmissionControl
+    --------------------------------------------------------------------------
+    Counts the requests in flight and the ones waiting for a slot.
+    --------------------------------------------------------------------------
+    Parameters:
+    - max_in_flight: max number of requests processed at the same time
+    - max_queued: max number of requests waiting for a slot; the following
+      ones are rejected immediately
+    - max_wait: max time (seconds) a request can wait for a slot
+    - max_retry_after: upper bound of the suggested retry time (seconds)
+    - exempt: endpoints which are never limited (e.g., metrics)
+    - long_polling: endpoints whose requests wait for long (e.g., /watch);
+      they do not take a slot, but at most max_long of them are served at
+      the same time - the following ones are rejected immediately
+    - max_long: max number of long polling requests at the same time
+    - long_retry_after: suggested retry time (seconds) of the rejected long
+      polling requests
+    --------------------------------------------------------------------------
+    The web server thread pool needs to be larger than max_in_flight +
+    max_queued + max_long, as queued and long polling requests hold a 
+    thread (see `threadsNeeded()`).
+    """
+
+    def __init__(self, max_in_flight=8, max_queued=32, max_wait=1, max_retry_after=30, exempt=None, 
+                 long_polling=None, max_long=16, long_retry_after=5):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.max_retry_after = max_retry_after
+        self.exempt = set(exempt or [])
+        self.long_polling = set(long_polling or [])
+        self.max_long = max_long
+        self.long_retry_after = long_retry_after
+
+        self._cond = threading.Condition()
+        # Slot of the admitted request served by each thread
+        self._held = threading.local()
+        self.in_flight = 0
+        self.queued = 0
+        self.long = 0               # Long polling requests being served
+        self.rejected = 0           # Total number of rejected requests
+        # Moving averages: processing time of a request (seconds) and
+        # rejections per second
+        self._avg_time = 0.01
+        self._reject_rate = 0
+        self._last_reject = time.time()
+
+    def acquire(self):
+        # Return True if the request can be processed (then call `release()`), False if rejected
+        with self._cond:
+            if self.in_flight < self.max_in_flight and self.queued == 0:
+                self.in_flight += 1
+                return True
+            if self.queued < self.max_queued:
+                self.queued += 1
+                admitted = self._cond.wait_for(lambda: self.in_flight < self.max_in_flight, self.max_wait)
+                self.queued -= 1
+                if admitted:
+                    self.in_flight += 1
+                    return True
+            self._reject()
+            return False
+
+    def acquireLong(self):
+        # Return True if the long polling request can be served (then call `releaseLong()`), False if rejected
+        with self._cond:
+            if self.long < self.max_long:
+                self.long += 1
+                return True
+            # Not in the rejection rate, which estimates the load of the slots
+            self.rejected += 1
+            return False
+
+    def releaseLong(self):
+        # End of a long polling request
+        with self._cond:
+            self.long -= 1
+
+    def threadsNeeded(self):
+        # Min. size of the web server thread pool, leaving a few threads to
+        # the exempt endpoints
+        return self.max_in_flight + self.max_queued + self.max_long + 4
+
+    def enter(self, start):
+        # Slot of the request admitted at `start` (perf_counter), served by this thread
+        slot = {"start": start}
+        self._held.slot = slot
+        return slot
+
+    def leave(self, slot=None):
+        """
+        Release `slot` (by default, the one of the request served by this
+        thread), if not released yet: called at the end of the request, or
+        earlier by a handler which is going to block on other services, so
+        that a slow service does not use up the slots of this one.
+        """
+        if slot is None:
+            slot = getattr(self._held, "slot", None)
+        with self._cond:
+            if slot is None or slot["start"] is None:
+                return
+            start, slot["start"] = slot["start"], None
+        self.release(time.perf_counter() - start)
+
+    def release(self, duration):
+        # End of an admitted request, which took `duration` seconds
+        with self._cond:
+            self.in_flight -= 1
+            self._avg_time = 0.9 * self._avg_time + 0.1 * duration
+            self._cond.notify()
+
+    def retryAfter(self):
+        """
+        Suggested wait (integer seconds, at least 1) before retrying: the
+        time needed to serve the requests in the queue plus the ones
+        rejected in the last second, at the current processing rate.
+        """
+        with self._cond:
+            backlog = self.queued + self.in_flight + self._reject_rate
+            wait = backlog * self._avg_time / self.max_in_flight
+        return int(min(self.max_retry_after, max(1, math.ceil(wait))))
+
+    def _reject(self):
+        # Update the rejection rate (decaying with a 1 s time constant) - holding the lock
+        now = time.time()
+        self._reject_rate = self._reject_rate * math.exp(-(now - self._last_reject)) + 1
+        self._last_reject = now
+        self.rejected += 1
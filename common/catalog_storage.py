@@ -0,0 +1,320 @@
+import json
+import os
+import sqlite3
+
+"""
+Catalog storage
+--------------------------------------------------------------------------
+Persistence layer for the catalog: instead of rewriting the whole catalog
+at every change, only the mutations are written. Two engines:
+- JsonJournalStorage: mutations are appended to a journal (one JSON 
+  object per line), periodically compacted into a full snapshot
+- SqliteStorage: mutations are applied to indexed SQLite tables
+--------------------------------------------------------------------------
+"""
+
+
+def applyChange(cat, change, positions=None):
+    """
+    Apply a single journal entry to the catalog dictionary `cat`.
+    --------------------------------------------------------------------------
+    Supported entries:
+    - {"op": "put", "coll": <list key>, "rec": <record>}: add/replace record
+    - {"op": "del", "coll": <list key>, "id": <record id>}: remove record
+    - {"op": "touch", "coll": <list key>, "times": {<record id>: <time>}}:
+      refresh the 'last_update' of existing records
+    - {"op": "set", "key": <key>, "value": <value>}: set top-level key
+    --------------------------------------------------------------------------
+    `positions` is an optional dict {coll: {str(id): index}} used to avoid
+    scanning the lists at every entry when replaying many changes.
+    """
+    if positions is None:
+        positions = {}
+
+    if change["op"] == "set":
+        cat[change["key"]] = change["value"]
+        return
+
+    coll = change["coll"]
+    if coll not in positions:
+        positions[coll] = {str(rec["id"]): ind for ind, rec in enumerate(cat[coll])}
+    pos = positions[coll]
+
+    if change["op"] == "put":
+        key = str(change["rec"]["id"])
+        if key in pos:
+            cat[coll][pos[key]] = change["rec"]
+        else:
+            pos[key] = len(cat[coll])
+            cat[coll].append(change["rec"])
+    elif change["op"] == "del":
+        key = str(change["id"])
+        if key in pos:
+            cat[coll].pop(pos[key])
+            # Removal shifts the following records - rebuild lazily
+            del positions[coll]
+    elif change["op"] == "touch":
+        for key, last_update in change["times"].items():
+            if key in pos:
+                cat[coll][pos[key]]["last_update"] = last_update
+
+
+class JsonJournalStorage():
+    """
+    JsonJournalStorage
+    --------------------------------------------------------------------------
+    Stores the catalog as a JSON snapshot plus an append-only journal of the
+    changes made after the snapshot was taken.
+    --------------------------------------------------------------------------
+    Parameters:
+    - snapshot_path: path of the full catalog JSON
+    - journal_path: path of the journal (default: snapshot path with
+      extension '.journal')
+    - compact_every: number of journal entries after which the journal
+      should be folded into a new snapshot
+    --------------------------------------------------------------------------
+    """
+
+    def __init__(self, snapshot_path, journal_path=None, compact_every=1000):
+        self.snapshot_path = snapshot_path
+        if journal_path is None:
+            journal_path = os.path.splitext(snapshot_path)[0] + ".journal"
+        self.journal_path = journal_path
+        self.compact_every = compact_every
+
+        self._journal_f = None
+        self._n_entries = 0         # Entries in the journal since last snapshot
+
+    def load(self, base):
+        """
+        Read the last snapshot and replay the journal on top of it.
+        If no snapshot was taken yet, the journal is replayed on `base`.
+        Returns the catalog dictionary, or None if nothing was stored.
+        """
+        try:
+            with open(self.snapshot_path) as f:
+                cat = json.load(f)
+        except:
+            cat = None
+
+        positions = {}
+        n = 0
+        try:
+            with open(self.journal_path) as f:
+                if cat is None:
+                    cat = base
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # Last line may be truncated if the process died while writing
+                        break
+                    applyChange(cat, change, positions)
+                    n += 1
+        except FileNotFoundError:
+            pass
+
+        self._n_entries = n
+        return cat
+
+    def append(self, changes):
+        """
+        Append the list of changes to the journal; returns the number of
+        bytes written.
+        """
+        if len(changes) == 0:
+            return 0
+        if self._journal_f is None:
+            self._journal_f = open(self.journal_path, "a")
+        data = "".join(json.dumps(change) + "\n" for change in changes)
+        self._journal_f.write(data)
+        self._journal_f.flush()
+        self._n_entries += len(changes)
+        return len(data)
+
+    def needsCompaction(self):
+        return self._n_entries >= self.compact_every
+
+    def compact(self, cat):
+        """
+        Write the full catalog as new snapshot and empty the journal.
+        The snapshot is first written to a temporary file, so that a crash
+        cannot leave a truncated catalog behind.
+        Returns the number of bytes written.
+        """
+        data = json.dumps(cat)
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.snapshot_path)
+
+        if self._journal_f is not None:
+            self._journal_f.close()
+        self._journal_f = open(self.journal_path, "w")
+        self._n_entries = 0
+        return len(data)
+
+
+class SqliteStorage():
+    """
+    SqliteStorage
+    --------------------------------------------------------------------------
+    Stores the catalog in a SQLite database (WAL mode): one table per 
+    collection, with a row per record, and a key-value table for the other
+    entries (e.g., the device catalog info).
+    It has the same methods as JsonJournalStorage, but each change is 
+    applied to the tables directly - no journal to compact, and the cost of
+    a write does not depend on the size of the catalog.
+    --------------------------------------------------------------------------
+    Parameters:
+    - db_path: path of the database file
+    - tables: dict {collection: [indexed fields]} - each record is stored 
+      as JSON, plus a column (with an index) for each of the given fields
+    - keys: other top-level entries of the catalog to be stored (e.g., 
+      "device_catalog")
+    --------------------------------------------------------------------------
+    """
+
+    def __init__(self, db_path, tables, keys=None):
+        self.db_path = db_path
+        self.tables = tables
+        self.keys = keys or []
+
+        # Accessed by the catalog holding its lock, from different threads
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        # The statements are always the same strings, so that sqlite3 keeps
+        # them prepared (statement cache)
+        self._sql = {}
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            for coll, fields in tables.items():
+                cols = "".join(f", {field}" for field in fields)
+                self._conn.execute(f"CREATE TABLE IF NOT EXISTS {coll} (id TEXT PRIMARY KEY, last_update TEXT, data TEXT{cols})")
+                for field in fields:
+                    self._conn.execute(f"CREATE INDEX IF NOT EXISTS {coll}_{field} ON {coll} ({field})")
+                # Upsert keeps the rowid, so the records are loaded in insertion order
+                values = ", ?" * len(fields)
+                updates = "".join(f", {field}=excluded.{field}" for field in fields)
+                self._sql[coll] = {
+                    "put": f"INSERT INTO {coll} (id, last_update, data{cols}) VALUES (?, ?, ?{values}) "
+                           f"ON CONFLICT(id) DO UPDATE SET last_update=excluded.last_update, data=excluded.data{updates}",
+                    "del": f"DELETE FROM {coll} WHERE id = ?",
+                    "touch": f"UPDATE {coll} SET last_update = ? WHERE id = ?",
+                    "load": f"SELECT data, last_update FROM {coll} ORDER BY rowid",
+                    "clear": f"DELETE FROM {coll}"
+                }
+        self._sql_set = "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value"
+
+    def load(self, base):
+        """
+        Read the catalog from the database, starting from `base` (records 
+        and entries found in the database replace the ones in `base`).
+        When the database is new, it is filled with the content of `base` 
+        and None is returned.
+        """
+        meta = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+        if "initialized" not in meta:
+            self.compact(base)
+            return None
+
+        cat = dict(base)
+        for key, value in meta.items():
+            if key in self.keys:
+                cat[key] = json.loads(value)
+        for coll in self.tables:
+            records = []
+            for data, last_update in self._conn.execute(self._sql[coll]["load"]):
+                rec = json.loads(data)
+                # Renewals only update the column
+                rec["last_update"] = last_update
+                records.append(rec)
+            cat[coll] = records
+        return cat
+
+    def append(self, changes):
+        """
+        Apply the list of changes (same format as the journal entries) in 
+        a single transaction; returns the number of bytes of the records
+        written.
+        """
+        if len(changes) == 0:
+            return 0
+        n_bytes = 0
+        with self._conn:
+            for change in changes:
+                if change["op"] == "set":
+                    value = json.dumps(change["value"])
+                    self._conn.execute(self._sql_set, (change["key"], value))
+                    n_bytes += len(value)
+                    continue
+                coll = change["coll"]
+                if coll not in self.tables:
+                    continue
+                if change["op"] == "put":
+                    n_bytes += self._put(coll, change["rec"])
+                elif change["op"] == "del":
+                    self._conn.execute(self._sql[coll]["del"], (str(change["id"]),))
+                elif change["op"] == "touch":
+                    self._conn.executemany(self._sql[coll]["touch"], 
+                        [(last_update, key) for key, last_update in change["times"].items()])
+        return n_bytes
+
+    def _put(self, coll, rec):
+        data = json.dumps(rec)
+        fields = [self._column(rec.get(field)) for field in self.tables[coll]]
+        self._conn.execute(self._sql[coll]["put"], [str(rec["id"]), rec.get("last_update", ""), data] + fields)
+        return len(data)
+
+    def _column(self, value):
+        # Indexed columns hold scalars - other values are stored as JSON
+        if value is None or isinstance(value, (int, float, str)):
+            return value
+        return json.dumps(value)
+
+    def needsCompaction(self):
+        # Changes are applied in place
+        return False
+
+    def compact(self, cat):
+        """
+        Rewrite all tables with the content of the catalog `cat`, in a 
+        single transaction, and checkpoint the WAL.
+        Returns the number of bytes of the records written.
+        """
+        n_bytes = 0
+        with self._conn:
+            for coll in self.tables:
+                self._conn.execute(self._sql[coll]["clear"])
+                for rec in cat.get(coll, []):
+                    n_bytes += self._put(coll, rec)
+            for key in self.keys:
+                if key in cat:
+                    self._conn.execute(self._sql_set, (key, json.dumps(cat[key])))
+            self._conn.execute(self._sql_set, ("initialized", "true"))
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return n_bytes
+
+
+def openStorage(config, snapshot_path, tables, keys=None, journal_path=None):
+    """
+    Create the storage described by `config` (dict, from the catalog 
+    "storage" key), e.g.:
+        {"engine": "sqlite", "path": "serv_catalog.db"}
+    Engines: "json" (default - JsonJournalStorage at `snapshot_path`) or 
+    "sqlite" (SqliteStorage; default path: snapshot path with extension 
+    '.db'). `tables` are the collections, with their indexed fields, and
+    `keys` the other entries to be stored (see SqliteStorage).
+    """
+    if config is None:
+        config = {}
+    engine = config.get("engine", "json")
+    if engine == "json":
+        return JsonJournalStorage(snapshot_path, journal_path)
+    elif engine == "sqlite":
+        db_path = config.get("path", os.path.splitext(snapshot_path)[0] + ".db")
+        return SqliteStorage(db_path, tables, keys)
+    else:
+        raise ValueError(f"Unknown storage engine '{engine}'")
@@ -0,0 +1,90 @@
+import time
+import threading
+import requests
+
+"""
+HTTP cache
+--------------------------------------------------------------------------
+Local cache of the responses to GET requests, following the headers set
+by the catalogs: a response is reused without contacting the server for
+'Cache-Control: max-age' seconds, then it is revalidated with its ETag
+(If-None-Match) - if the server answers 304, the cached copy is still
+good and no body is downloaded.
+--------------------------------------------------------------------------
+"""
+
+
+class HTTPCache():
+    """
+    HTTPCache
+    --------------------------------------------------------------------------
+    Drop-in replacement of `requests.get()` for slowly changing resources
+    (e.g., broker and Telegram information, device catalog address).
+    --------------------------------------------------------------------------
+    Parameters:
+    - max_entries: max number of cached URLs (the oldest one is dropped)
+    --------------------------------------------------------------------------
+    """
+
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # {url: [expiration time (unix), response]}
+        self._entries = {}
+
+    def get(self, url, **kwargs):
+        """
+        Return the response (requests.Response) to GET `url`, from the
+        cache if still fresh. Other arguments are passed to `requests.get()`.
+        Raises the same exceptions as `requests.get()`.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if entry is not None and "ETag" in entry[1].headers:
+            headers["If-None-Match"] = entry[1].headers["ETag"]
+        resp = requests.get(url, headers=headers, **kwargs)
+
+        if resp.status_code == 304 and entry is not None:
+            # Still valid: keep the cached body, with the new expiration
+            self._store(url, entry[1], resp.headers)
+            return entry[1]
+        if resp.status_code == 200:
+            self._store(url, resp, resp.headers)
+        return resp
+
+    def invalidate(self, url=None):
+        # Drop the cached response of `url` (all responses if None)
+        with self._lock:
+            if url is None:
+                self._entries = {}
+            else:
+                self._entries.pop(url, None)
+
+    def _store(self, url, resp, headers):
+        # Only responses carrying a max-age or an ETag are worth keeping
+        max_age = self._maxAge(headers.get("Cache-Control", ""))
+        if max_age is None or (max_age == 0 and "ETag" not in resp.headers):
+            return
+        with self._lock:
+            if url not in self._entries and len(self._entries) >= self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            self._entries[url] = [time.time() + max_age, resp]
+
+    def _maxAge(self, cache_control):
+        # Max-age (seconds) of the 'Cache-Control' header, 0 if not to be
+        # reused without revalidation, None if not cacheable
+        max_age = 0
+        for directive in cache_control.split(","):
+            directive = directive.strip().lower()
+            if directive == "no-store":
+                return None
+            if directive.startswith("max-age="):
+                try:
+                    max_age = max(0, int(directive[len("max-age="):]))
+                except ValueError:
+                    pass
+        return max_age
@@ -0,0 +1,54 @@
+import json
+import zlib
+
+"""
+JSON streaming
+--------------------------------------------------------------------------
+Encoding of large lists of records as a sequence of chunks, to be sent
+with CherryPy's streaming (`cherrypy.response.stream = True`): the first
+bytes are sent right away and the full body is never held in memory.
+--------------------------------------------------------------------------
+"""
+
+
+def streamList(records, chunk_size=500, use_gzip=False, level=6):
+    """
+    Generator yielding the JSON encoding of the list `records` (the same
+    bytes as `json.dumps(records).encode()`), `chunk_size` records at a
+    time - compressed as a gzip stream if `use_gzip` is True.
+    ---
+    The list must not be modified while it is streamed (the catalogs
+    replace their lists instead of modifying them).
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) if use_gzip else None
+
+    def encode(text):
+        data = text.encode()
+        if compressor is not None:
+            # Flush, so that each chunk is sent as soon as it is encoded
+            return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data
+
+    yield encode("[")
+    for start in range(0, len(records), chunk_size):
+        text = ", ".join(json.dumps(rec) for rec in records[start:start+chunk_size])
+        if start > 0:
+            text = ", " + text
+        yield encode(text)
+    chunk = encode("]")
+    if compressor is not None:
+        chunk += compressor.flush()
+    yield chunk
+
+
+def afterBody(body, callback):
+    """
+    Generator yielding the chunks of the streamed `body`, then calling
+    `callback()` - also if it is closed before the end (client
+    disconnected). Used to release resources or record metrics only once
+    the whole body was sent.
+    """
+    try:
+        yield from body
+    finally:
+        callback()
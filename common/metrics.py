@@ -0,0 +1,185 @@
+import time
+import inspect
+import threading
+import cherrypy
+from .json_stream import afterBody
+
+"""
+Metrics
+--------------------------------------------------------------------------
+Counters, gauges and histograms exported in the Prometheus text format
+(`GET /metrics`). Recording a value only costs a dictionary update under
+a lock, so the instrumentation can be left on.
+--------------------------------------------------------------------------
+"""
+
+# Default histogram buckets - seconds, for request latencies
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+def timed(handler):
+    """
+    Decorator for the REST handlers (GET, POST, PUT, ...) of a web service
+    having a `metrics` attribute (Metrics object): it records the request
+    count and latency by method, endpoint and response code.
+    If the handler returns a generator (streamed body), the latency is the
+    time to send the whole body.
+    """
+    def wrapper(self, *uri, **params):
+        start = time.perf_counter()
+        record = lambda code: self.metrics.recordRequest(handler.__name__, uri, code, time.perf_counter() - start)
+        try:
+            out = handler(self, *uri, **params)
+        except cherrypy.HTTPError as exc:
+            record(exc.status)
+            raise
+        except:
+            record(500)
+            raise
+        code = cherrypy.response.status or 200
+        if inspect.isgenerator(out):
+            return afterBody(out, lambda: record(code))
+        record(code)
+        return out
+
+    wrapper.__name__ = handler.__name__
+    wrapper.__doc__ = handler.__doc__
+    return wrapper
+
+
+class Metrics():
+    """
+    Metrics
+    --------------------------------------------------------------------------
+    Registry of the metrics of a web service.
+    --------------------------------------------------------------------------
+    Parameters:
+    - prefix: prepended to all metric names (e.g., "serv_catalog")
+    - endpoints: known endpoints (first element of the URI); the others
+      are counted as "other", to keep the number of series bounded
+    - max_clients: max number of client addresses tracked separately
+    --------------------------------------------------------------------------
+    """
+
+    def __init__(self, prefix, endpoints=None, max_clients=100):
+        self.prefix = prefix
+        self.endpoints = set(endpoints or [])
+        self.max_clients = max_clients
+
+        self._lock = threading.Lock()
+        self._types = {}            # {name: (type, help)}
+        self._counters = {}         # {name: {labels: value}}
+        self._histograms = {}       # {name: {labels: [bucket counts, sum, count]}}
+        self._buckets = {}          # {name: upper bounds}
+        self._gauges = {}           # {name: {labels: value}}
+        self._gauge_funcs = {}      # {name: function returning {labels: value}}
+        self._clients = set()
+
+        self.describe("http_requests_total", "counter", "HTTP requests by method, endpoint and response code")
+        self.describe("http_request_duration_seconds", "histogram", "Duration of the HTTP requests")
+        self.describe("http_requests_by_client_total", "counter", "HTTP requests by client address")
+
+    def describe(self, name, kind, help_str, buckets=None):
+        # Declare metric `name` ("counter", "gauge" or "histogram")
+        self._types[name] = (kind, help_str)
+        if kind == "histogram":
+            self._buckets[name] = buckets or LATENCY_BUCKETS
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def setGauge(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def gaugeFunction(self, name, func):
+        """
+        Gauge evaluated at export time: `func` returns a number or a dict
+        {labels tuple: value}, e.g., {(("collection", "users"),): 10}
+        """
+        self._gauge_funcs[name] = func
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        bounds = self._buckets.get(name, LATENCY_BUCKETS)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = [[0] * len(bounds), 0, 0]
+                series[key] = hist
+            for ind, bound in enumerate(bounds):
+                if value <= bound:
+                    hist[0][ind] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    def recordRequest(self, method, uri, code, duration):
+        # Used by the `timed` decorator
+        endpoint = str(uri[0]) if len(uri) >= 1 else ""
+        if endpoint not in self.endpoints:
+            endpoint = "other"
+        try:
+            code = int(str(code).split()[0])
+        except ValueError:
+            code = 500
+        self.inc("http_requests_total", method=method, endpoint=endpoint, code=str(code))
+        self.observe("http_request_duration_seconds", duration, method=method, endpoint=endpoint)
+
+        client = cherrypy.request.remote.ip or ""
+        with self._lock:
+            if client not in self._clients:
+                if len(self._clients) < self.max_clients:
+                    self._clients.add(client)
+                else:
+                    client = "other"
+        self.inc("http_requests_by_client_total", client=client)
+
+    def export(self):
+        # Return all metrics in the Prometheus text format
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            gauges = {name: dict(series) for name, series in self._gauges.items()}
+            histograms = {name: {key: [list(hist[0]), hist[1], hist[2]] for key, hist in series.items()}
+                          for name, series in self._histograms.items()}
+        for name, func in self._gauge_funcs.items():
+            value = func()
+            if not isinstance(value, dict):
+                value = {(): value}
+            gauges[name] = value
+
+        for name in sorted(set(counters) | set(gauges) | set(histograms)):
+            full_name = f"{self.prefix}_{name}"
+            kind, help_str = self._types.get(name, ("untyped", ""))
+            lines.append(f"# HELP {full_name} {help_str}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if name in histograms:
+                bounds = self._buckets.get(name, LATENCY_BUCKETS)
+                for key, (buckets, total, count) in histograms[name].items():
+                    cumulative = 0
+                    for bound, n in zip(bounds, buckets):
+                        cumulative += n
+                        lines.append(f"{full_name}_bucket{self._labels(key, ('le', str(bound)))} {cumulative}")
+                    lines.append(f"{full_name}_bucket{self._labels(key, ('le', '+Inf'))} {count}")
+                    lines.append(f"{full_name}_sum{self._labels(key)} {total}")
+                    lines.append(f"{full_name}_count{self._labels(key)} {count}")
+            else:
+                series = counters.get(name, gauges.get(name, {}))
+                for key, value in series.items():
+                    lines.append(f"{full_name}{self._labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _labels(self, key, extra=None):
+        pairs = list(key)
+        if extra is not None:
+            pairs.append(extra)
+        if len(pairs) == 0:
+            return ""
+        escaped = [(label, str(value).replace("\\", "\\\\").replace('"', '\\"')) for label, value in pairs]
+        return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
@@ -0,0 +1,123 @@
+import gzip
+import json
+
+"""
+Response cache
+--------------------------------------------------------------------------
+Cache of the encoded responses of the catalog collections: the JSON (and
+gzip) bytes are only produced once per collection version, so repeated
+reads of an unchanged collection do not serialize it again. Large
+collections, which are streamed, are kept as the list of their chunks.
+--------------------------------------------------------------------------
+"""
+
+
+def acceptsGzip(accept_encoding):
+    """
+    Return True if the value of the 'Accept-Encoding' header allows gzip
+    (e.g., "gzip, deflate", but not "gzip;q=0").
+    """
+    for elem in accept_encoding.split(","):
+        params = [par.strip() for par in elem.split(";")]
+        if params[0].lower() in ["gzip", "*"]:
+            for par in params[1:]:
+                if par.replace(" ", "") in ["q=0", "q=0.0", "q=0.00", "q=0.000"]:
+                    return False
+            return True
+    return False
+
+
+class ResponseCache():
+    """
+    ResponseCache
+    --------------------------------------------------------------------------
+    Stores, for each key (e.g., collection name), the version of the content
+    and its encoding as JSON bytes, plus the gzip variant (compressed the
+    first time it is requested).
+    A new version of the content replaces the entry, so that the catalogs
+    do not need to invalidate it explicitly - they just need to increase
+    the version at every change.
+    --------------------------------------------------------------------------
+    Parameters:
+    - min_gzip_size: bodies smaller than this (bytes) are never compressed
+    - level: gzip compression level
+    --------------------------------------------------------------------------
+    """
+
+    def __init__(self, min_gzip_size=1024, level=6):
+        self.min_gzip_size = min_gzip_size
+        self.level = level
+        # {key: (version, body, gzip body or None)} - entries are replaced,
+        # never modified, so they can be read without locking
+        self._entries = {}
+        # {(key, gzip): (version, list of chunks)} - streamed contents
+        self._streams = {}
+
+    def get(self, key, version, build, use_gzip=False):
+        """
+        Return the encoded content for `key` at `version`, as a tuple
+        (bytes, content encoding) - the encoding is "gzip" or None.
+        ---
+        - build: function returning the (JSON serializable) content; only
+          called if the cached entry is missing or older
+        - use_gzip: True if the client accepts gzip
+        ---
+        The version must be read before calling `build` (or the content),
+        so that a concurrent change can only make the cached body newer
+        than its version, never older.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            entry = (version, json.dumps(build()).encode(), None)
+            self._entries[key] = entry
+            self._dropStreams(key)
+
+        if not use_gzip or len(entry[1]) < self.min_gzip_size:
+            return entry[1], None
+        if entry[2] is None:
+            entry = (entry[0], entry[1], gzip.compress(entry[1], self.level))
+            self._entries[key] = entry
+        return entry[2], "gzip"
+
+    def stream(self, key, version, chunks, use_gzip=False):
+        """
+        Return a generator yielding the encoded content for `key` at
+        `version`, as a sequence of chunks (for streamed responses).
+        ---
+        - chunks: function returning the generator of the chunks (JSON, 
+          gzip-compressed if `use_gzip`); only called if the cached entry
+          is missing or older
+        ---
+        The chunks are stored once they have all been sent: a body which
+        was not completed (client disconnected) is not cached.
+        """
+        entry = self._streams.get((key, use_gzip))
+        if entry is not None and entry[0] == version:
+            return (chunk for chunk in entry[1])
+        return self._record(key, version, chunks(), use_gzip)
+
+    def invalidate(self, key=None):
+        # Drop the entry of `key` (all entries if None)
+        if key is None:
+            self._entries = {}
+            self._streams = {}
+        else:
+            self._entries.pop(key, None)
+            self._dropStreams(key)
+
+    def _record(self, key, version, chunks, use_gzip):
+        # Yield the chunks, storing them at the end
+        stored = []
+        for chunk in chunks:
+            stored.append(chunk)
+            yield chunk
+        entry = self._streams.get((key, use_gzip))
+        if entry is None or entry[0] != version:
+            self._entries.pop(key, None)
+            self._dropStreams(key)
+        self._streams[(key, use_gzip)] = (version, stored)
+
+    def _dropStreams(self, key):
+        # Drop the streamed entries of `key` (both variants)
+        self._streams.pop((key, False), None)
+        self._streams.pop((key, True), None)
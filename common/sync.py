@@ -0,0 +1,63 @@
+import os
+import sys
+import filecmp
+import shutil
+
+"""
+Shared helpers
+--------------------------------------------------------------------------
+The modules in this folder are used by more than one service. Each service
+is built as a self-contained Docker image (only its own folder is copied),
+so it imports them from its own `sub` folder, where a copy of each helper
+it uses is committed. Edit the helpers here, then run, from the
+repository root:
+
+    $ python3 common/sync.py            # update the copies
+    $ python3 common/sync.py --check    # only list missing/outdated copies
+
+and commit the updated copies together with the helper.
+--------------------------------------------------------------------------
+"""
+
+# Helper -> folders of the services using it
+HELPERS = {
+    "admission.py": ["serv_catalog", "dev_catalog"],
+    "metrics.py": ["serv_catalog", "dev_catalog"],
+    "json_stream.py": ["serv_catalog", "dev_catalog"],
+    "response_cache.py": ["serv_catalog", "dev_catalog"],
+    "catalog_storage.py": ["serv_catalog", "dev_catalog"],
+    "http_cache.py": ["device_connector", "lighting_strategy", "telegram_bot", "water_delivery_strategy", "weather"],
+    "retry.py": ["device_connector", "lighting_strategy", "telegram_bot", "water_delivery_strategy", "weather"],
+    "lease.py": ["dev_catalog", "lighting_strategy", "mongoDB_adaptor", "telegram_bot", "water_delivery_strategy", "weather"],
+}
+
+
+def sync(root, check=False):
+    """
+    Copy each helper to the `sub` folder of the services using it, if
+    missing or different. Return the list of the copies which were (with
+    `check`: which should be) updated.
+    """
+    common = os.path.join(root, "common")
+    updated = []
+    for helper, services in HELPERS.items():
+        src = os.path.join(common, helper)
+        for service in services:
+            dst = os.path.join(root, service, "sub", helper)
+            if os.path.exists(dst) and filecmp.cmp(src, dst, shallow=False):
+                continue
+            updated.append(dst)
+            if not check:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copyfile(src, dst)
+    return updated
+
+
+if __name__ == "__main__":
+    check = "--check" in sys.argv[1:]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    updated = sync(root, check)
+    for path in updated:
+        print(("Outdated: " if check else "Updated: ") + os.path.relpath(path, root))
+    if check and len(updated) > 0:
+        sys.exit(1)
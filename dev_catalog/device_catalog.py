@@ -3,7 +3,16 @@ import requests
 import json
 import time
 from datetime import datetime
+import threading
+import hashlib
 import sys
+from sub.response_cache import ResponseCache, acceptsGzip
+from sub.json_stream import streamList
+from sub.metrics import Metrics, timed
+from sub.admission import AdmissionControl, admitted
+from sub.catalog_storage import openStorage
+from sub.MyMQTT import MyMQTT
+from sub.lease import renewLease
 
 """
 Device Catalog
@@ -16,6 +25,57 @@ port if running along the service
 catalog (on port 8080)
 """
 
+def mergePatch(target, patch, list_keys=("id", "service_type", "endpoint")):
+    """
+    Apply a JSON merge patch (RFC 7396) to `target` and return the result,
+    without modifying `target`: objects are merged recursively, null values
+    remove the key, any other value replaces the target one.
+    ---
+    Extension for lists of objects identified by one of `list_keys` (the 
+    sensors and actuators by "id", their "services_details" by 
+    "service_type", the "endpoints_details" by "endpoint"): an object in 
+    the patch, keyed by the identifier, patches the single elements instead
+    of replacing the whole list - e.g., 
+        {"resources": {"sensors": {"2": {"units": ["Cel"]}}}}
+    only changes sensor 2. A null element removes it, a new identifier 
+    appends the element. A list in the patch still replaces the list.
+    """
+    if not isinstance(patch, dict):
+        return patch
+    if isinstance(target, list):
+        key = next((key for key in list_keys if all(isinstance(elem, dict) and key in elem for elem in target)), None)
+        if key is not None:
+            return mergeList(target, patch, key, list_keys)
+    out = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            out.pop(key, None)
+        else:
+            out[key] = mergePatch(out.get(key), value, list_keys)
+    return out
+
+
+def mergeList(target, patch, key, list_keys):
+    # Patch the elements of the list `target`, identified by field `key`, 
+    # with the object `patch` ({str(identifier): element patch}) - see `mergePatch`
+    out = list(target)
+    positions = {str(elem[key]): ind for ind, elem in enumerate(out)}
+    for elem_key, value in patch.items():
+        if elem_key in positions:
+            if value is None:
+                out[positions[elem_key]] = None
+            else:
+                out[positions[elem_key]] = mergePatch(out[positions[elem_key]], value, list_keys)
+        elif isinstance(value, dict):
+            elem = mergePatch({}, value, list_keys)
+            if key not in elem:
+                # Numeric identifiers (e.g., sensor IDs) are stored as numbers
+                elem[key] = int(elem_key) if elem_key.isdigit() else elem_key
+            positions[elem_key] = len(out)
+            out.append(elem)
+    return [elem for elem in out if elem is not None]
+
+
 class DeviceCatalog():
     """
     DeviceCatalog
@@ -25,46 +85,325 @@ class DeviceCatalog():
     The web service will use an instance of
     DeviceCatalog to handle the JSON 
     catalog.
+    ---------------------------------------
+    Concurrency: the catalog dictionary is
+    never modified once published; writers
+    (holding `self._lock`) build a new one
+    and replace it, so readers need no lock.
     """
 
-    def __init__(self, in_path, out_path="dev_catalog_updated.json"):
+    def __init__(self, in_path, out_path="dev_catalog_updated.json", metrics=None, listener=None):
         # NOTE: this class does not need the static info about the services catalog
         # since connection to the services catalog is handled by the web service
         
         # Allow to use fac-simile catalog for testing
         try:
-            self.cat = json.load(open(in_path))
+            cat = json.load(open(in_path))
         except:
             print("Default device catalog taken")
-            self.cat = json.load(open("dev_catalog.json"))
+            cat = json.load(open("dev_catalog.json"))
         
         self._dev_cat_params = ['project_name', 'project_owner', 
                         'device_catalog', "devices"]
 
         # Check for valid catalog
-        if all(elem for elem in self.cat for elem in self._dev_cat_params):
+        if all(elem for elem in cat for elem in self._dev_cat_params):
             print("Valid catalog!")
         else:
             raise KeyError("Wrong device catalog syntax!")
         
         self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cat["last_update"] = self.last_update
+        cat["last_update"] = self.last_update
+
+        # Storage engine (optional "storage" entry of the input catalog, e.g.
+        # {"engine": "sqlite", "path": "dev_catalog.db"}): changes are written
+        # to the database, and the devices are recovered from it at startup.
+        # By default, saveAsJson() writes the whole catalog as JSON
+        storage_conf = cat.pop("storage", None)
+        self._storage = None
+        self._pending = []          # Changes not yet written to the database
+        self._renewed = set()       # IDs of the devices renewed since the last save
+        self._changes = 0           # Other changes since the last save
+        if storage_conf is not None and storage_conf.get("engine", "json") != "json":
+            self._storage = openStorage(storage_conf, out_path, {"devices": ["name", "greenhouse"]}, ["next_id"])
+            stored = self._storage.load(cat)
+            if stored is not None:
+                cat["devices"] = stored["devices"]
+                if "next_id" in stored:
+                    cat["next_id"] = stored["next_id"]
+                print(f"Recovered {len(cat['devices'])} devices")
 
+        # Writers hold the lock; `self.cat` is the published catalog
+        self._lock = threading.RLock()
+        self.cat = cat
+        # Increased at every change of the devices
+        self.version = 0
         # For checking at insertion:
         self._device_params = ['id', 'name', 'endpoints', 
                             'endpoints_details', 'greenhouse', 
                             'resources', 'last_update']
         
+        # Capability index, replaced (never modified) together with the 
+        # catalog: {"devices": {id: device}, "topics": {id: {"sensor": 
+        # {capability: [MQTT topics]}, "actuator": {...}}}, "sensor": 
+        # {measure type: frozenset of IDs}, "actuator": {action: frozenset of IDs}}
+        # plus the topic table of the sensors: "rows": {id: [(topic, row)]},
+        # "by_topic": {topic: [device ID, sensor ID, measure type, unit]}
+        # and its version "topics_version", only increased when it changes;
+        # "hashes": {id: content hash of the device (see _hash)}.
+        # The epoch distinguishes the versions of different runs
+        self.epoch = format(int(time.time()), "x")
+        self._index = {"devices": {}, "hashes": {}, "topics": {}, "sensor": {}, "actuator": {},
+                       "rows": {}, "by_topic": {}, "topics_version": 0}
+        self._index = self._updateIndex(put=cat["devices"])
+
         self.out_path = out_path
 
+        # Optional Metrics object: duration and size of the saved catalog
+        self.metrics = metrics
+
+        # Optional function called (holding the lock, so in order) at every 
+        # change of the devices, with the event - see _notify()
+        self.listener = listener
+        if metrics is not None:
+            metrics.describe("save_duration_seconds", "histogram", "Duration of saveAsJson")
+            metrics.describe("saved_bytes_total", "counter", "Bytes written by saveAsJson")
+
+        # ID allocation: IDs are never reused - new IDs are above both the
+        # highest ID in use and the high-water mark of the allocated ones
+        # ("next_id", stored in the output catalog and recovered from it)
+        self._max_id = 0
+        for dev in cat["devices"]:
+            self._updateMaxID(dev["id"])
+        if self._storage is None:
+            try:
+                cat["next_id"] = int(json.load(open(out_path))["next_id"])
+            except:
+                pass
+
 
     def saveAsJson(self):
         # Used to save a local copy of the current dictionary - returns 1 if success, else 0
+        # With a storage engine, only the changes since the last call are written
+        with self._lock:
+            try:
+                start = time.perf_counter()
+                if self._storage is not None:
+                    # Renewed devices are written with their last timestamp
+                    devices = self._index["devices"]
+                    renewed = [{"op": "put", "coll": "devices", "rec": devices[dev_id]} for dev_id in self._renewed if dev_id in devices]
+                    pending, self._pending = self._pending + renewed, []
+                    n_bytes = self._storage.append(pending)
+                else:
+                    data = json.dumps(self.cat)
+                    with open(self.out_path, "w") as f:
+                        f.write(data)
+                    n_bytes = len(data)
+                self._renewed = set()
+                self._changes = 0
+                if self.metrics is not None:
+                    self.metrics.observe("save_duration_seconds", time.perf_counter() - start)
+                    self.metrics.inc("saved_bytes_total", n_bytes)
+                return 1
+            except:
+                return 0
+
+    def _log(self, change):
+        # Keep the change for the storage engine, if any - holding the lock
+        self._changes += 1
+        if self._storage is not None:
+            self._pending.append(change)
+
+    def countChanges(self):
+        # Number of changes (except renewals) not saved yet
+        return self._changes
+
+    def _hash(self, dev):
+        # Content hash of a device record: all fields but last_update, in canonical JSON
+        content = {key: dev.get(key) for key in self._device_params if key != "last_update"}
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def _publish(self, devices, put=(), dropped=(), renewed=()):
+        # Replace the published catalog with one having the new list of 
+        # devices, where the devices in `put` were added/updated, the 
+        # IDs in `dropped` removed and the devices in `renewed` only got a 
+        # new timestamp - must be called holding the lock.
+        # Renewals alone do not change the version: the cached responses
+        # (by version) stay valid, only their timestamps get older
+        cat = dict(self.cat)
+        cat["devices"] = devices
+        cat["last_update"] = self.last_update
+        self._index = self._updateIndex(put, dropped, renewed)
+        self.cat = cat
+        if len(put) > 0 or len(dropped) > 0:
+            self.version += 1
+
+    def _deviceTopics(self, dev):
+        """
+        Return the list of MQTT topics of the device, as dictionaries:
+        {"topic", "kind" ("sensor" or "actuator"), "resource_id", 
+        "capability", "unit"}.
+        ---
+        The capability of a sensor topic is its measure type (e.g., "Soil 
+        Moisture"): the one whose name, in lower case and with underscores,
+        is the last element of the topic ("smartGreenhouse/1/chirp/soil_moisture"),
+        else the one at the same position. The capability of an actuator 
+        topic is its last element (e.g., "act_water"), and it has no unit.
+        Malformed resources are skipped.
+        """
+        topics = []
+        resources = dev.get("resources")
+        if not isinstance(resources, dict):
+            return topics
+        for kind in ["sensors", "actuators"]:
+            for res in resources.get(kind) or []:
+                try:
+                    mqtt_topics = []
+                    for det in res.get("services_details") or []:
+                        if det.get("service_type") == "MQTT":
+                            mqtt_topics += det.get("topic") or []
+                    measures = (res.get("measure_type") or []) if kind == "sensors" else []
+                    units = res.get("units") or []
+                    if isinstance(measures, str):
+                        measures = [measures]
+                    if isinstance(units, str):
+                        units = [units]
+                    names = [str(meas).lower().replace(" ", "_") for meas in measures]
+
+                    for pos, top in enumerate(mqtt_topics):
+                        entry = {"topic": top, "kind": kind[:-1], "resource_id": res.get("id"),
+                                 "capability": top.split("/")[-1], "unit": None}
+                        ind = None
+                        if entry["capability"] in names:
+                            ind = names.index(entry["capability"])
+                        elif len(measures) == len(mqtt_topics):
+                            ind = pos
+                        if ind is not None:
+                            entry["capability"] = measures[ind]
+                            entry["unit"] = units[ind] if ind < len(units) else None
+                        topics.append(entry)
+                except (AttributeError, TypeError):
+                    continue
+        return topics
+
+    def _updateIndex(self, put=(), dropped=(), renewed=()):
+        # Return a new capability index, with the devices in `put` added/
+        # updated and the IDs in `dropped` removed - holding the lock.
+        # The dictionaries are copied, the ID sets are only rebuilt for the
+        # capabilities which changed (not at the periodic refresh); for the
+        # `renewed` devices, only the record is replaced
+        old = self._index
+        index = {"devices": dict(old["devices"]), "hashes": dict(old["hashes"]), "topics": dict(old["topics"]),
+                 "sensor": dict(old["sensor"]), "actuator": dict(old["actuator"]),
+                 "rows": old["rows"], "by_topic": old["by_topic"], 
+                 "topics_version": old["topics_version"]}
+        changes = []            # (kind, capability, ID, True if added)
+        new_rows = {}           # {ID: [(topic, row)]} - for the changed ones
+        for dev_id in dropped:
+            if dev_id in index["devices"]:
+                del index["devices"][dev_id]
+                del index["hashes"][dev_id]
+                for kind, caps in index["topics"].pop(dev_id).items():
+                    changes += [(kind, cap, dev_id, False) for cap in caps]
+                new_rows[dev_id] = []
+        for dev in put:
+            caps = {"sensor": {}, "actuator": {}}
+            rows = []
+            for entry in self._deviceTopics(dev):
+                caps[entry["kind"]].setdefault(entry["capability"], []).append(entry["topic"])
+                if entry["kind"] == "sensor":
+                    rows.append((entry["topic"], [dev["id"], entry["resource_id"], entry["capability"], entry["unit"]]))
+            old_caps = index["topics"].get(dev["id"], {"sensor": {}, "actuator": {}})
+            for kind in caps:
+                changes += [(kind, cap, dev["id"], False) for cap in old_caps[kind] if cap not in caps[kind]]
+                changes += [(kind, cap, dev["id"], True) for cap in caps[kind] if cap not in old_caps[kind]]
+            index["devices"][dev["id"]] = dev
+            index["hashes"][dev["id"]] = self._hash(dev)
+            index["topics"][dev["id"]] = caps
+            if rows != index["rows"].get(dev["id"], []):
+                new_rows[dev["id"]] = rows
+
+        for dev in renewed:
+            index["devices"][dev["id"]] = dev
+
+        for kind, cap, dev_id, added in changes:
+            ids = index[kind].get(cap, frozenset())
+            ids = ids | {dev_id} if added else ids - {dev_id}
+            if ids:
+                index[kind][cap] = ids
+            else:
+                index[kind].pop(cap, None)
+
+        if new_rows:
+            # The topic table changed: new version
+            index["rows"] = dict(index["rows"])
+            index["by_topic"] = dict(index["by_topic"])
+            for dev_id, rows in new_rows.items():
+                for topic, row in index["rows"].pop(dev_id, []):
+                    # Unless the topic was taken by another device
+                    if index["by_topic"].get(topic, [None])[0] == dev_id:
+                        del index["by_topic"][topic]
+                if rows:
+                    index["rows"][dev_id] = rows
+                for topic, row in rows:
+                    index["by_topic"][topic] = row
+            index["topics_version"] += 1
+        return index
+
+    def _notify(self, event, dev):
+        """
+        Pass the event of device `dev` to the listener, if any - holding 
+        the lock, after publishing the change. The event is compact: 
+        {"event": "add"/"update"/"expire", "id", "version" (catalog version)}
+        plus, if not expired, "greenhouse", "sensors" (topic table rows: 
+        {topic: [device ID, sensor ID, measure type, unit]}) and "actuators"
+        ({action: [topics]}).
+        """
+        if self.listener is None:
+            return
+        out = {"event": event, "id": dev["id"], "version": self.version}
+        if event != "expire":
+            index = self._index
+            out["greenhouse"] = dev["greenhouse"]
+            out["sensors"] = {topic: row for topic, row in index["rows"].get(dev["id"], [])}
+            out["actuators"] = index["topics"][dev["id"]]["actuator"]
         try:
-            json.dump(self.cat, open(self.out_path, "w"))
-            return 1
-        except:
-            return 0
+            self.listener(out)
+        except Exception as e:
+            print(f"Unable to notify the device event: {e}")
+
+    def replayEvents(self):
+        """
+        Notify an "add" event for each device, e.g., when the listener 
+        starts; no change can be notified in between.
+        """
+        with self._lock:
+            for dev in self.cat["devices"]:
+                self._notify("add", dev)
+
+    def _updateMaxID(self, dev_id):
+        # Keep track of the highest (numeric) ID in use
+        try:
+            self._max_id = max(self._max_id, int(dev_id))
+        except (ValueError, TypeError):
+            pass
+
+    def allocateIDs(self, count=1):
+        """
+        Reserve `count` consecutive new device IDs and return the first one.
+        The new high-water mark is saved (`saveAsJson()`) before returning, 
+        so the IDs are not handed out again after a restart.
+        """
+        if count < 1:
+            raise ValueError("The number of IDs must be positive")
+        with self._lock:
+            first = max(self.cat.get("next_id", 1), self._max_id + 1)
+            cat = dict(self.cat)
+            cat["next_id"] = first + count
+            self.cat = cat
+            self._log({"op": "set", "key": "next_id", "value": first + count})
+            self.saveAsJson()
+        return first
 
     def getDevCatInfo(self):
         return self.cat["device_catalog"]
@@ -72,19 +411,82 @@ class DeviceCatalog():
     def getDevices(self):
         return self.cat["devices"]
 
+    def getVersion(self):
+        return self.version
+
     def countDevices(self):
-        return len(self.cat["users"])
+        return len(self.cat["devices"])
 
     def searchDevice(self, parameter, value):
         if parameter not in self._device_params:
             raise KeyError(f"Invalid key '{parameter}'")
         elem = {}
-        for elem_cat in self.cat["devices"]:
+        for elem_cat in self.getDevices():
             if elem_cat[parameter] == value:
                 elem = elem_cat.copy()
 
         return elem
 
+    def queryDevices(self, sensors=(), actuators=(), fields=None):
+        """
+        Return the list of devices having all the given capabilities:
+        sensors by measure type (e.g., "Soil Moisture") and actuators by
+        action (last element of the topic, e.g., "act_water"), sorted by ID.
+        ---
+        If `fields` is None, the full records are returned; else, only 
+        the device ID and the listed fields. The field "topics" is the 
+        dictionary {capability: [MQTT topics]} of the device (sensors and 
+        actuators). Raises KeyError for an unknown field.
+        """
+        if fields is not None:
+            for field in fields:
+                if field not in self._device_params + ["topics"]:
+                    raise KeyError(f"Invalid field '{field}'")
+        index = self._index
+        ids = None
+        for kind, caps in [("sensor", sensors), ("actuator", actuators)]:
+            for cap in caps:
+                found = index[kind].get(cap, frozenset())
+                ids = found if ids is None else ids & found
+        if ids is None:
+            ids = index["devices"].keys()
+        try:
+            ids = sorted(ids)
+        except TypeError:
+            ids = sorted(ids, key=str)
+
+        out = []
+        for dev_id in ids:
+            dev = index["devices"][dev_id]
+            if fields is None:
+                out.append(dev)
+                continue
+            rec = {"id": dev_id}
+            for field in fields:
+                if field == "topics":
+                    topics = index["topics"][dev_id]
+                    rec["topics"] = {**topics["sensor"], **topics["actuator"]}
+                else:
+                    rec[field] = dev[field]
+            out.append(rec)
+        return out
+
+    def getTopicTable(self):
+        """
+        Return the topic table of the sensors and its version, as 
+        ({topic: [device ID, sensor ID, measure type, unit]}, version);
+        the version is only increased when the table changes.
+        """
+        index = self._index
+        return index["by_topic"], index["topics_version"]
+
+    def searchTopic(self, topic):
+        # Return the sensor publishing on `topic`, as {"topic", "device_id", "sensor_id", "measure_type", "unit"} ({} if not found)
+        row = self._index["by_topic"].get(topic)
+        if row is None:
+            return {}
+        return {"topic": topic, "device_id": row[0], "sensor_id": row[1], "measure_type": row[2], "unit": row[3]}
+
     def addDevice(self, newDev):
         """ 
         Add new device; if successful, the returned value
@@ -101,47 +503,141 @@ class DeviceCatalog():
         if all(elem in newDev for elem in self._device_params):
             # can proceed to adding the element
             new_id = newDev["id"]
-            if self.searchDevice("id", new_id) == {}:
-                new_dict = {}
-                for key in self._device_params:
-                    new_dict[key] = newDev[key]
-                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                new_dict["last_update"] = self.last_update
-                self.cat["devices"].append(new_dict)
-                self.cat["last_update"] = self.last_update
-                return new_id
+            with self._lock:
+                if self.searchDevice("id", new_id) == {}:
+                    new_dict = {}
+                    for key in self._device_params:
+                        new_dict[key] = newDev[key]
+                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    new_dict["last_update"] = self.last_update
+                    self._updateMaxID(new_id)
+                    self._publish(self.cat["devices"] + [new_dict], put=[new_dict])
+                    self._log({"op": "put", "coll": "devices", "rec": new_dict})
+                    self._notify("add", new_dict)
+                    return new_id
         
         return 0
     
     def updateDevice(self, upd_dev):
+        """
+        Replace an existing device; the returned value is its ID, or 0 if
+        the device is not registered or a field is missing.
+        If the content did not change (same hash), the device is only 
+        renewed (see `renewDevices`): nothing to write to disk, no event.
+        """
         if all(elem in upd_dev for elem in self._device_params):
-            # Find service
-            for ind in range(len(self.cat["devices"])):
-                if self.cat["devices"][ind]["id"] == upd_dev["id"]:
-                    for key in self._device_params:
-                        self.cat["devices"][ind][key] = upd_dev[key]
-                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.cat["devices"][ind]["last_update"] = self.last_update
-                    self.cat["last_update"] = self.last_update
-                    return upd_dev["id"]
+            with self._lock:
+                if self._index["devices"].get(upd_dev["id"]) is not None:
+                    return self._replaceDevice(upd_dev)
             
         return 0
 
+    def patchDevice(self, dev_id, patch, expected=None):
+        """
+        Partial update of device `dev_id`: the JSON merge patch (RFC 7396) 
+        `patch` is applied to the stored record - e.g., {"greenhouse": 2}.
+        Sensors and actuators can be patched one by one, keyed by ID (see 
+        `mergePatch`).
+        If `expected` (list of content hashes) is given, the patch is only
+        applied if the current hash of the device is one of them - checked
+        holding the lock, so two patches based on the same version cannot
+        both succeed.
+        The returned value is the device ID, -1 if the device changed (not 
+        in `expected`), or 0 if the device is not registered, the patch 
+        changes the ID or removes a required field.
+        """
+        if not isinstance(patch, dict) or patch.get("id", dev_id) != dev_id:
+            return 0
+        with self._lock:
+            dev = self._index["devices"].get(dev_id)
+            if dev is not None and expected is not None and self._index["hashes"][dev_id] not in expected:
+                return -1
+            if dev is not None:
+                new_dev = mergePatch(dev, patch)
+                if all(elem in new_dev for elem in self._device_params):
+                    return self._replaceDevice(new_dev)
+        return 0
+
+    def getDeviceHash(self, dev_id):
+        # Content hash of the device (None if not registered)
+        return self._index["hashes"].get(dev_id)
+
+    def _replaceDevice(self, upd_dev):
+        # Replace the record of a registered device - holding the lock
+        dev_id = upd_dev["id"]
+        if self._hash(upd_dev) == self._index["hashes"][dev_id]:
+            # Same content (e.g., periodic refresh): only the timestamp changes
+            self.renewDevices([dev_id])
+            return dev_id
+
+        new_dict = {}
+        for key in self._device_params:
+            new_dict[key] = upd_dev[key]
+        self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        new_dict["last_update"] = self.last_update
+        devices = list(self.cat["devices"])
+        for ind in range(len(devices)):
+            if devices[ind]["id"] == dev_id:
+                devices[ind] = new_dict
+        self._publish(devices, put=[new_dict])
+        self._log({"op": "put", "coll": "devices", "rec": new_dict})
+        self._notify("update", new_dict)
+        return dev_id
+
+    def renewDevices(self, ids):
+        """
+        Refresh the last_update of the devices having the given IDs (e.g., 
+        heartbeats), without any other change - not an event.
+        Returns the list of renewed IDs (unknown ones need to register).
+        All of them are published in a single new catalog, with the same
+        version; they are only written to disk at the next `saveAsJson()`.
+        """
+        with self._lock:
+            known = self._index["devices"]
+            ids = {dev_id for dev_id in ids if dev_id in known}
+            if len(ids) == 0:
+                return []
+            self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            devices = []
+            renewed = []
+            for dev in self.cat["devices"]:
+                if dev["id"] in ids:
+                    dev = dev.copy()
+                    dev["last_update"] = self.last_update
+                    renewed.append(dev)
+                devices.append(dev)
+            self._publish(devices, renewed=renewed)
+            self._renewed |= ids
+        return [dev["id"] for dev in renewed]
+
+    def countRenewals(self):
+        # Number of devices renewed and not saved yet
+        return len(self._renewed)
+
     def cleanDevices(self, curr_time, timeout):
         """
         Clean up old devices records
         - curr_time: unix timestamp
         - timeout: in seconds
         """
-        n_rem = 0
-        for ind in range(len(self.cat["devices"])):
-            gh_time = datetime.timestamp(datetime.strptime(self.cat["devices"][ind]["last_update"], "%Y-%m-%d %H:%M:%S"))       # Problematic
-            if curr_time - gh_time > timeout:
-                # Delete record
-                self.cat["devices"].remove(self.cat["devices"][ind])
+        with self._lock:
+            kept = []
+            dropped = []
+            for dev in self.cat["devices"]:
+                dev_time = datetime.timestamp(datetime.strptime(dev["last_update"], "%Y-%m-%d %H:%M:%S"))
+                if curr_time - dev_time <= timeout:
+                    kept.append(dev)
+                else:
+                    dropped.append(dev["id"])
+                    self._log({"op": "del", "coll": "devices", "id": dev["id"]})
+            
+            # Expired records are dropped by publishing the list of the others
+            n_rem = len(dropped)
+            if n_rem > 0:
                 self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.cat["last_update"] = self.last_update
-                n_rem += 1
+                self._publish(kept, dropped=dropped)
+                for dev_id in dropped:
+                    self._notify("expire", {"id": dev_id})
         
         return n_rem
 
@@ -155,18 +651,64 @@ class DeviceCatalogWebService():
 
     exposed = True
 
-    def __init__(self, catalog_path, serv_catalog_info="serv_cat_info.json", cmd_list_cat="cmd_list.json", output_cat_path="dev_catalog_updated.json", dev_timeout=120):
+    def __init__(self, catalog_path, serv_catalog_info="serv_cat_info.json", cmd_list_cat="cmd_list.json", output_cat_path="dev_catalog_updated.json", dev_timeout=120, events_topic="smartGreenhouse/catalog/devices", heartbeat_topic="smartGreenhouse/catalog/heartbeat"):
         self.API = json.load(open(cmd_list_cat))
-        self.catalog = DeviceCatalog(in_path=catalog_path, out_path=output_cat_path)
+
+        # Metrics exported at /metrics - requests are only counted by known endpoint
+        endpoints = [cmd.split("?")[0].strip("/") for elem in self.API["methods"] for cmd in elem["available_commands"]]
+        self.metrics = Metrics("dev_catalog", endpoints + ["new_id"])
+        self.metrics.describe("devices", "gauge", "Number of registered devices")
+        self.metrics.describe("expired_records_total", "counter", "Devices removed at cleanup")
+        self.metrics.describe("cleanup_duration_seconds", "histogram", "Duration of the cleanup sweeps")
+        self.metrics.describe("allocated_ids_total", "counter", "Device IDs handed out")
+
+        self.metrics.describe("device_events_total", "counter", "Device events published over MQTT")
+
+        # Device events: added, updated and expired devices are published 
+        # (retained) on `events_topic`/<device ID>, on the broker known by 
+        # the services catalog - not before the connection
+        self._events_topic = events_topic
+        self._broker_info = {}
+        self._mqtt = None
+        # Seconds after the connection during which the stale retained 
+        # events (devices expired while not connected) are cleared
+        self._events_sync_time = 10
+
+        # Heartbeats of the devices (MQTT, `heartbeat_topic`/<device ID>): 
+        # collected as they arrive, applied in bulk every `_hb_period` seconds
+        self._hb_topic = heartbeat_topic
+        self._hb_period = 5
+        self._hb_lock = threading.Lock()
+        self._heartbeats = set()
+        self.metrics.describe("heartbeats_received_total", "counter", "Heartbeats received over MQTT")
+        self.metrics.describe("heartbeat_renewals_total", "counter", "Devices renewed by the heartbeats (unknown: not registered)")
+
+        self.catalog = DeviceCatalog(in_path=catalog_path, out_path=output_cat_path, metrics=self.metrics, listener=self.publishEvent)
+        self.metrics.gaugeFunction("devices", self.catalog.countDevices)
+
+        # Admission control: excess requests are rejected with 429 and a
+        # Retry-After hint (metrics are not limited)
+        self.admission = AdmissionControl(max_in_flight=8, max_queued=32, max_wait=1, exempt=["metrics"])
+        self.metrics.describe("requests_in_flight", "gauge", "Requests being processed")
+        self.metrics.describe("requests_queued", "gauge", "Requests waiting to be processed")
+        self.metrics.describe("rejected_requests_total", "counter", "Requests rejected by the admission control (429)")
+        self.metrics.gaugeFunction("requests_in_flight", lambda: self.admission.in_flight)
+        self.metrics.gaugeFunction("requests_queued", lambda: self.admission.queued)
+        self.metrics.gaugeFunction("rejected_requests_total", lambda: self.admission.rejected)
         self.msg_ok = {"status": "SUCCESS", "msg": ""}
         self.msg_ko = {"status": "FAILURE", "msg": ""}
         self.timeout = dev_timeout          # seconds - device info timeout
+
+        # Encoded response of the devices list, by catalog version; lists 
+        # with more devices than this are streamed instead
+        self._cache = ResponseCache()
+        self._stream_threshold = 5000
         
         # Used for choosing when to try again to make POST to service catalog
         self.serv_timeout = 60
 
-        # Next device ID:
-        self._next_devID = 1
+        # At most this number of IDs can be reserved by a single request
+        self._max_id_block = 1000
 
         self.my_info = self.catalog.getDevCatInfo()
         print(f"I am {self.my_info}")
@@ -184,19 +726,42 @@ class DeviceCatalogWebService():
         
         # Register at the catalog
         self._registered_at_catalog = False
+        self._last_update_serv = 0
         self.registerAtServiceCatalog()
+        self.connectToBroker()
     
         
+    @timed
+    @admitted
     def GET(self, *uri, **params):
         if (len(uri) >= 1):
-            if (str(uri[0]) == "devices"):
-                return json.dumps(self.catalog.getDevices())
+            if (str(uri[0]) == "metrics"):
+                cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+                return self.metrics.export()
+            elif (str(uri[0]) == "devices"):
+                if any(par in params for par in ["sensor", "actuator", "fields"]):
+                    return self.queryDevices(params)
+                return self.cachedResponse(self.catalog.getDevices)
+            elif (str(uri[0]) == "topics"):
+                return self.topicTable()
+            elif (str(uri[0]) == "topic"):
+                if "name" not in params:
+                    raise cherrypy.HTTPError(400, f"Missing/wrong parameters")
+                found = self.catalog.searchTopic(str(params["name"]))
+                if found == {}:
+                    raise cherrypy.HTTPError(404, f"Topic {params['name']} not found!")
+                return json.dumps(found)
             elif (str(uri[0]) == "device"):
                 if "id" in params:
                     dev_ID = int(params["id"])
                     found_dev = self.catalog.searchDevice("id", dev_ID)
                     if found_dev != {}:
-                        # Was found
+                        # Was found - the ETag is the content hash (not 
+                        # changed by the refreshes)
+                        etag = f'"{self.catalog.getDeviceHash(dev_ID)}"'
+                        cherrypy.response.headers["ETag"] = etag
+                        if self.notModified(etag):
+                            return b""
                         return json.dumps(found_dev)
                     else:
                         raise cherrypy.HTTPError(404, f"Device {dev_ID} not found!")
@@ -210,14 +775,24 @@ class DeviceCatalogWebService():
                 else:
                     raise cherrypy.HTTPError(400, f"Missing/wrong parameters")
             elif (str(uri[0]) == "new_id"):
-                self.checkUnusedID()
+                # Optional parameter 'count' to reserve a block of IDs
+                try:
+                    count = int(params.get("count", 1))
+                except ValueError:
+                    raise cherrypy.HTTPError(400, "Invalid count")
+                if count < 1 or count > self._max_id_block:
+                    raise cherrypy.HTTPError(400, f"The count must be between 1 and {self._max_id_block}")
                 out = {}
-                out["id"] = self._next_devID
-                self._next_devID += 1
+                out["id"] = self.catalog.allocateIDs(count)
+                self.metrics.inc("allocated_ids_total", count)
+                if "count" in params:
+                    out["ids"] = list(range(out["id"], out["id"] + count))
                 return json.dumps(out)
         else:
             return "Available commands: " + json.dumps(self.API["methods"][0])
 
+    @timed
+    @admitted
     def POST(self, *uri, **params):
         """ 
         Used to add new records (devices)
@@ -242,6 +817,8 @@ class DeviceCatalogWebService():
         else:
             return "Available commands: " + json.dumps(self.API["methods"][1])
 
+    @timed
+    @admitted
     def PUT(self, *uri, **params):
         """
         Used to update existing records
@@ -255,7 +832,10 @@ class DeviceCatalogWebService():
                     out = self.msg_ok.copy()
                     out["msg"] = f"Device {body['id']} was successfully updated"
                     print(out["msg"])
-                    self.catalog.saveAsJson()
+                    # Unchanged devices are only renewed, in memory
+                    if self.catalog.countChanges() > 0:
+                        self.catalog.saveAsJson()
+                    cherrypy.response.headers["ETag"] = f'"{self.catalog.getDeviceHash(body["id"])}"'
                     cherrypy.response.status = 200
                     return json.dumps(out)
                 else:
@@ -268,15 +848,147 @@ class DeviceCatalogWebService():
             return "Available commands: " + json.dumps(self.API["methods"][2])
 
 
+    @timed
+    @admitted
+    def PATCH(self, *uri, **params):
+        """
+        Used to update part of an existing record: the body is a JSON merge 
+        patch (RFC 7396), e.g. `/device?id=1` + {"greenhouse": 2}.
+        With the header If-Match (ETag of the device), the patch is only 
+        applied if the device did not change in the meantime.
+        """
+        body = json.loads(cherrypy.request.body.read())
+
+        if (len(uri) >= 1):
+            if (str(uri[0]) == "device"):
+                if "id" not in params:
+                    raise cherrypy.HTTPError(400, f"Missing/wrong parameters")
+                dev_ID = int(params["id"])
+                if_match = cherrypy.request.headers.get("If-Match")
+                expected = None
+                if if_match is not None and if_match.strip() != "*":
+                    # Strong comparison: weak tags (W/) never match
+                    expected = [tag.strip()[1:-1] for tag in if_match.split(",") if tag.strip().startswith('"')]
+
+                rc = self.catalog.patchDevice(dev_ID, body, expected)
+                if rc == -1:
+                    raise cherrypy.HTTPError(412, f"Device {dev_ID} was modified")
+                if rc != 0:
+                    out = self.msg_ok.copy()
+                    out["msg"] = f"Device {dev_ID} was successfully updated"
+                    print(out["msg"])
+                    if self.catalog.countChanges() > 0:
+                        self.catalog.saveAsJson()
+                    cherrypy.response.headers["ETag"] = f'"{self.catalog.getDeviceHash(dev_ID)}"'
+                    cherrypy.response.status = 200
+                    return json.dumps(out)
+                else:
+                    out = self.msg_ko.copy()
+                    out["msg"] = "Unable to update device"
+                    print(out["msg"])
+                    cherrypy.response.status = 400
+                    return json.dumps(out)
+        else:
+            return "Available commands: " + json.dumps(self.API["methods"][3])
+
     ###########################################################
 
+    def cachedResponse(self, build):
+        """
+        Return the body of the devices list; `build` returns the list (not 
+        copied). The body comes from the response cache (encoded again only
+        if the devices changed); lists larger than `self._stream_threshold`
+        are streamed, 500 devices per chunk, and cached as their list of
+        chunks. The gzip variant is returned if the client accepts it.
+        The ETag is the version (with the epoch): a client having the
+        current list gets 304, before anything is encoded.
+        """
+        version = self.catalog.getVersion()
+        etag = f'"{self.catalog.epoch}-{version}"'
+        cherrypy.response.headers["ETag"] = etag
+        cherrypy.response.headers["Cache-Control"] = "no-cache"
+        cherrypy.response.headers["Vary"] = "Accept-Encoding"
+        if self.notModified(etag):
+            return b""
+        devices = build()
+        use_gzip = acceptsGzip(cherrypy.request.headers.get("Accept-Encoding", ""))
+        if len(devices) > self._stream_threshold:
+            cherrypy.response.stream = True
+            if use_gzip:
+                cherrypy.response.headers["Content-Encoding"] = "gzip"
+            return self._cache.stream("devices", version, lambda: streamList(devices, use_gzip=use_gzip), use_gzip)
+
+        body, encoding = self._cache.get("devices", version, lambda: devices, use_gzip)
+        if encoding is not None:
+            cherrypy.response.headers["Content-Encoding"] = encoding
+        return body
+
+    def queryDevices(self, params):
+        """
+        Capability query on the devices (`/devices?sensor=...&actuator=...&fields=...`):
+        'sensor' and 'actuator' can be repeated (all are required), 'fields'
+        is a comma-separated list of device fields (e.g., "topics").
+        """
+        sensors = params.get("sensor", [])
+        actuators = params.get("actuator", [])
+        sensors = [sensors] if isinstance(sensors, str) else sensors
+        actuators = [actuators] if isinstance(actuators, str) else actuators
+        fields = None
+        if "fields" in params:
+            fields = [field.strip() for field in str(params["fields"]).split(",") if field.strip() != ""]
+        try:
+            return json.dumps(self.catalog.queryDevices(sensors, actuators, fields))
+        except KeyError as e:
+            raise cherrypy.HTTPError(400, str(e))
+
+    def notModified(self, etag):
+        """
+        If the client already has the version `etag` (If-None-Match, weak 
+        comparison: "W/" tags set by proxies match too), set the status to 
+        304 and return True: no need to build the body.
+        """
+        if_none_match = cherrypy.request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            client_tags = [tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")]
+            if etag in client_tags or "*" in client_tags:
+                cherrypy.response.status = 304
+                return True
+        return False
+
+    def topicTable(self):
+        """
+        Return the topic table (`/topics`): {"epoch", "version", "fields", 
+        "topics": {topic: [device ID, sensor ID, measure type, unit]}}.
+        The ETag is the version (with the epoch): clients keep a copy and
+        revalidate it (If-None-Match), getting 304 until the table changes.
+        """
+        table, version = self.catalog.getTopicTable()
+        etag = f'"{self.catalog.epoch}-{version}"'
+        cherrypy.response.headers["ETag"] = etag
+        cherrypy.response.headers["Cache-Control"] = "no-cache"
+        cherrypy.response.headers["Vary"] = "Accept-Encoding"
+        if self.notModified(etag):
+            return b""
+
+        out = {"epoch": self.catalog.epoch, "version": version,
+               "fields": ["device_id", "sensor_id", "measure_type", "unit"], "topics": table}
+        use_gzip = acceptsGzip(cherrypy.request.headers.get("Accept-Encoding", ""))
+        body, encoding = self._cache.get("topics", version, lambda: out, use_gzip)
+        if encoding is not None:
+            cherrypy.response.headers["Content-Encoding"] = encoding
+        return body
+
     def cleanRecords(self):
         curr_time = time.time()
 
         rem_d = self.catalog.cleanDevices(curr_time, self.timeout)
+        self.metrics.inc("expired_records_total", rem_d)
+        self.metrics.observe("cleanup_duration_seconds", time.time() - curr_time)
 
-        if rem_d > 0:
+        # Renewals (heartbeats) are saved here, not as they arrive
+        if rem_d > 0 or self.catalog.countRenewals() > 0:
             self.catalog.saveAsJson()
+        if rem_d > 0:
             print(f"\n%%%%%%%%%%%%%%%%%%%%\nRemoved {rem_d} device(s)\n%%%%%%%%%%%%%%%%%%%%\n")
 
     def registerAtServiceCatalog(self, max_tries=10):
@@ -335,6 +1047,10 @@ class DeviceCatalogWebService():
         # If it fails with code 400 -> cannot update
             # Perform POST
 
+        if self._last_update_serv > 0 and renewLease(self._serv_cat_addr, {"device_catalog": True}) == 1:
+            self._last_update_serv = time.time()
+            return 1
+
         updated = False
         count_fail = 0
 
@@ -367,11 +1083,117 @@ class DeviceCatalogWebService():
         print("Maximum number of tries exceeded - service catalog was unreachable!")
         return 0
 
+    def getBrokerInfo(self):
+        """
+        Obtain the broker information from the services catalog, stored in
+        self._broker_info. Returns 1 if available, else 0.
+        """
+        if self._broker_info == {}:
+            try:
+                r = requests.get(self._serv_cat_addr + "/broker")
+                if r.ok:
+                    self._broker_info = r.json()
+                    print("Broker info retrieved!")
+                else:
+                    print(f"Error {r.status_code} - unable to get the broker information")
+            except:
+                print("Unable to reach services catalog to get the broker information")
+        return 1 if self._broker_info != {} else 0
+
+    def connectToBroker(self):
+        """
+        Connect to the MQTT broker for publishing the device events.
+        At connection, all devices are published again, and the retained 
+        events of devices which are not in the catalog any more are cleared
+        (see `notify`).
+        Returns 1 if connected, else 0 (to be tried again later).
+        """
+        if self._mqtt is not None:
+            return 1
+        if self.getBrokerInfo() == 0:
+            return 0
+        try:
+            client = MyMQTT(f"smartGreenhouse_dev_catalog_{self.getMyPort()}", self._broker_info["ip"], self._broker_info["port_n"], self)
+            client.start()
+        except Exception as e:
+            print(f"Unable to connect to the broker: {e}")
+            return 0
+
+        self._mqtt = client
+        self.catalog.replayEvents()
+        self._mqtt.mySubscribe(self._events_topic + "/+")
+        threading.Timer(self._events_sync_time, self._mqtt.unsubscribe, [self._events_topic + "/+"]).start()
+        self._mqtt.mySubscribe(self._hb_topic + "/+")
+        return 1
+
+    def publishEvent(self, event):
+        """
+        Publish a device event (listener of the catalog, called in order).
+        The state of a device is kept by the broker (retained message on 
+        `<events_topic>/<device ID>`), so that new subscribers receive all
+        devices; at expiration, the event is followed by an empty retained 
+        message, which removes it.
+        """
+        if self._mqtt is None:
+            # All devices are published at connection
+            return
+        topic = f"{self._events_topic}/{event['id']}"
+        if event["event"] == "expire":
+            self._mqtt.myPublish(topic, event)
+            self._mqtt.myPublish(topic, None, retain=True)
+        else:
+            self._mqtt.myPublish(topic, event, retain=True)
+        self.metrics.inc("device_events_total", event=event["event"])
+
+    def notify(self, topic, payload):
+        """
+        Callback for MyMQTT:
+        - heartbeats: the device ID (last element of the topic) is kept 
+          until the next bulk renewal (`heartbeatLoop`); the payload is ignored
+        - retained events found on the broker after the connection: the 
+          devices which are not in the catalog any more (e.g., expired while
+          this catalog was not running) are removed.
+        """
+        if topic.startswith(self._hb_topic + "/"):
+            dev_id = topic.split("/")[-1]
+            try:
+                dev_id = int(dev_id)
+            except ValueError:
+                pass
+            with self._hb_lock:
+                self._heartbeats.add(dev_id)
+            self.metrics.inc("heartbeats_received_total")
+            return
+
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            # Empty message (removed device)
+            return
+        if not isinstance(event, dict):
+            return
+        if event.get("event") != "expire" and self.catalog.searchDevice("id", event.get("id")) == {}:
+            print(f"Clearing stale event of device {event.get('id')}")
+            self._mqtt.myPublish(topic, None, retain=True)
+
+    def heartbeatLoop(self):
+        # Renew the devices which sent a heartbeat, in bulk, every `self._hb_period` seconds (own thread)
+        while True:
+            time.sleep(self._hb_period)
+            with self._hb_lock:
+                ids, self._heartbeats = self._heartbeats, set()
+            if len(ids) > 0:
+                renewed = self.catalog.renewDevices(ids)
+                self.metrics.inc("heartbeat_renewals_total", len(renewed), result="renewed")
+                self.metrics.inc("heartbeat_renewals_total", len(ids) - len(renewed), result="unknown")
+
     def startOperation(self, refresh_rate):
         # Begin looping to keep the service catalog updated and delete old device records
+        threading.Thread(target=self.heartbeatLoop, daemon=True).start()
         while True:
             time.sleep(refresh_rate)
             self.updateServiceCatalog()
+            self.connectToBroker()
             time.sleep(5)
             self.cleanRecords()
 
@@ -383,21 +1205,6 @@ class DeviceCatalogWebService():
     def getMyPort(self):
         return self.my_info["port"]
 
-    def checkUnusedID(self):
-        """
-        Used to verify the current 'next id' is not taken already
-        """
-        # self._next_devID
-
-        # Get list of currently used IDs:
-        ids = []
-
-        for dev in self.catalog.getDevices():
-            ids.append(dev['id'])
-        
-        while self._next_devID in ids:
-            self._next_devID += 1
-
 #
 #
 #
@@ -425,8 +1232,12 @@ if __name__ == "__main__":
     cherrypy.tree.mount(WebService, '/', conf)
     cherrypy.config.update({'server.socket_host': "0.0.0.0"})   # Make dev cat. open to anyone
     cherrypy.config.update({'server.socket_port': WebService.getMyPort()})
+    # Requests waiting for the admission control hold a thread
+    cherrypy.config.update({'server.thread_pool': 50})
     cherrypy.engine.start()
     try:
         WebService.startOperation(30)
     except KeyboardInterrupt:
+        if WebService._mqtt is not None:
+            WebService._mqtt.stop()
         cherrypy.engine.stop()
\ No newline at end of file
@@ -6,6 +6,8 @@ from datetime import datetime
 import time
 import warnings
 from sub.MyMQTT import MyMQTT
+from sub.retry import retryDelay
+from sub.http_cache import HTTPCache
 
 from device_agents.dht11_agent import DHT11Agent
 from device_agents.bmp180_agent import BMP180Agent
@@ -88,12 +90,22 @@ class DevConn:
 
         with open(self_path) as f:
             self.whoami = json.load(f)
+        self._http_cache = HTTPCache()
 
         self.dev_cat_info = {}
         self.dev_cat_timestamp = 0
         self.dev_cat_timeout = 120 #s
         self._registered_dev_cat = False
 
+        # Liveness: a heartbeat is published (MQTT) at every loop, while the 
+        # full description is only sent (PUT) every `_full_update_period` s.
+        # Heartbeats are not acknowledged (they may be lost if the device catalog
+        # is not connected to the broker), so the full update must still come 
+        # before the device timeout of the device catalog
+        self._hb_topic = "smartGreenhouse/catalog/heartbeat"
+        self._dev_timeout = 120 #s - same as in the device catalog
+        self._full_update_period = self._dev_timeout / 2
+
         # NOTE: it can be useful to statically assign device IDs - if the flag own_ID
         # is true, the device will use the ID specified in the conf file
         if not own_ID:
@@ -510,14 +522,20 @@ class DevConn:
         """
         tries = 0
         while tries <= max_tries and self.broker_info == {}:
+            tries += 1
             addr = self.sc_addr + "/broker"
-            r = requests.get(addr)
-            if r.ok:
-                self.broker_info = r.json()
-                print("Broker info retrieved!")
-                return 1
-            else:
-                print(f"Error {r.status_code} ☀︎")
+            try:
+                r = self._http_cache.get(addr)
+                if r.ok:
+                    self.broker_info = r.json()
+                    print("Broker info retrieved!")
+                    return 1
+                else:
+                    print(f"Error {r.status_code} ☀︎")
+                    time.sleep(retryDelay(r, 3))
+            except:
+                print("Tried to connect to services catalog - failed to establish a connection!")
+                time.sleep(retryDelay(None, 3))
         
         if self.broker_info != {}:
             return 1
@@ -525,7 +543,7 @@ class DevConn:
             return 0
 
 
-    def connectToServCat(self, max_tries=50):
+    def connectToServCat(self, max_tries=50, refresh=False):
         """
         Attempt to contact the services catalog to 
         retrieve information about the device catalog
@@ -533,6 +551,10 @@ class DevConn:
         Parameters:
         - max_tries: max n. of attempts (hint: use 
           high value at the beginning)
+        - refresh: if True, the current info is dropped 
+          and the services catalog is asked again, 
+          skipping the local HTTP cache (e.g., the 
+          device catalog may have moved)
         ----------------------------------------------
         Output:
         - 1 if info was correctly retrieved
@@ -540,9 +562,12 @@ class DevConn:
         """
         tries = 0
         addr = self.sc_addr + "/device_catalog"
+        if refresh:
+            self.dev_cat_info = {}
+            self._http_cache.invalidate(addr)
         while tries <= max_tries and self.dev_cat_info == {}:
             try:
-                r = requests.get(addr)
+                r = self._http_cache.get(addr)
                 if r.ok:
                     self.dev_cat_info = r.json()
                     self.dev_cat_timestamp = time.time()
@@ -551,11 +576,11 @@ class DevConn:
                 else:
                     print(f"Error {r.status_code} - it was not possible to retrieve the device catalog info")
                     tries += 1
-                    time.sleep(3)
+                    time.sleep(retryDelay(r, 3))
             except:
                 print("Tried to connect to services catalog - failed to establish a connection!")
                 tries += 1
-                time.sleep(3)
+                time.sleep(retryDelay(None, 3))
         
         if self.dev_cat_info != {}:
             # It may be that the device catalog is not registered, hence the returned 
@@ -606,7 +631,8 @@ class DevConn:
 
                 t = 0
                 while t <= max_tries and not self._id_assigned:
-                    
+                    t += 1
+                    r_id = None
                     try:
                         r_id = requests.get(id_addr)
 
@@ -620,7 +646,8 @@ class DevConn:
                     except:
                         print("Tried to request ID - failed to establish a connection")
                     
-                    time.sleep(3)
+                    if not self._id_assigned:
+                        time.sleep(retryDelay(r_id, 3))
             
             addr = addr_dev_cat + "/device"
             while tries <= max_tries and not self._registered_dev_cat:  
@@ -640,11 +667,11 @@ class DevConn:
                     else:
                         print(f"Error {r.status_code} - unable to update device information on device catalog")
                     tries += 1
-                    time.sleep(3)
+                    time.sleep(retryDelay(r, 3))
                 except:
                     print("Tried to register at device catalog - failed to establish a connection!")
                     tries += 1
-                    time.sleep(3)
+                    time.sleep(retryDelay(None, 3))
             
             if self._registered_dev_cat:
                 # Success
@@ -693,11 +720,11 @@ class DevConn:
                     else:
                         print(f"Error {r.status_code}")
                         tries += 1
-                        time.sleep(3)
+                        time.sleep(retryDelay(r, 3))
                 except:
                     print("Unable to reach device catalog to update information!")
                     tries += 1
-                    time.sleep(3)
+                    time.sleep(retryDelay(None, 3))
 
             if upd_succ:
                 # Success
@@ -710,6 +737,10 @@ class DevConn:
             return -1
 
 
+    def sendHeartbeat(self):
+        # Tell the device catalog that this device is alive (the catalog renews it at its next tick)
+        self.mqtt_cli.myPublish(f"{self._hb_topic}/{self.whoami['id']}", {"t": time.time()})
+
     def updateMeas(self):
         # Read all available services and update self.last_meas
 
@@ -825,27 +856,34 @@ class DevConn:
         ############### Working loop ###############
         meas_timeout = 60           # Time for measurement update
         t_last_meas = 0             # This triggers measurements in first loop
+        t_last_upd = 0              # Same for the full update at the device catalog
 
         cherrypy.engine.start()
 
         try:
             while True:
                 print("\nlooping . . .")
-                # Update info
-                upd_oper = self.updateDevCat(max_tries=10)
-                
-                if upd_oper == -1:
-                    # No dev cat info
-                    self.connectToServCat()
-                    upd_oper = self.updateDevCat()
-                
-                # No `elif` - upd_oper could have been updated
-                if upd_oper == 0:
-                    # Cannot reach device catalog
-                    warnings.warn("Could not reach device catalog!")
+                self.sendHeartbeat()
+
+                # Update info (if the device catalog does not know this 
+                # device anymore, it registers again)
+                if time.time() - t_last_upd > self._full_update_period:
+                    upd_oper = self.updateDevCat(max_tries=10)
                     
-                    # It may be that the device catalog was moved - get new address
-                    self.connectToServCat()
+                    if upd_oper == -1:
+                        # No dev cat info
+                        self.connectToServCat()
+                        upd_oper = self.updateDevCat()
+                    
+                    # No `elif` - upd_oper could have been updated
+                    if upd_oper == 0:
+                        # Cannot reach device catalog
+                        warnings.warn("Could not reach device catalog!")
+                        
+                        # It may be that the device catalog was moved - get new address
+                        self.connectToServCat(refresh=True)
+                    elif upd_oper == 1:
+                        t_last_upd = time.time()
 
                 # Make and publish measurements
                 curr_time = time.time()
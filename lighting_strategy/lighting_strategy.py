@@ -2,6 +2,9 @@ import json
 import requests
 import time
 from sub.MyMQTT import MyMQTT
+from sub.retry import retryDelay
+from sub.http_cache import HTTPCache
+from sub.lease import renewLease
 
 class lighting_strategy:
     
@@ -19,6 +22,7 @@ class lighting_strategy:
 
         # Creating service catalog address and saving the information to send to the service catalog
         self._serv_cat_address = "http://" + self._conf["services_catalog"]["ip"] + ":" + str(self._conf["services_catalog"]["port"])
+        self._http_cache = HTTPCache()
         self.whoami = self._conf["lighting_strategy"]
         
 
@@ -136,10 +140,10 @@ class lighting_strategy:
                     return 1
                 else:
                     print(f"Error {req.status_code}")
-                    time.sleep(5)
+                    time.sleep(retryDelay(req, 5))
             except:
                 print("Unable to reach service catalog - retrying")
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
         
         if self.greenhouses != []:
             return 1
@@ -170,15 +174,19 @@ class lighting_strategy:
                     return -1
                 else:
                     print(f"Status code: {reg.status_code}")
-                time.sleep(5)
+                time.sleep(retryDelay(reg, 5))
 
             except:
                 print("Tried to connect to services catalog - failed to establish a connection!")
                 tries += 1
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
 
 
     def updateServiceCatalog(self, max_tries = 10):
+        if self._last_update_serv > 0 and renewLease(self._serv_cat_address, {"services": [self.whoami["id"]]}) == 1:
+            self._last_update_serv = time.time()
+            return 1
+
         updated = False
         count_fail = 0
         tries = 0
@@ -203,7 +211,7 @@ class lighting_strategy:
             except:
                 print("Tried to connect to services catalog - failed to establish a connection! (2)")
                 count_fail += 1
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
 
         print("Maximum number of tries exceeded - service catalog was unreachable!")
         return 0
@@ -213,14 +221,20 @@ class lighting_strategy:
         tries = 0
 
         while tries <= max_tries and self._broker_info == {}:
+            tries += 1
             addr = self._serv_cat_address + "/broker"
-            r = requests.get(addr)
-            if r.ok:                                   
-                self._broker_info = r.json()
-                print("Broker info retrieved!")
-                return 1
-            else:
-                print(f"Error {r.status_code}")
+            try:
+                r = self._http_cache.get(addr)
+                if r.ok:
+                    self._broker_info = r.json()
+                    print("Broker info retrieved!")
+                    return 1
+                else:
+                    print(f"Error {r.status_code}")
+                    time.sleep(retryDelay(r, 5))
+            except:
+                print("Unable to reach services catalog - retrying")
+                time.sleep(retryDelay(None, 5))
         
         if self._broker_info != {}:
             return 1
@@ -233,18 +247,22 @@ class lighting_strategy:
         while self._dev_cat_info == {} and tries < max_tries:
             addr = self._serv_cat_address + "/device_catalog"
             try:
-                r = requests.get(addr)
-                if r.ok:
+                r = self._http_cache.get(addr)
+                if r.ok and r.json() != {}:
                     self._dev_cat_info = r.json()
                     self._dev_cat_info["last_update"] = time.time()
                     print("Device catalog info retrieved!")
                     return 1
+                elif r.ok:
+                    # Not registered at the services catalog (yet)
+                    print("No device catalog found at services catalog!")
+                    time.sleep(5)
                 else:
                     print(f"Error {r.status_code}")
-                    time.sleep(5)
+                    time.sleep(retryDelay(r, 5))
             except:
                 print("Unable to reach services catalog - retrying")
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
         
         if self._dev_cat_info != {}:
             return 1
@@ -259,6 +277,12 @@ class lighting_strategy:
             if (curr_time - self._dev_cat_info["last_update"]) > timeout:
                 self._dev_cat_info = {}
 
+    def dropDevCatInfo(self):
+        # Forget the device catalog info - the next request to the services
+        # catalog skips the local HTTP cache
+        self._dev_cat_info = {}
+        self._http_cache.invalidate(self._serv_cat_address + "/device_catalog")
+
     def cleanupGreenhouses(self, timeout=120):
         
         if self.greenhouses != {}:
@@ -281,7 +305,8 @@ class lighting_strategy:
             while tries < max_tries:
                 tries += 1
                 try:
-                    r = requests.get(dc_addr)
+                    # Only the device IDs and their MQTT topics are needed
+                    r = requests.get(dc_addr, params={"fields": "topics"})
                     if r.ok:
                         # The response is the list
                         self._devices["list"] = r.json()
@@ -290,14 +315,16 @@ class lighting_strategy:
                         return 1
                     else:
                         print(f"Error {r.status_code}")
-                        time.sleep(5)
+                        time.sleep(retryDelay(r, 5))
                 except:
                     print("Unable to reach device catalog!")
-                    time.sleep(5)
+                    time.sleep(retryDelay(None, 5))
             
             print("Unable to retrieve devices list")
         except:
             print("No device catalog found at services catalog!")
+        # The device catalog may have moved: get its address again
+        self.dropDevCatInfo()
         return 0
 
     def clearDevicesList(self, info_timeout=120):
@@ -320,18 +347,15 @@ class lighting_strategy:
         if self._devices["list"] != []:
             
             n_sub = 0
-            for dev in self._devices["list"]:                   
-                for sens in dev["resources"]["sensors"]:        
-                    if "MQTT" in sens["available_services"]:    
-                        for det in sens["services_details"]:   
-                            if det["service_type"] == "MQTT":   
-                                for top in det["topic"]:        
-                                    if top.split('/')[-1] == "light_intensity" and top not in self.topics_list:
-                                        # Sub to the topic
-                                        self.mqtt_cli.mySubscribe(top)
-                                        # Add topic to the list
-                                        self.topics_list.append(top)
-                                        n_sub += 1
+            for dev in self._devices["list"]:
+                # Topics by measure type, resolved by the device catalog
+                for top in dev["topics"].get("Light Intensity", []):
+                    if top not in self.topics_list:
+                        # Sub to the topic
+                        self.mqtt_cli.mySubscribe(top)
+                        # Add topic to the list
+                        self.topics_list.append(top)
+                        n_sub += 1
             
             return n_sub
     
@@ -344,17 +368,13 @@ class lighting_strategy:
 
         if self._devices["list"] != []:
             n_sub = 0
-            for dev in self._devices["list"]:                   
-                for sens in dev["resources"]["actuators"]:        
-                    if "MQTT" in sens["available_services"]:    
-                        for det in sens["services_details"]:   
-                            if det["service_type"] == "MQTT":   
-                                for top in det["topic"]:        
-                                    if top.split('/')[-1] == "act_light" and top not in self.topics_actuator_list:
-                                        # Add topic to the list
-                                        print(top)
-                                        self.topics_actuator_list.append(top)
-                                        n_sub += 1
+            for dev in self._devices["list"]:
+                for top in dev["topics"].get("act_light", []):
+                    if top not in self.topics_actuator_list:
+                        # Add topic to the list
+                        print(top)
+                        self.topics_actuator_list.append(top)
+                        n_sub += 1
             
             return n_sub
 
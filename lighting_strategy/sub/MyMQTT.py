@@ -32,6 +32,8 @@ class MyMQTT:
         - notify(topic, payload) - must be present in the subscriber class
     - clientID: client name
     - _topic: string of the considered topic
+    - _topics: set of all the topics the client is subscribed to (subscribed 
+      again at every (re)connection, as the session is not kept by the broker)
     - _isSubscriber: bool represeting what kind of client is this object ()
     - _paho_mqtt: PahoMQTT.Client() object
         - _paho_mqtt.on_connect: method used to respond to a connection
@@ -45,6 +47,7 @@ class MyMQTT:
       self.notifier = notifier
       self.clientID = clientID
       self._topic = ""
+      self._topics = set()
       self._isSubscriber = False
       # Create an instance of paho.mqtt.client (transient connection)
       self._paho_mqtt = PahoMQTT.Client(clientID, True)
@@ -63,6 +66,10 @@ class MyMQTT:
       --------------------------------------------------------------------------
       """
       print("Connected to %s with result code: %d" % (self.broker, rc))
+      if rc == 0:
+          # Clean session - the subscriptions are lost at reconnection
+          for topic in self._topics:
+              self._paho_mqtt.subscribe(topic, 2)
 
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
       """
@@ -77,7 +84,7 @@ class MyMQTT:
 
     ################################################################
 
-    def myPublish(self, topic, msg):
+    def myPublish(self, topic, msg, retain=False):
       """
       myPublish
       --------------------------------------------------------------------------
@@ -85,12 +92,16 @@ class MyMQTT:
       --------------------------------------------------------------------------
       Parameters:
       - topic: string containing the topic in which to publish
-      - msg: message to be published (string) - format is not important for MQTT
+      - msg: message to be published (string) - format is not important for MQTT;
+        None sends an empty message (which clears the retained one)
+      - retain: if True, the broker keeps the message and sends it to the 
+        clients subscribing to the topic later
       --------------------------------------------------------------------------
       NOTE: to be called by the user
       """
       # Publish the message with a certain topic (QoS: 2)
-      self._paho_mqtt.publish(topic, json.dumps(msg), 2)
+      payload = json.dumps(msg) if msg is not None else None
+      self._paho_mqtt.publish(topic, payload, 2, retain)
 
     def mySubscribe(self, topic):
       """
@@ -109,6 +120,7 @@ class MyMQTT:
       # Just to remember that it works also as a subscriber
       self._isSubscriber = True
       self._topic = topic
+      self._topics.add(topic)
       print("subscribed to %s" % (topic))
 
     def start(self):
@@ -124,17 +136,25 @@ class MyMQTT:
       self._paho_mqtt.connect(self.broker, self.port)
       self._paho_mqtt.loop_start()
 
-    def unsubscribe(self):
+    def unsubscribe(self, topic=None):
       """
       unsubscribe
       --------------------------------------------------------------------------
       Unsubscribes the client from the topic (attribute 'topic')
       and sets _isSubscriber to False
       --------------------------------------------------------------------------
+      Parameters:
+      - topic: if specified, only unsubscribes from this topic (the client
+        may be subscribed to more than one)
+      --------------------------------------------------------------------------
       """
-      if (self._isSubscriber):
+      if topic is not None and topic != self._topic:
+          self._paho_mqtt.unsubscribe(topic)
+          self._topics.discard(topic)
+      elif (self._isSubscriber):
           # remember to unsuscribe if it is working also as subscriber
           self._paho_mqtt.unsubscribe(self._topic)
+          self._topics.discard(self._topic)
           self._isSubscriber = False
 
     def stop(self):
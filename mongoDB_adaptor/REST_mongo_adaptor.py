@@ -3,6 +3,7 @@ import mongoDB_adaptor as mDB
 import json as js
 import requests
 import time
+from sub.lease import renewLease
 
 class adaptor_mongo_interface(object):
     exposed = True
@@ -33,6 +34,7 @@ class adaptor_mongo_interface(object):
     
     def __init__(self,conf_file,own_ID = False):
         self._registered_dev_cat = False
+        self._last_update_serv = 0
         self.own_ID = own_ID
         self.conf_dict = js.load(open(conf_file))
         # information of service catalog
@@ -191,6 +193,10 @@ class adaptor_mongo_interface(object):
         # If it fails with code 400 -> cannot update
             # Perform POST
 
+        if self._last_update_serv > 0 and renewLease(self.addr_ser_cat, {"services": [self.conf_dict["mongo_db"]["id"]]}) == 1:
+            self._last_update_serv = time.time()
+            return 1
+
         updated = False
         count_fail = 0
 
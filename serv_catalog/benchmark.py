@@ -0,0 +1,250 @@
+import time
+from datetime import datetime
+import json
+import os
+import sys
+import random
+import shutil
+import tempfile
+import platform
+import subprocess
+import contextlib
+import cherrypy
+import requests
+from services_catalog import ServicesCatalogWebService
+
+"""
+Benchmark of the services catalog web service
+------------------------------------------------------------------
+Generates synthetic catalogs of increasing size, serves each one on
+localhost and measures the main requests (GET, POST, PUT), the cleanup
+and the persistence.
+Results (throughput, p50/p99 latency) are written as JSON, so that runs
+on different versions can be compared.
+------------------------------------------------------------------
+Usage (from the serv_catalog folder):
+
+    $ python3 benchmark.py [sizes] [output] [port]
+
+- sizes: comma-separated number of users/greenhouses/services
+  (default 100,1000,10000,100000)
+- output: path of the results (default bench_results.json)
+- port: localhost port used for the web service (default 18090)
+"""
+
+# Number of requests for each scenario - full lists are expensive, so fewer
+N_REQUESTS = 200
+N_FULL_LIST = 20
+# Fraction of the services which is expired when the benchmark starts
+EXPIRED_FRACTION = 0.1
+
+
+def generateCatalog(base_path, size, out_path):
+    """
+    Write at `out_path` a catalog having the static info of `base_path`
+    and `size` users, greenhouses (one per user) and services.
+    EXPIRED_FRACTION of the services have an old timestamp, so that the
+    cleanup has something to remove.
+    """
+    cat = json.load(open(base_path))
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    old = "2000-01-01 00:00:00"
+    cat["users"] = []
+    cat["greenhouses"] = []
+    cat["services"] = []
+    for ind in range(1, size + 1):
+        cat["users"].append({
+            "id": ind, "user_name": f"name_{ind}", "user_surname": f"surname_{ind}",
+            "email_addr": f"user_{ind}@mail.com", "greenhouse": [ind], "last_update": now
+        })
+        cat["greenhouses"].append({
+            "id": ind, "user_id": ind, "device_id": ind, "plant_type": "basil",
+            "plant_needs": {"light": "high"}, "last_update": now
+        })
+        cat["services"].append({
+            "id": ind, "name": f"service_{ind}", "endpoints": [f"/sensor_{ind}"],
+            "endpoints_details": [{"endpoint": f"/sensor_{ind}", "type": "MQTT"}],
+            "last_update": old if ind <= size * EXPIRED_FRACTION else now
+        })
+    json.dump(cat, open(out_path, "w"))
+
+
+def percentile(values, perc):
+    # `values` needs to be sorted
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(round(perc / 100 * (len(values) - 1))))]
+
+
+def summary(name, size, latencies, duration):
+    # Build the result record of a scenario (latencies in seconds)
+    lat = sorted(latencies)
+    return {
+        "size": size,
+        "op": name,
+        "requests": len(lat),
+        "throughput": round(len(lat) / duration, 2) if duration > 0 else 0,
+        "p50_ms": round(percentile(lat, 50) * 1000, 3),
+        "p99_ms": round(percentile(lat, 99) * 1000, 3),
+        "max_ms": round(lat[-1] * 1000, 3) if len(lat) > 0 else 0
+    }
+
+
+def runScenario(name, size, requests_list):
+    """
+    Perform the requests (functions returning a `requests` response) one
+    after the other, measuring each of them.
+    Raises RuntimeError if a request fails unexpectedly.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for req in requests_list:
+        t0 = time.perf_counter()
+        resp = req()
+        latencies.append(time.perf_counter() - t0)
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{name}: unexpected response {resp.status_code} - {resp.text[:200]}")
+        resp.close()
+    return summary(name, size, latencies, time.perf_counter() - start)
+
+
+def benchmarkSize(size, port, work_dir):
+    """
+    Run all scenarios on a catalog of the given size; returns the list of
+    results.
+    """
+    cat_path = os.path.join(work_dir, f"catalog_{size}.json")
+    out_path = os.path.join(work_dir, f"catalog_{size}_updated.json")
+    generateCatalog("serv_catalog.json", size, cat_path)
+
+    results = []
+    # Startup: load + indexes
+    t0 = time.perf_counter()
+    ws = ServicesCatalogWebService(cat_path, "cmdList.json", out_path)
+    results.append({"size": size, "op": "startup", "time_ms": round((time.perf_counter() - t0) * 1000, 3)})
+
+    cherrypy.tree.mount(ws, '/', {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+    addr = f"http://127.0.0.1:{port}"
+    sess = requests.Session()
+    rnd = random.Random(size)
+
+    def rndID():
+        return rnd.randint(1, size)
+
+    # Warm up the connection and the server threads
+    for _ in range(10):
+        sess.get(addr + "/broker")
+
+    def firstByte(path):
+        # Only wait for the first bytes of the body (then the response is closed)
+        resp = sess.get(addr + path, stream=True)
+        next(resp.iter_content(1), None)
+        return resp
+
+    # Reads
+    results.append(runScenario("GET /users", size,
+        [lambda: sess.get(addr + "/users") for _ in range(N_FULL_LIST)]))
+    results.append(runScenario("GET /users (first byte)", size,
+        [lambda: firstByte("/users") for _ in range(N_FULL_LIST)]))
+    results.append(runScenario("GET /services", size,
+        [lambda: sess.get(addr + "/services") for _ in range(N_FULL_LIST)]))
+    results.append(runScenario("GET /user?id", size,
+        [lambda: sess.get(addr + f"/user?id={rndID()}") for _ in range(N_REQUESTS)]))
+    results.append(runScenario("GET /service?name", size,
+        [lambda: sess.get(addr + f"/service?name=service_{rnd.randint(int(size * EXPIRED_FRACTION) + 1, size)}") for _ in range(N_REQUESTS)]))
+    results.append(runScenario("GET /greenhouses?usr_id", size,
+        [lambda: sess.get(addr + f"/greenhouses?usr_id={rndID()}") for _ in range(N_REQUESTS)]))
+    results.append(runScenario("GET /greenhouses?plant_type&limit", size,
+        [lambda: sess.get(addr + "/greenhouses?plant_type=basil&limit=10") for _ in range(N_REQUESTS)]))
+
+    # Writes
+    new_ids = iter(range(size + 1, size + N_REQUESTS + 1))
+    def newUser():
+        usr_id = next(new_ids)
+        return {"id": usr_id, "user_name": "new", "user_surname": "user",
+                "email_addr": f"new_{usr_id}@mail.com", "greenhouse": []}
+    def updUser():
+        usr_id = rndID()
+        return {"id": usr_id, "user_name": f"name_{usr_id}", "user_surname": f"changed_{time.time()}",
+                "email_addr": f"user_{usr_id}@mail.com", "greenhouse": [usr_id]}
+    results.append(runScenario("POST /user", size,
+        [lambda: sess.post(addr + "/user", data=json.dumps(newUser())) for _ in range(N_REQUESTS)]))
+    results.append(runScenario("PUT /user", size,
+        [lambda: sess.put(addr + "/user", data=json.dumps(updUser())) for _ in range(N_REQUESTS)]))
+    results.append(runScenario("PUT /heartbeat", size,
+        [lambda: sess.put(addr + "/heartbeat", data=json.dumps({"services": [rndID() for _ in range(10)]})) for _ in range(N_REQUESTS)]))
+
+    # Cleanup (EXPIRED_FRACTION of the services are removed)
+    t0 = time.perf_counter()
+    n_rem, _ = ws.cleanRecords()
+    results.append({"size": size, "op": "cleanRecords", "removed": n_rem,
+                    "time_ms": round((time.perf_counter() - t0) * 1000, 3)})
+
+    # Persistence
+    t0 = time.perf_counter()
+    ws.catalog.saveAsJson()
+    results.append({"size": size, "op": "saveAsJson", "time_ms": round((time.perf_counter() - t0) * 1000, 3),
+                    "bytes": os.path.getsize(out_path)})
+    latencies = []
+    for _ in range(N_REQUESTS):
+        ws.catalog.updateUser(updUser())
+        t0 = time.perf_counter()
+        ws.catalog.saveChanges()
+        latencies.append(time.perf_counter() - t0)
+    results.append(summary("saveChanges (1 update)", size, latencies, sum(latencies)))
+
+    sess.close()
+    return results
+
+
+def gitVersion():
+    # Commit of the code under test, if available
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except:
+        return ""
+
+
+if __name__ == "__main__":
+    sizes = [100, 1000, 10000, 100000]
+    out_file = "bench_results.json"
+    port = 18090
+    if len(sys.argv) > 1:
+        sizes = [int(elem) for elem in sys.argv[1].split(",")]
+    if len(sys.argv) > 2:
+        out_file = sys.argv[2]
+    if len(sys.argv) > 3:
+        port = int(sys.argv[3])
+
+    cherrypy.config.update({'server.socket_host': "127.0.0.1", 'server.socket_port': port,
+                            'log.screen': False, 'server.thread_pool': 10})
+    cherrypy.engine.start()
+
+    report = {
+        "version": gitVersion(),
+        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "requests_per_scenario": N_REQUESTS,
+        "results": []
+    }
+    work_dir = tempfile.mkdtemp(prefix="serv_cat_bench_")
+    try:
+        for size in sizes:
+            print(f"Catalog size: {size}")
+            # The catalog prints every change - keep the output readable
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                results = benchmarkSize(size, port, work_dir)
+            for res in results:
+                if "p50_ms" in res:
+                    print(f"  {res['op']:<36} {res['throughput']:>10.1f} req/s  p50 {res['p50_ms']:>9.3f} ms  p99 {res['p99_ms']:>9.3f} ms")
+                else:
+                    print(f"  {res['op']:<36} {res['time_ms']:>10.3f} ms")
+            report["results"] += results
+    finally:
+        cherrypy.engine.exit()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    json.dump(report, open(out_file, "w"), indent=4)
+    print(f"Results written to {out_file}")
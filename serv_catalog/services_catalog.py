@@ -1,8 +1,22 @@
 import time
 from datetime import datetime
+from collections import OrderedDict, deque
+import threading
 import cherrypy
+from cherrypy.lib import httputil
+from cherrypy.process.servers import ServerAdapter
+import cheroot.wsgi
 import json
+import argparse
+import os
 import sys
+import subprocess
+import requests
+from sub.catalog_storage import openStorage
+from sub.response_cache import ResponseCache, acceptsGzip
+from sub.json_stream import streamList
+from sub.metrics import Metrics, timed
+from sub.admission import AdmissionControl, admitted
 
 """
 This program contains the services catalog for the application
@@ -16,15 +30,22 @@ Web service info:
 class ServicesCatalog():
     """ 
     ServicesCatalog class
+    ---
+    Concurrency: the records and the indexes are published as an immutable
+    view (`self._view`), which is replaced as a whole at every change.
+    Readers take the current view once and never lock; writers are
+    serialized by `self._lock` and never modify published records, lists or
+    indexes in place - they build new ones and then publish the new view.
+    Only lease renewals set "last_update" of the published record in place.
     """
 
-    def __init__(self, in_path, out_path="serv_cat_updated.json"):
+    def __init__(self, in_path, out_path="serv_cat_updated.json", journal_path=None, feed_size=5000, metrics=None, persist=True):
         # Allow to use fac-simile catalog for testing
         try:
-            self.cat = json.load(open(in_path))
+            cat = json.load(open(in_path))
         except:
             print("Default catalog taken")
-            self.cat = json.load(open("serv_catalog.json"))
+            cat = json.load(open("serv_catalog.json"))
         
         self._serv_cat_params = ['project_name', 'project_owner',
                         'services_catalog', 'broker', 'telegram', 
@@ -32,13 +53,19 @@ class ServicesCatalog():
                         "services"]
 
         # Check for valid catalog
-        if all(elem for elem in self.cat for elem in self._serv_cat_params):
+        if all(elem for elem in cat for elem in self._serv_cat_params):
             print("Valid catalog!")
         else:
             raise KeyError("Wrong catalog syntax!")
         
         self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cat["last_update"] = self.last_update
+        cat["last_update"] = self.last_update
+
+        # Storage engine configuration (optional) - not part of the catalog
+        storage_conf = cat.pop("storage", None)
+        # Cache-Control max-age (seconds) by resource class - optional, see
+        # `getCacheControl()`
+        self._cache_control = cat.pop("cache_control", {})
 
         # For checking at insertion:
         self._dev_cat_params = ["ip", "port", "methods"]
@@ -54,15 +81,532 @@ class ServicesCatalog():
         
         self.out_path = out_path
 
-    def saveAsJson(self):
-        # Used to save a local copy of the current dictionary - returns 1 if success, else 0
+        # Optional Metrics object: duration and size of the writes to disk
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.describe("save_duration_seconds", "histogram", "Duration of the writes to disk (snapshot or journal)")
+            metrics.describe("saved_bytes_total", "counter", "Bytes written to disk (snapshot or journal)")
+
+        # Writers (adders, updaters, renewals, cleaners, persistence) hold
+        # this lock; readers only use the published view
+        self._lock = threading.RLock()
+        self._view = {"cat": cat}
+
+        # Persistence: by default, snapshot (out_path) + append-only journal
+        # of the changes; the "storage" entry of the input catalog can select
+        # SQLite instead. If records were stored, they are recovered.
+        # Replicas (persist=False) get their content from the primary and 
+        # do not write anything
+        tables = {"users": ["email_addr"], "greenhouses": ["user_id", "device_id"], "services": ["name"]}
+        self._storage = None
+        if persist:
+            self._storage = openStorage(storage_conf, out_path, tables, ["device_catalog", "next_ids"], journal_path)
+        self._pending = []          # Changes not yet written to the journal
+        self._renewed = {}          # Lease renewals not yet written - {coll: {id: last_update}}
+        self._devcat_renewed = False
+        if persist:
+            self.recover()
+
+        # Hash indexes over the records (part of the view):
+        # - "users", "services": {id: record}
+        # - "greenhouses": {str(id): record} - greenhouse IDs may come as strings
+        # - "services_name": {name: record}
+        # - "greenhouses_by_user", "greenhouses_by_device": reverse indexes of 
+        #   the relationships, {str(user/device ID): tuple of greenhouse keys},
+        #   keys in the same order as the list
+        # Writers also keep the position of each record in the lists, so
+        # that replacing a record does not need a scan
+        self._positions = {}
+        # ... and the number of services having each name (to find another
+        # service with the same name when one is removed from "services_name")
+        self._name_count = {}
+        # Greenhouse field -> name of its reverse index
+        self._relations = {"user_id": "greenhouses_by_user", "device_id": "greenhouses_by_device"}
+
+        # Expiry scheduling: for each collection, the record keys (as used in
+        # the indexes) ordered by last refresh time (unix timestamp). All records
+        # of a collection share the same timeout, so the first one is always 
+        # the next to expire and cleanups only need to look at the head
+        self._expiry = {}
+        self._devcat_time = 0       # Last refresh of the device catalog info
+
+        # ID allocation: IDs are never reused, so the free IDs of a collection
+        # are the ones above both the high-water mark of the allocated IDs 
+        # (persisted as "next_ids") and the highest ID in use
+        self._max_id = {}
+        self.buildIndexes()
+
+        # Versioning: the catalog version is increased at every change of the 
+        # content (not at lease renewals, which only touch 'last_update'); each
+        # collection stores the catalog version of its last change, and when 
+        # it happened. The epoch makes the versions unique across restarts
+        self._epoch = int(time.time())
+        self.version = 0
+        self._feed = deque(maxlen=feed_size)     # Last changes: (version, coll, kind, record)
+        self._feed_base = 0         # The feed has all the changes after this version
+        self._changed = threading.Condition(self._lock)
+        # {coll: (version, unix time of last change)} - replaced, not modified
+        self._versions = {}
+        for coll in ["static", "device_catalog", "users", "greenhouses", "services"]:
+            self._versions[coll] = (0, time.time())
+
+    @property
+    def cat(self):
+        # Catalog dictionary of the current view - not to be modified
+        return self._view["cat"]
+
+    def buildIndexes(self):
+        """
+        (Re)build the lookup indexes from the records lists and publish them.
+        If duplicates are present, the last record wins (same as the 
+        linear searches used to do).
+        """
+        with self._lock:
+            cat = self._view["cat"]
+            view = {
+                "cat": cat,
+                "users": {usr["id"]: usr for usr in cat["users"]},
+                "greenhouses": {str(gh["id"]): gh for gh in cat["greenhouses"]},
+                "services": {serv["id"]: serv for serv in cat["services"]},
+                "services_name": {serv["name"]: serv for serv in cat["services"]}
+            }
+            for field, name in self._relations.items():
+                view[name] = self._reverseIndex(cat["greenhouses"], field)
+            for coll in ["users", "greenhouses", "services"]:
+                self._positions[coll] = {self._key(coll, rec["id"]): ind for ind, rec in enumerate(cat[coll])}
+            self._name_count = {}
+            for serv in view["services"].values():
+                self._name_count[serv["name"]] = self._name_count.get(serv["name"], 0) + 1
+
+            # Timestamps are parsed only here - from now on, refreshes store
+            # the numeric time directly
+            now = time.time()
+            for coll in ["users", "greenhouses", "services"]:
+                times = [(self._parseTime(rec["last_update"], now), key) for key, rec in view[coll].items()]
+                times.sort(key=lambda elem: elem[0])
+                self._expiry[coll] = OrderedDict((key, t) for t, key in times)
+            self._devcat_time = self._parseTime(cat["device_catalog"]["last_update"], 0)
+            for coll in ["users", "greenhouses", "services"]:
+                self._max_id[coll] = 0
+                for rec in cat[coll]:
+                    self._updateMaxID(coll, rec["id"])
+            self._view = view
+
+    def _key(self, coll, rec_id):
+        # Key of a record in the indexes of its collection
+        if coll == "greenhouses":
+            return str(rec_id)
+        return rec_id
+
+    def _reverseIndex(self, greenhouses, field):
+        # Build {str(gh[field]): tuple of greenhouse keys}, in list order
+        out = {}
+        for gh in greenhouses:
+            out[str(gh[field])] = out.get(str(gh[field]), ()) + (str(gh["id"]),)
+        return out
+
+    def _updateMaxID(self, coll, rec_id):
+        # Keep track of the highest (numeric) ID in use
         try:
-            json.dump(self.cat, open(self.out_path, "w"))
-            return 1
+            self._max_id[coll] = max(self._max_id[coll], int(rec_id))
+        except (ValueError, TypeError):
+            pass
+
+    def _putRecords(self, coll, recs):
+        """
+        Publish a new view where the records `recs` of collection `coll` are
+        added, or replace the ones with the same ID.
+        The list and the indexes are copied (only references), so readers
+        holding the previous view are not affected.
+        Must be called holding the lock.
+        """
+        view = dict(self._view)
+        cat = dict(view["cat"])
+        lst = list(cat[coll])
+        index = dict(view[coll])
+        pos = self._positions[coll]
+        if coll == "services":
+            names = dict(view["services_name"])
+        elif coll == "greenhouses":
+            # Reverse indexes are only copied if a relationship changes
+            reverse = {}
+        for rec in recs:
+            key = self._key(coll, rec["id"])
+            if key in pos:
+                lst[pos[key]] = rec
+            else:
+                pos[key] = len(lst)
+                lst.append(rec)
+            old = index.get(key)
+            index[key] = rec
+            self._updateMaxID(coll, rec["id"])
+            if coll == "services":
+                # Keep the name index consistent
+                if old is not None:
+                    self._unindexName(names, old, lst, index)
+                names[rec["name"]] = rec
+                self._name_count[rec["name"]] = self._name_count.get(rec["name"], 0) + 1
+            elif coll == "greenhouses":
+                # Move the greenhouse under its new user/device, if changed
+                for field, name in self._relations.items():
+                    if old is not None and str(old[field]) == str(rec[field]):
+                        continue
+                    if name not in reverse:
+                        reverse[name] = dict(view[name])
+                    if old is not None:
+                        others = tuple(elem for elem in reverse[name][str(old[field])] if elem != key)
+                        if len(others) > 0:
+                            reverse[name][str(old[field])] = others
+                        else:
+                            del reverse[name][str(old[field])]
+                    keys = reverse[name].get(str(rec[field]), ()) + (key,)
+                    if len(keys) > 1 and pos[keys[-2]] > pos[key]:
+                        keys = tuple(sorted(keys, key=pos.get))
+                    reverse[name][str(rec[field])] = keys
+        cat[coll] = lst
+        cat["last_update"] = self.last_update
+        view["cat"] = cat
+        view[coll] = index
+        if coll == "services":
+            view["services_name"] = names
+        elif coll == "greenhouses":
+            view.update(reverse)
+        self._view = view
+
+    def _dropRecords(self, coll, keys):
+        """
+        Publish a new view without the records of `coll` having the given
+        index keys. Only the part of the list after the first removed record
+        is filtered (and its positions updated), and the name/reverse indexes
+        only lose the removed entries.
+        Must be called holding the lock.
+        """
+        view = dict(self._view)
+        cat = dict(view["cat"])
+        index = dict(view[coll])
+        pos = self._positions[coll]
+        removed = {key: index.pop(key) for key in keys if key in index}
+        if len(removed) == 0:
+            return
+        first = min(pos[key] for key in removed)
+        lst = cat[coll]
+        lst = lst[:first] + [rec for rec in lst[first:] if index.get(self._key(coll, rec["id"])) is rec]
+        for key in removed:
+            del pos[key]
+        for ind in range(first, len(lst)):
+            pos[self._key(coll, lst[ind]["id"])] = ind
+        cat[coll] = lst
+        cat["last_update"] = self.last_update
+        view["cat"] = cat
+        view[coll] = index
+        if coll == "services":
+            names = dict(view["services_name"])
+            for rec in removed.values():
+                self._unindexName(names, rec, lst, index)
+            view["services_name"] = names
+        elif coll == "greenhouses":
+            for field, name in self._relations.items():
+                reverse = dict(view[name])
+                for key, rec in removed.items():
+                    others = tuple(elem for elem in reverse.get(str(rec[field]), ()) if elem != key)
+                    if len(others) > 0:
+                        reverse[str(rec[field])] = others
+                    else:
+                        reverse.pop(str(rec[field]), None)
+                view[name] = reverse
+        self._view = view
+
+    def _unindexName(self, names, serv, lst, index):
+        # Remove the service `serv` from the name index `names` (new copy): if
+        # other services have the same name, the last one in the list `lst` 
+        # (of the new view, indexed by `index`) takes its place
+        name = serv["name"]
+        self._name_count[name] -= 1
+        if self._name_count[name] == 0:
+            del self._name_count[name]
+        if names.get(name) is serv:
+            del names[name]
+            if name in self._name_count:
+                for other in reversed(lst):
+                    if other["name"] == name and index.get(other["id"]) is other:
+                        names[name] = other
+                        break
+
+    def _renewRecord(self, coll, key, rec):
+        """
+        Renew the lease of the published record `rec` (index key `key`): only
+        its "last_update" is changed, in place - a single assignment, so 
+        readers see either value - without publishing a new view, so that
+        renewals cost the same whatever the size of the catalog.
+        The renewal is written at the next `saveChanges()`.
+        Must be called holding the lock.
+        """
+        rec["last_update"] = self.last_update
+        self._touch(coll, key)
+        self._renewed.setdefault(coll, {})[str(rec["id"])] = self.last_update
+
+    def _setDevCat(self, info):
+        # Publish a new view with the device catalog info `info` - holding the lock
+        self._setKey("device_catalog", info)
+
+    def _setKey(self, key, value):
+        # Publish a new view where the top-level `key` is `value` - holding the lock
+        view = dict(self._view)
+        cat = dict(view["cat"])
+        cat[key] = value
+        cat["last_update"] = self.last_update
+        view["cat"] = cat
+        self._view = view
+
+    def _bump(self, coll, kind, rec, version=None):
+        """
+        Record a change in the content of collection `coll`: the version is 
+        increased (or set to `version`, for the changes copied from the 
+        primary), the change ('added', 'updated' or 'expired' record `rec`)
+        is placed in the feed and the watchers are woken up.
+        """
+        with self._changed:
+            self.version = self.version + 1 if version is None else version
+            versions = dict(self._versions)
+            versions[coll] = (self.version, time.time())
+            self._versions = versions
+            if len(self._feed) == self._feed.maxlen:
+                self._feed_base = self._feed[0][0]
+            self._feed.append((self.version, coll, kind, rec))
+            self._changed.notify_all()
+
+    def getChanges(self, since, epoch=None):
+        """
+        Return the changes occurred after version `since`, as:
+            {"version": <current>, "reset": false, "changes": {
+                <collection>: {"added": [...], "updated": [...], "expired": [<IDs>]},
+                "device_catalog": <current device catalog info>
+            }}
+        Only changed collections are present; for each record only the net
+        change is reported, with its current content.
+        If the feed does not go back to `since` (or `since` is from another 
+        run of the catalog, i.e., `epoch` - as returned with it - is not the 
+        current one), "reset" is true and the client needs to download the
+        full collections again.
+        """
+        with self._lock:
+            out = {"epoch": self._epoch, "version": self.version, "reset": False, "changes": {}}
+            if epoch is not None and epoch != self._epoch:
+                out["reset"] = True
+                return out
+            if since == self.version:
+                return out
+            if since > self.version or since < self._feed_base:
+                out["reset"] = True
+                return out
+
+            # Net change of each record: collect the last kind/content per key
+            net = {}
+            for version, coll, kind, rec in reversed(self._feed):
+                if version <= since:
+                    break
+                if coll == "device_catalog":
+                    out["changes"]["device_catalog"] = self.getDevCatalog()
+                    continue
+                key = str(rec["id"])
+                coll_net = net.setdefault(coll, {})
+                if key not in coll_net:
+                    coll_net[key] = (kind, rec)
+                elif kind == "added" and coll_net[key][0] == "updated":
+                    # Added and then updated within the window - still new to the client
+                    coll_net[key] = ("added", coll_net[key][1])
+        
+        for coll, coll_net in net.items():
+            out["changes"][coll] = {"added": [], "updated": [], "expired": []}
+            for kind, rec in coll_net.values():
+                if kind == "expired":
+                    out["changes"][coll]["expired"].append(rec["id"])
+                else:
+                    out["changes"][coll][kind].append(rec)
+        return out
+
+    def waitForChanges(self, since, timeout, epoch=None):
+        """
+        Block until the catalog version is different from `since` (or the 
+        timeout, in seconds, expires), then return the changes - see 
+        `getChanges()`. If `epoch` is not the current one, return at once.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != since or (epoch is not None and epoch != self._epoch), timeout)
+        return self.getChanges(since, epoch)
+
+    def waitForVersion(self, version, timeout):
+        # Block until the catalog reaches `version` (or the timeout, in seconds, expires)
+        with self._changed:
+            return self._changed.wait_for(lambda: self.version >= version, timeout)
+
+    # REPLICATION: a replica loads the snapshot of the primary, then 
+    # applies its changes (see `getChanges()`), keeping its versions
+
+    def getSnapshot(self):
+        """
+        Return the full content of the catalog with its versions:
+            {"epoch": ..., "version": ..., "versions": {coll: [version, time]}, "cat": {...}}
+        Changes after "version" are then available from `getChanges()`.
+        """
+        with self._lock:
+            return {"epoch": self._epoch, "version": self.version, "versions": self._versions, "cat": self.cat}
+
+    def loadSnapshot(self, snapshot):
+        # Replace the whole content with the snapshot of another catalog (see `getSnapshot()`)
+        with self._changed:
+            self._view = {"cat": snapshot["cat"]}
+            self.buildIndexes()
+            self._epoch = snapshot["epoch"]
+            self.version = snapshot["version"]
+            self._versions = {coll: tuple(elem) for coll, elem in snapshot["versions"].items()}
+            self._feed.clear()
+            self._feed_base = self.version
+            self._changed.notify_all()
+
+    def applyChanges(self, changes):
+        """
+        Apply the changes of another catalog, as returned by its
+        `getChanges()` (without reset); the catalog takes its version.
+        """
+        with self._lock:
+            version = changes["version"]
+            self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            for coll, coll_changes in changes["changes"].items():
+                if coll == "device_catalog":
+                    info = coll_changes
+                    if info == {}:
+                        # Expired
+                        info = self._default_dev_cat.copy()
+                        info["last_update"] = ""
+                    self._setDevCat(info)
+                    self._bump("device_catalog", "updated", info, version)
+                    continue
+                recs = coll_changes["added"] + coll_changes["updated"]
+                if len(recs) > 0:
+                    self._putRecords(coll, recs)
+                index = self._view[coll]
+                removed = [index[self._key(coll, rec_id)] for rec_id in coll_changes["expired"] if self._key(coll, rec_id) in index]
+                if len(removed) > 0:
+                    self._dropRecords(coll, [self._key(coll, rec["id"]) for rec in removed])
+                for kind in ["added", "updated"]:
+                    for rec in coll_changes[kind]:
+                        self._bump(coll, kind, rec, version)
+                for rec in removed:
+                    self._bump(coll, "expired", rec, version)
+            with self._changed:
+                self.version = version
+                self._changed.notify_all()
+
+    def _differs(self, rec, upd, params):
+        # True if the update changes any of the fields of the record
+        return any(rec[key] != upd[key] for key in params)
+
+    def _parseTime(self, last_update, default):
+        try:
+            return datetime.timestamp(datetime.strptime(last_update, "%Y-%m-%d %H:%M:%S"))
         except:
+            return default
+
+    def _touch(self, coll, key):
+        # Mark the record as just refreshed - it becomes the last to expire
+        expiry = self._expiry[coll]
+        expiry[key] = time.time()
+        expiry.move_to_end(key)
+
+    def _popExpired(self, coll, curr_time, timeout):
+        # Remove from the schedule and return the keys of the expired records
+        expiry = self._expiry[coll]
+        expired = []
+        while len(expiry) > 0:
+            key, t = next(iter(expiry.items()))
+            if curr_time - t <= timeout:
+                break
+            expiry.popitem(last=False)
+            expired.append(key)
+        return expired
+
+    def recover(self):
+        """
+        Restore the records (users, greenhouses, services, device catalog) 
+        from the last snapshot + journal, if present.
+        The static information (project, broker, telegram, ...) is always 
+        the one of the input catalog.
+        Only used at startup, before the view is shared with readers; the 
+        indexes need to be rebuilt afterwards (`buildIndexes()`).
+        """
+        cat = self._view["cat"]
+        stored = self._storage.load(cat)
+        if stored is None:
             return 0
+        for key in ["device_catalog", "users", "greenhouses", "services", "next_ids"]:
+            if key in stored:
+                cat[key] = stored[key]
+        print(f"Recovered {len(cat['users'])} users, {len(cat['greenhouses'])} greenhouses and {len(cat['services'])} services")
+        return 1
+
+    def saveAsJson(self):
+        # Used to save a local copy of the current dictionary - returns 1 if success, else 0
+        # The snapshot includes all changes, so the journal is emptied
+        with self._lock:
+            try:
+                self._pending = []
+                if self._storage is None:
+                    return 1
+                start = time.perf_counter()
+                n_bytes = self._storage.compact(self.cat)
+                self._recordSave("snapshot", time.perf_counter() - start, n_bytes)
+                return 1
+            except:
+                return 0
+
+    def saveChanges(self):
+        """
+        Append the pending changes to the journal - the cost only depends on 
+        the size of the changes. When the journal becomes too long, it is 
+        compacted into a new snapshot (`saveAsJson()`).
+        Returns 1 if success, else 0
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            # Renewals are written as a single entry per collection
+            renewed, self._renewed = self._renewed, {}
+            for coll, times in renewed.items():
+                pending.append({"op": "touch", "coll": coll, "times": times})
+            if self._devcat_renewed:
+                self._devcat_renewed = False
+                pending.append({"op": "set", "key": "device_catalog", "value": self.cat["device_catalog"]})
+            if self._storage is None:
+                return 1
+            try:
+                start = time.perf_counter()
+                n_bytes = self._storage.append(pending)
+                if n_bytes > 0:
+                    self._recordSave("journal", time.perf_counter() - start, n_bytes)
+            except:
+                return 0
+            if self._storage.needsCompaction():
+                return self.saveAsJson()
+            return 1
+
+    def _recordSave(self, kind, duration, n_bytes):
+        if self.metrics is not None:
+            self.metrics.observe("save_duration_seconds", duration, kind=kind)
+            self.metrics.inc("saved_bytes_total", n_bytes, kind=kind)
+
+    def _logPut(self, coll, rec):
+        self._pending.append({"op": "put", "coll": coll, "rec": rec})
+
+    def _logDel(self, coll, rec_id):
+        self._pending.append({"op": "del", "coll": coll, "id": rec_id})
+
+    def _logDevCat(self):
+        self._pending.append({"op": "set", "key": "device_catalog", "value": self.cat["device_catalog"]})
 
     # GETTERS: they all return a python dictionary
+    # The returned objects belong to the published view: they are never
+    # modified (except "last_update", at lease renewals), and they must not
+    # be modified by the callers either
     
     def gerProjectName(self):
         return self.cat["project_name"]
@@ -73,6 +617,10 @@ class ServicesCatalog():
     def getServCatInfo(self):
         return self.cat["services_catalog"]
 
+    def getCacheControl(self):
+        # Max-age (seconds) by resource class, as set in the input catalog ({} if not set)
+        return self._cache_control
+
     def getBroker(self):
         return self.cat["broker"]
 
@@ -81,8 +629,9 @@ class ServicesCatalog():
 
     def getDevCatalog(self):
         # Not hard-coded: need to check it is not empty!
-        if self.cat["device_catalog"]["last_update"] != "":
-            return self.cat["device_catalog"]
+        dev_cat = self.cat["device_catalog"]
+        if dev_cat["last_update"] != "":
+            return dev_cat
         else:
             return {}
 
@@ -97,9 +646,24 @@ class ServicesCatalog():
         return self.cat["services"]
     
     def getUserGreenhouses(self, userID):
-        for usrinfo in self.cat["users"]:
-            if usrinfo["id"] == int(userID):
-                return usrinfo["greenhouses"]
+        # Return the list of greenhouse IDs of the user, {} if not found
+        usrinfo = self._view["users"].get(int(userID))
+        if usrinfo is None:
+            return {}
+        return usrinfo["greenhouse"]
+
+    def getVersion(self, coll=None):
+        # Version of the whole catalog, or of the specified collection
+        if coll is None:
+            return self.version
+        return self._versions[coll][0]
+
+    def getETag(self, coll):
+        return f'"{self._epoch:x}-{self._versions[coll][0]}"'
+
+    def getLastModified(self, coll):
+        # Unix timestamp of the last change in the collection
+        return self._versions[coll][1]
 
     # COUNTERS
     def countUsers(self):
@@ -112,12 +676,17 @@ class ServicesCatalog():
         return len(self.cat["services"])
 
     # SEARCHES: search for specific record
+    # Searches by ID (and service name) use the indexes, the other
+    # parameters fall back to a linear scan
 
     def searchUser(self, parameter, value):
         if parameter not in self._usr_params:
             raise KeyError(f"Invalid key '{parameter}'")
+        view = self._view
+        if parameter == "id":
+            return self._copyOrEmpty(view["users"].get(value))
         elem = {}
-        for elem_cat in self.cat["users"]:
+        for elem_cat in view["cat"]["users"]:
             if elem_cat[parameter] == value:
                 # Supposing no duplicates
                 elem = elem_cat.copy()
@@ -127,24 +696,170 @@ class ServicesCatalog():
     def searchGreenhouse(self, parameter, value):
         if parameter not in self._greenhouse_params:
             raise KeyError(f"Invalid key '{parameter}'")
+        view = self._view
+        if parameter == "id":
+            return self._copyOrEmpty(view["greenhouses"].get(str(value)))
         elem = {}
-        for elem_cat in self.cat["greenhouses"]:
+        for elem_cat in view["cat"]["greenhouses"]:
             if str(elem_cat[parameter]) == str(value):
                 elem = elem_cat.copy()
 
         return elem
     
+    def searchGreenhouseByDevice(self, device_id):
+        # Return the greenhouse associated with the device, {} if not found
+        view = self._view
+        keys = view["greenhouses_by_device"].get(str(device_id), ())
+        if len(keys) == 0:
+            return {}
+        # Supposing one greenhouse per device - as the linear search, the last one wins
+        return view["greenhouses"][keys[-1]].copy()
+
+    def getGreenhouseContext(self, gh_id):
+        """
+        Return the greenhouse `gh_id` together with its owner, both read 
+        from the same view:
+            {"greenhouse": {...}, "user": {...} or None}
+        Returns {} if the greenhouse is not found.
+        The device is stored in the device catalog: its ID is the 
+        'device_id' of the greenhouse.
+        """
+        view = self._view
+        gh = view["greenhouses"].get(str(gh_id))
+        if gh is None:
+            return {}
+        usr = view["users"].get(self._numericOrStr(str(gh["user_id"])))
+        return {
+            "greenhouse": gh.copy(),
+            "user": usr.copy() if usr is not None else None
+        }
+
     def searchService(self, parameter, value):
         if parameter not in self._services_params:
             raise KeyError(f"Invalid key '{parameter}'")
+        view = self._view
+        if parameter == "id":
+            return self._copyOrEmpty(view["services"].get(value))
+        elif parameter == "name":
+            return self._copyOrEmpty(view["services_name"].get(value))
         elem = {}
-        for elem_cat in self.cat["services"]:
+        for elem_cat in view["cat"]["services"]:
             if elem_cat[parameter] == value:
                 elem = elem_cat.copy()
 
         return elem
 
+    def queryRecords(self, coll, filters=None, fields=None, limit=None, offset=0):
+        """
+        Query collection `coll` ("users", "greenhouses" or "services").
+        ---
+        - filters: dict {field: value}; a record matches if, for each field,
+          the value is equal (as string) to the given one - or, for list
+          fields (e.g., the greenhouses of a user), if it contains it
+        - fields: list of fields to be returned (None: all fields)
+        - limit, offset: pagination over the matching records
+        ---
+        Returns the total number of matching records and the list of the 
+        records in the requested page.
+        Raises KeyError if a filter/field is not valid for the collection.
+        """
+        if coll == "users":
+            valid = self._usr_params
+        elif coll == "greenhouses":
+            valid = self._greenhouse_params
+        elif coll == "services":
+            valid = self._services_params
+        else:
+            raise KeyError(f"Invalid collection '{coll}'")
+        valid = valid + ["last_update"]
+        if filters is None:
+            filters = {}
+        for key in list(filters) + (fields or []):
+            if key not in valid:
+                raise KeyError(f"Invalid key '{key}'")
+
+        filters = {key: str(value) for key, value in filters.items()}
+
+        # Use the indexes to restrict the candidates, if possible
+        view = self._view
+        if "id" in filters:
+            if coll == "users":
+                candidates = [view["users"].get(self._numericOrStr(filters["id"]))]
+            elif coll == "greenhouses":
+                candidates = [view["greenhouses"].get(filters["id"])]
+            else:
+                candidates = [view["services"].get(self._numericOrStr(filters["id"]))]
+        elif coll == "services" and "name" in filters:
+            candidates = [view["services_name"].get(filters["name"])]
+        elif coll == "greenhouses" and ("user_id" in filters or "device_id" in filters):
+            field = "user_id" if "user_id" in filters else "device_id"
+            keys = view[self._relations[field]].get(filters[field], ())
+            candidates = [view["greenhouses"][key] for key in keys]
+        else:
+            candidates = view["cat"][coll]
+
+        matching = [rec for rec in candidates if rec is not None and self._matches(rec, filters)]
+
+        total = len(matching)
+        if limit is not None:
+            matching = matching[offset:offset+limit]
+        elif offset > 0:
+            matching = matching[offset:]
+        
+        if fields is not None:
+            matching = [{key: rec[key] for key in fields} for rec in matching]
+        return total, matching
+
+    def _matches(self, rec, filters):
+        for key, value in filters.items():
+            if isinstance(rec[key], list):
+                if value not in [str(elem) for elem in rec[key]]:
+                    return False
+            elif str(rec[key]) != value:
+                return False
+        return True
+
+    def _numericOrStr(self, value):
+        # IDs in query strings are strings, while they are stored as int
+        try:
+            return int(value)
+        except ValueError:
+            return value
+
+    def _copyOrEmpty(self, elem):
+        # Searches return a copy of the record, or {} if not found
+        if elem is None:
+            return {}
+        return elem.copy()
+
+    # ID ALLOCATION
+
+    def allocateIDs(self, coll, count=1):
+        """
+        Reserve `count` consecutive new IDs for collection `coll` ("users", 
+        "greenhouses" or "services") and return the first one.
+        ---
+        The IDs are above the highest ID in use and above all IDs 
+        allocated before (also in previous runs - the high-water mark is 
+        journaled), so they are never handed out twice, even if they are
+        not used or the records expire.
+        """
+        if coll not in ["users", "greenhouses", "services"]:
+            raise KeyError(f"Invalid collection '{coll}'")
+        if count < 1:
+            raise ValueError("The number of IDs must be positive")
+
+        with self._lock:
+            next_ids = dict(self.cat.get("next_ids", {}))
+            first = max(next_ids.get(coll, 1), self._max_id[coll] + 1)
+            next_ids[coll] = first + count
+            self._setKey("next_ids", next_ids)
+            self._pending.append({"op": "set", "key": "next_ids", "value": next_ids})
+        return first
+
     # ADDERS: add new records
+    # Adders, updaters, renewals and cleaners hold the lock and publish a
+    # new view: records are never modified after being published
 
     def addDevCat(self, device_catalog):
         """ 
@@ -158,20 +873,21 @@ class ServicesCatalog():
         - The device catalog was already added
         """
         if all(elem in device_catalog for elem in self._dev_cat_params):
-            if self.cat["device_catalog"]["last_update"] == "":
-                # The object was not created yet
-                for key in self._default_dev_cat.keys():
-                    # Doing this prevents to insert keys that are not the allowed ones
-                    if key != "last_update":
-                        # Necessary - last_update is added after
-                        # If the device catalog was reset, the last_update key is present
-                        # but set to ""
-                        self.cat["device_catalog"][key] = device_catalog[key]
-                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.cat["device_catalog"]["last_update"] = self.last_update
-                self.cat["last_update"] = self.last_update
-                print("Device catalog was added")
-                return 1
+            with self._lock:
+                if self.cat["device_catalog"]["last_update"] == "":
+                    # The object was not created yet
+                    new_info = {}
+                    for key in self._default_dev_cat.keys():
+                        # Doing this prevents to insert keys that are not the allowed ones
+                        new_info[key] = device_catalog[key]
+                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    new_info["last_update"] = self.last_update
+                    self._devcat_time = time.time()
+                    self._setDevCat(new_info)
+                    self._logDevCat()
+                    self._bump("device_catalog", "added", new_info)
+                    print("Device catalog was added")
+                    return 1
         return 0
 
     def addUser(self, newUsr):
@@ -191,17 +907,22 @@ class ServicesCatalog():
         if all(elem in newUsr for elem in self._usr_params):
             # can proceed to adding the element
             new_id = newUsr["id"]
-            if self.searchUser("id", new_id) == {}:
-                # not found
-                new_dict = {}
-                for key in self._usr_params:
-                    new_dict[key] = newUsr[key]
-                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                new_dict["last_update"] = self.last_update
-                self.cat["users"].append(new_dict)
-                self.cat["last_update"] = self.last_update
-                print(f"User {new_dict['id']} was added")
-                return new_id
+            with self._lock:
+                if new_id not in self._view["users"]:
+                    # not found
+                    new_dict = {}
+                    for key in self._usr_params:
+                        new_dict[key] = newUsr[key]
+                    # The list of greenhouses is replaced (not appended) at updates
+                    new_dict["greenhouse"] = list(new_dict["greenhouse"])
+                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    new_dict["last_update"] = self.last_update
+                    self._putRecords("users", [new_dict])
+                    self._touch("users", new_id)
+                    self._logPut("users", new_dict)
+                    self._bump("users", "added", new_dict)
+                    print(f"User {new_dict['id']} was added")
+                    return new_id
 
         return 0    # Element is either invalid or already exists
 
@@ -215,34 +936,49 @@ class ServicesCatalog():
         If the returned value is 0, one of the following happened:
         - The inserted element does not contain the required fields
         - An element with the same ID already exists
+        - The ID is not a number
         
         If the returned value is -1:
-        - It was not possible to find the user
+        - It was not possible to find the user (the greenhouse is not added)
+        - The greenhouse was already assigned to the user
 
         This method also prevents to add elements having unnecessary keys
         """
         if all(elem in newGH for elem in self._greenhouse_params):
             # can proceed to adding the element
             new_id = newGH["id"]
-            if self.searchGreenhouse("id", new_id) == {}:
-                new_dict = {}
-                for key in self._greenhouse_params:
-                    new_dict[key] = newGH[key]
-                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                new_dict["last_update"] = self.last_update
-                self.cat["greenhouses"].append(new_dict)
-                self.cat["last_update"] = self.last_update
-                print(f"Greenhouse {new_dict['id']} was added")
-            user_id = newGH["user_id"]
-            ufound = False
-            for usr in self.cat["users"]:
-                if usr["id"] == user_id and int(new_id) not in usr["greenhouse"]:
-                    usr["greenhouse"].append(int(new_id))
-                    ufound = True
+            try:
+                # Validate before changing anything (the ID is stored as int in the user)
+                int(new_id)
+            except (ValueError, TypeError):
+                return 0
+            with self._lock:
+                if self._view["users"].get(newGH["user_id"]) is None:
+                    print("User not found!")
+                    return -1
+                if str(new_id) not in self._view["greenhouses"]:
+                    new_dict = {}
+                    for key in self._greenhouse_params:
+                        new_dict[key] = newGH[key]
+                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    new_dict["last_update"] = self.last_update
+                    self._putRecords("greenhouses", [new_dict])
+                    self._touch("greenhouses", str(new_id))
+                    self._logPut("greenhouses", new_dict)
+                    self._bump("greenhouses", "added", new_dict)
+                    print(f"Greenhouse {new_dict['id']} was added")
+                user_id = newGH["user_id"]
+                usr = self._view["users"].get(user_id)
+                if usr is not None and int(new_id) not in usr["greenhouse"]:
+                    new_usr = usr.copy()
+                    new_usr["greenhouse"] = usr["greenhouse"] + [int(new_id)]
+                    self._putRecords("users", [new_usr])
+                    self._logPut("users", new_usr)
+                    self._bump("users", "updated", new_usr)
                     return int(new_id)
-            if not ufound:
-                print("User not found!")
-                return -1
+                else:
+                    print("The greenhouse is already assigned to the user!")
+                    return -1
         
         return 0
 
@@ -262,48 +998,71 @@ class ServicesCatalog():
         if all(elem in newServ for elem in self._services_params):
             # can proceed to adding the element
             new_id = newServ["id"]
-            if self.searchService("id", new_id) == {}:
-                new_dict = {}
-                for key in self._services_params:
-                    new_dict[key] = newServ[key]
-                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                new_dict["last_update"] = self.last_update
-                self.cat["services"].append(new_dict)
-                self.cat["last_update"] = self.last_update
-                print(f"Service {new_dict['name']} was added")
-                return new_id
+            with self._lock:
+                if new_id not in self._view["services"]:
+                    new_dict = {}
+                    for key in self._services_params:
+                        new_dict[key] = newServ[key]
+                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    new_dict["last_update"] = self.last_update
+                    self._putRecords("services", [new_dict])
+                    self._touch("services", new_id)
+                    self._logPut("services", new_dict)
+                    self._bump("services", "added", new_dict)
+                    print(f"Service {new_dict['name']} was added")
+                    return new_id
         
         return 0
 
 
     # UPDATERS: update records
+    # The updated record is a new dictionary replacing the old one
     
     def updateDevCat(self, upd_info):
         if all(elem in upd_info for elem in self._dev_cat_params):
-            if self.cat["device_catalog"]["last_update"] != "":
-                # The object already existed
-                for key in self._default_dev_cat:
-                    # Doing this prevents to insert keys that are not the allowed ones
-                    if key != "last_update":
-                        self.cat["device_catalog"][key] = upd_info[key]
-                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.cat["device_catalog"]["last_update"] = self.last_update
-                self.cat["last_update"] = self.last_update
-                print("Device catalog was updated")
-                return 1
+            with self._lock:
+                dev_cat = self.cat["device_catalog"]
+                if dev_cat["last_update"] != "":
+                    # The object already existed
+                    changed = self._differs(dev_cat, upd_info, self._dev_cat_params)
+                    new_info = {}
+                    for key in self._default_dev_cat:
+                        # Doing this prevents to insert keys that are not the allowed ones
+                        new_info[key] = upd_info[key]
+                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    new_info["last_update"] = self.last_update
+                    self._devcat_time = time.time()
+                    self._setDevCat(new_info)
+                    self._logDevCat()
+                    if changed:
+                        self._bump("device_catalog", "updated", new_info)
+                    print("Device catalog was updated")
+                    return 1
         return 0
 
     def updateUser(self, updUsr):
         # Check fields
         if all(elem in updUsr for elem in self._usr_params):
-            # Find device
-            for ind in range(len(self.cat["users"])):
-                if self.cat["users"][ind]["id"] == updUsr["id"]:
+            with self._lock:
+                # Find user
+                usr = self._view["users"].get(updUsr["id"])
+                if usr is not None and not self._differs(usr, updUsr, self._usr_params):
+                    # Same content: only the lease is renewed
+                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    self._renewRecord("users", usr["id"], usr)
+                    print(f"User {updUsr['id']} was renewed")
+                    return updUsr["id"]
+                if usr is not None:
+                    new_usr = {}
                     for key in self._usr_params:
-                        self.cat["users"][ind][key] = updUsr[key]
+                        new_usr[key] = updUsr[key]
+                    new_usr["greenhouse"] = list(new_usr["greenhouse"])
                     self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.cat["users"][ind]["last_update"] = self.last_update
-                    self.cat["last_update"] = self.last_update
+                    new_usr["last_update"] = self.last_update
+                    self._putRecords("users", [new_usr])
+                    self._touch("users", new_usr["id"])
+                    self._logPut("users", new_usr)
+                    self._bump("users", "updated", new_usr)
                     print(f"User {updUsr['id']} was updated")
                     return updUsr["id"]
             
@@ -311,14 +1070,25 @@ class ServicesCatalog():
 
     def updateGreenhouse(self, upd_gh):
         if all(elem in upd_gh for elem in self._greenhouse_params):
-            # Find greenhouse
-            for ind in range(len(self.cat["greenhouses"])):
-                if self.cat["greenhouses"][ind]["id"] == upd_gh["id"]:
+            with self._lock:
+                # Find greenhouse
+                gh = self._view["greenhouses"].get(str(upd_gh["id"]))
+                if gh is not None and not self._differs(gh, upd_gh, self._greenhouse_params):
+                    # Same content: only the lease is renewed
+                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    self._renewRecord("greenhouses", str(gh["id"]), gh)
+                    print(f"Greenhouse {upd_gh['id']} was renewed")
+                    return upd_gh["id"]
+                if gh is not None:
+                    new_gh = {}
                     for key in self._greenhouse_params:
-                        self.cat["greenhouses"][ind][key] = upd_gh[key]
+                        new_gh[key] = upd_gh[key]
                     self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.cat["greenhouses"][ind]["last_update"] = self.last_update
-                    self.cat["last_update"] = self.last_update
+                    new_gh["last_update"] = self.last_update
+                    self._putRecords("greenhouses", [new_gh])
+                    self._touch("greenhouses", str(new_gh["id"]))
+                    self._logPut("greenhouses", new_gh)
+                    self._bump("greenhouses", "updated", new_gh)
                     print(f"Greenhouse {upd_gh['id']} was updated")
                     return upd_gh["id"]
             
@@ -326,19 +1096,144 @@ class ServicesCatalog():
 
     def updateService(self, upd_ser):
         if all(elem in upd_ser for elem in self._services_params):
-            # Find service
-            for ind in range(len(self.cat["services"])):
-                if self.cat["services"][ind]["id"] == upd_ser["id"]:
+            with self._lock:
+                # Find service
+                serv = self._view["services"].get(upd_ser["id"])
+                if serv is not None and not self._differs(serv, upd_ser, self._services_params):
+                    # Same content: only the lease is renewed
+                    self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    self._renewRecord("services", serv["id"], serv)
+                    print(f"Service {upd_ser['name']} was renewed")
+                    return upd_ser["id"]
+                if serv is not None:
+                    new_serv = {}
                     for key in self._services_params:
-                        self.cat["services"][ind][key] = upd_ser[key]
+                        new_serv[key] = upd_ser[key]
                     self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.cat["services"][ind]["last_update"] = self.last_update
-                    self.cat["last_update"] = self.last_update
+                    new_serv["last_update"] = self.last_update
+                    # Also re-indexes the name, if changed
+                    self._putRecords("services", [new_serv])
+                    self._touch("services", new_serv["id"])
+                    self._logPut("services", new_serv)
+                    self._bump("services", "updated", new_serv)
                     print(f"Service {upd_ser['name']} was updated")
                     return upd_ser["id"]
             
         return 0
 
+    # RENEWALS: only refresh the timestamp of existing records (leases)
+
+    def renewDevCat(self):
+        """
+        Refresh the last_update of the device catalog info.
+        Returns 1 if success, 0 if the device catalog is not registered.
+        """
+        with self._lock:
+            dev_cat = self.cat["device_catalog"]
+            if dev_cat["last_update"] == "":
+                return 0
+            self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            new_info = dev_cat.copy()
+            new_info["last_update"] = self.last_update
+            self._setDevCat(new_info)
+            self._devcat_time = time.time()
+            self._devcat_renewed = True
+            return 1
+
+    def renewLeases(self, coll, ids):
+        """
+        Refresh the last_update of the records in `coll` ("users", 
+        "greenhouses" or "services") having the given IDs, without 
+        rewriting (nor checking) the other fields.
+        Returns the list of renewed IDs - missing ones need to be registered
+        again.
+        The renewals are not journaled immediately, but at the next 
+        `saveChanges()`; records are renewed in place (`_renewRecord()`).
+        """
+        if coll not in ["users", "greenhouses", "services"]:
+            raise KeyError(f"Invalid collection '{coll}'")
+
+        with self._lock:
+            index = self._view[coll]
+            self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            renewed = []
+            for rec_id in ids:
+                key = self._key(coll, rec_id)
+                rec = index.get(key)
+                if rec is not None:
+                    self._renewRecord(coll, key, rec)
+                    renewed.append(rec_id)
+        
+        return renewed
+
+    # BATCHES: apply many operations at once
+
+    def applyBatch(self, ops):
+        """
+        Apply a list of operations holding the lock for the whole batch, so
+        that no other writer can interleave with it.
+        ---
+        Each operation is a dictionary:
+        - {"op": "add" | "update" | "upsert", "coll": <collection>, "rec": <record>}
+          ("upsert": update the record, or add it if it does not exist)
+        - {"op": "heartbeat", "coll": <collection>, "ids": [<IDs>]}
+        where the collection is "users", "greenhouses" or "services".
+        ---
+        Returns, for each operation, a dictionary with the outcome: "code"
+        (201 added, 200 updated/renewed, 400 invalid, 404 not found), "msg"
+        and "id" (or, for heartbeats, "renewed" and "unknown" IDs).
+        A failed operation does not stop (nor undo) the others.
+        Nothing is written to disk: the caller should then `saveChanges()`.
+        """
+        adders = {"users": self.addUser, "greenhouses": self.addGreenhouse, "services": self.addService}
+        updaters = {"users": self.updateUser, "greenhouses": self.updateGreenhouse, "services": self.updateService}
+        params = {"users": self._usr_params, "greenhouses": self._greenhouse_params, "services": self._services_params}
+        results = []
+        with self._lock:
+            for op in ops:
+                try:
+                    kind = op["op"]
+                    coll = op["coll"]
+                    if coll not in adders:
+                        raise KeyError("coll")
+                    
+                    if kind == "heartbeat":
+                        ids = op["ids"]
+                        if not isinstance(ids, list):
+                            ids = [ids]
+                        renewed = self.renewLeases(coll, ids)
+                        renewed_set = set(renewed)
+                        res = {"code": 200, "msg": f"Renewed {len(renewed)} lease(s)", "renewed": renewed, 
+                               "unknown": [rec_id for rec_id in ids if rec_id not in renewed_set]}
+                    elif kind in ["add", "update", "upsert"]:
+                        rec = op["rec"]
+                        res = {"code": 404, "msg": "Record not found", "id": rec.get("id")}
+                        if not all(elem in rec for elem in params[coll]):
+                            # Invalid for all kinds (an update would not find it)
+                            res["code"] = 400
+                            res["msg"] = "Invalid record - missing fields"
+                        elif kind in ["update", "upsert"] and updaters[coll](rec) != 0:
+                            res["code"] = 200
+                            res["msg"] = "Updated"
+                        elif kind in ["add", "upsert"]:
+                            rc = adders[coll](rec)
+                            # addGreenhouse returns -1 if the user was not found
+                            if (rc > 0 if coll == "greenhouses" else rc != 0):
+                                res["code"] = 201
+                                res["msg"] = "Added"
+                            else:
+                                res["code"] = 400
+                                res["msg"] = "Unable to add record"
+                    else:
+                        raise KeyError("op")
+                except KeyError as exc:
+                    res = {"code": 400, "msg": f"Invalid operation - missing/wrong key {exc}"}
+                except (TypeError, AttributeError, ValueError):
+                    res = {"code": 400, "msg": "Invalid operation"}
+                results.append(res)
+
+        return results
+
     # CLEANERS: perform timeout check on records
 
     def cleanDevCat(self, curr_time, timeout):
@@ -347,17 +1242,19 @@ class ServicesCatalog():
         - curr_time: unix timestamp
         - timeout: in seconds
         """
-        try:
-            oldtime = datetime.timestamp(datetime.strptime(self.cat["device_catalog"]["last_update"], "%Y-%m-%d %H:%M:%S"))
-        except:
-            # If unable to read timestamp it means it is empty
-            return 0
-        if curr_time - oldtime > timeout:
-            self.cat["device_catalog"] = self._default_dev_cat.copy()
-            self.cat["device_catalog"]["last_update"] = ""
-            self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            self.cat["last_update"] = self.last_update
-            return 1
+        with self._lock:
+            if self.cat["device_catalog"]["last_update"] == "":
+                # Empty
+                return 0
+            if curr_time - self._devcat_time > timeout:
+                new_info = self._default_dev_cat.copy()
+                new_info["last_update"] = ""
+                self._devcat_time = 0
+                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                self._setDevCat(new_info)
+                self._logDevCat()
+                self._bump("device_catalog", "expired", new_info)
+                return 1
         
         return 0
 
@@ -367,17 +1264,8 @@ class ServicesCatalog():
         - curr_time: unix timestamp
         - timeout: in seconds
         """
-        n_rem = 0
-        for ind in range(len(self.cat["users"])):
-            dev_time = datetime.timestamp(datetime.strptime(self.cat["users"][ind]["last_update"], "%Y-%m-%d %H:%M:%S"))
-            if curr_time - dev_time > timeout:
-                # Delete record
-                self.cat["users"].remove(self.cat["users"][ind])
-                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.cat["last_update"] = self.last_update
-                n_rem += 1
-        
-        return n_rem
+        with self._lock:
+            return self._removeRecords("users", self._popExpired("users", curr_time, timeout))
 
     def cleanGreenhouses(self, curr_time, timeout):
         """
@@ -387,24 +1275,28 @@ class ServicesCatalog():
 
         As a greenhouse is deleted, also clear its info in the corresponding user (try to)...
         """
-        n_rem = 0
-        for ind in range(len(self.cat["greenhouses"])):
-            gh_time = datetime.timestamp(datetime.strptime(self.cat["greenhouses"][ind]["last_update"], "%Y-%m-%d %H:%M:%S"))
-            if curr_time - gh_time > timeout:
-                # Delete record
-
+        with self._lock:
+            expired = self._popExpired("greenhouses", curr_time, timeout)
+            index = self._view["greenhouses"]
+            users = self._view["users"]
+            upd_users = {}
+            for gh_key in expired:
                 # Remove greenhouse from user info (no check on that since 
                 # the user could have been deleted)
-                for usr in self.cat["users"]:
-                    if usr["id"] == self.cat["greenhouses"][ind]["user_id"]:
-                        usr["greenhouse"].remove(self.cat["greenhouse"][ind]["id"])
-
-                self.cat["greenhouses"].remove(self.cat["greenhouses"][ind])
-                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.cat["last_update"] = self.last_update
-                n_rem += 1
+                gh = index[gh_key]
+                usr = upd_users.get(gh["user_id"], users.get(gh["user_id"]))
+                if usr is not None and int(gh["id"]) in usr["greenhouse"]:
+                    new_usr = usr.copy()
+                    new_usr["greenhouse"] = [elem for elem in usr["greenhouse"] if elem != int(gh["id"])]
+                    upd_users[gh["user_id"]] = new_usr
+
+            if len(upd_users) > 0:
+                self._putRecords("users", list(upd_users.values()))
+                for usr in upd_users.values():
+                    self._logPut("users", usr)
+                    self._bump("users", "updated", usr)
         
-        return n_rem
+            return self._removeRecords("greenhouses", expired)
 
     def cleanServices(self, curr_time, timeout):
         """
@@ -412,20 +1304,43 @@ class ServicesCatalog():
         - curr_time: unix timestamp
         - timeout: in seconds
         """
-        n_rem = 0
-        for ind in range(len(self.cat["services"])):
-            gh_time = datetime.timestamp(datetime.strptime(self.cat["services"][ind]["last_update"], "%Y-%m-%d %H:%M:%S"))
-            if curr_time - gh_time > timeout:
-                # Delete record
-                self.cat["services"].remove(self.cat["services"][ind])
-                self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.cat["last_update"] = self.last_update
-                n_rem += 1
+        with self._lock:
+            return self._removeRecords("services", self._popExpired("services", curr_time, timeout))
         
-        return n_rem
+    def _removeRecords(self, coll, keys):
+        # Drop the records with the given index keys, publishing a single new view
+        # Returns the number of removed records - must be called holding the lock
+        if len(keys) > 0:
+            index = self._view[coll]
+            removed = [index[key] for key in keys]
+            self.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self._dropRecords(coll, keys)
+            for rec in removed:
+                self._logDel(coll, rec["id"])
+                self._bump(coll, "expired", rec)
+        return len(keys)
 
     
 
+
+def writes(handler):
+    """
+    Decorator for the REST handlers changing the catalog (POST, PUT): on a
+    replica the request is forwarded to the primary, while the primary
+    returns its version after the change in the header X-Catalog-Version.
+    """
+    def wrapper(self, *uri, **params):
+        if self.primary is not None:
+            return self.forward(handler.__name__, uri, params)
+        out = handler(self, *uri, **params)
+        cherrypy.response.headers["X-Catalog-Version"] = str(self.catalog.getVersion())
+        return out
+
+    wrapper.__name__ = handler.__name__
+    wrapper.__doc__ = handler.__doc__
+    return wrapper
+
+
 class ServicesCatalogWebService():
     """
     ServicesCatalogWebService
@@ -434,28 +1349,95 @@ class ServicesCatalogWebService():
     """
     exposed = True
 
-    def __init__(self, catalog_path, cmd_list_cat, output_cat_path="serv_catalog_updated.json"):
+    def __init__(self, catalog_path, cmd_list_cat, output_cat_path="serv_catalog_updated.json", primary=None):
         self.API = json.load(open(cmd_list_cat))
-        self.catalog = ServicesCatalog(catalog_path, output_cat_path)
+
+        # Metrics exported at /metrics - requests are only counted by known endpoint
+        endpoints = [cmd.split("?")[0].strip("/") for elem in self.API["methods"] for cmd in elem["available_commands"]]
+        endpoints += ["new_user_id", "new_greenhouse_id", "new_serv_id"]
+        self.metrics = Metrics("serv_catalog", endpoints)
+        self.metrics.describe("records", "gauge", "Number of records by collection")
+        self.metrics.describe("expired_records_total", "counter", "Records removed at cleanup, by collection")
+        self.metrics.describe("cleanup_duration_seconds", "histogram", "Duration of the cleanup sweeps")
+        self.metrics.describe("allocated_ids_total", "counter", "IDs handed out, by collection")
+        self.metrics.describe("version", "gauge", "Version of the catalog content")
+        self.metrics.gaugeFunction("records", self.countRecords)
+        self.metrics.gaugeFunction("version", lambda: self.catalog.getVersion())
+
+        # Admission control: excess requests are rejected with 429 and a
+        # Retry-After hint (metrics are not limited, long polls have their
+        # own limit, as each one holds a thread for up to a minute)
+        self.admission = AdmissionControl(max_in_flight=8, max_queued=32, max_wait=1, exempt=["metrics"],
+                                          long_polling=["watch"], max_long=16)
+        self.metrics.describe("requests_in_flight", "gauge", "Requests being processed")
+        self.metrics.describe("requests_queued", "gauge", "Requests waiting to be processed")
+        self.metrics.describe("rejected_requests_total", "counter", "Requests rejected by the admission control (429)")
+        self.metrics.gaugeFunction("requests_in_flight", lambda: self.admission.in_flight)
+        self.metrics.gaugeFunction("requests_queued", lambda: self.admission.queued)
+        self.metrics.describe("watch_requests", "gauge", "Pending long polling requests (/watch)")
+        self.metrics.gaugeFunction("watch_requests", lambda: self.admission.long)
+        self.metrics.gaugeFunction("rejected_requests_total", lambda: self.admission.rejected)
+
+        # Replica mode: `primary` is the address of the primary catalog (e.g.,
+        # "http://10.0.0.1:8080"); the content is copied from it and kept 
+        # updated (see `followLoop()`), GETs are served locally and the 
+        # writes are forwarded
+        self.primary = primary.rstrip("/") if primary is not None else None
+        self._forward_timeout = 10          # seconds - requests forwarded to the primary
+        self._forward_wait = 2              # seconds - max wait for a forwarded change to be replicated
+        self._retry_time = 5                # seconds - wait after a failed request to the primary
+
+        self.catalog = ServicesCatalog(catalog_path, output_cat_path, metrics=self.metrics, persist=primary is None)
         self.msg_ok = {"status": "SUCCESS", "msg": ""}
         self.msg_ko = {"status": "FAILURE", "msg": ""}
         self._dev_cat_timeout = 240          # seconds - for device catalog and services list
         self._user_gh_timeout = 15*24*60*60          # seconds - for users and greenhouses (15 days)
+        self._watch_timeout = 30            # seconds - default wait of /watch requests
+        self._watch_max_timeout = 60
+        self._dev_cat_req_timeout = 2       # seconds - requests to the device catalog
 
-        self.my_info = self.catalog.getServCatInfo()
+        # Encoded responses of the full collections, by version; collections
+        # with more records than this are streamed instead
+        self._cache = ResponseCache()
+        self._stream_threshold = 5000
 
-        ###### Initialize IDs for each element 
-        # NOTE: the ID the services cat stores are the next ones that need to be assigned
+        self.my_info = self.catalog.getServCatInfo()
 
-        # USER ID
-        self._next_userID = 1
-        
-        # GREENHOUSE ID
-        self._next_ghID = 1
+        # Time (seconds) for which clients can use their copy of a resource
+        # without asking again (Cache-Control: max-age), by resource class;
+        # can be changed by the "cache_control" entry of the input catalog
+        self._max_age = {
+            "static": 3600,
+            "device_catalog": 60,
+            "users": 0,
+            "greenhouses": 0,
+            "services": 30
+        }
+        self._max_age.update(self.catalog.getCacheControl())
+
+        # Collection whose version identifies the content of each resource
+        # (used for ETag/Last-Modified/Cache-Control)
+        self._resource_coll = {
+            "project_info": "static",
+            "broker": "static",
+            "telegram": "static",
+            "device_catalog": "device_catalog",
+            "users": "users",
+            "user": "users",
+            "greenhouses": "greenhouses",
+            "greenhouse": "greenhouses",
+            "services": "services",
+            "service": "services"
+        }
 
-        # SERVICE ID
-        self._next_servID = 1
+        # IDs are allocated by the catalog (see `allocateIDs()`); at most 
+        # this number of IDs can be reserved by a single request
+        self._max_id_block = 1000
+        # Max number of operations in a POST /batch request
+        self._max_batch = 1000
 
+    @timed
+    @admitted
     def GET(self, *uri, **params):
 
         # Potential issue (2): when retrieving users, greenhouses or services, the returned
@@ -464,7 +1446,29 @@ class ServicesCatalogWebService():
         
         # Depending on uri path, show what is required
         if (len(uri) >= 1):
-            if (str(uri[0]) == "project_info"):
+            if str(uri[0]) in self._resource_coll and len(uri) == 1:
+                coll = self._resource_coll[str(uri[0])]
+                if str(uri[0]) == "greenhouses" and "usr_id" in params:
+                    # The list of greenhouses of a user is stored in the user record
+                    coll = "users"
+                max_age = None
+                if str(uri[0]) == "device_catalog" and self.catalog.getDevCatalog() == {}:
+                    # Not registered (yet) or expired: clients must not keep
+                    # the empty record, but ask again
+                    max_age = 0
+                if self.notModified(coll, max_age):
+                    return ""
+
+            if (str(uri[0]) == "metrics"):
+                cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+                return self.metrics.export()
+            elif (str(uri[0]) in ["new_user_id", "new_greenhouse_id", "new_serv_id"] and self.primary is not None):
+                # IDs are allocated by the primary only
+                return self.forward("GET", uri, params)
+            elif (str(uri[0]) == "snapshot"):
+                # Full content and version, to start a replica
+                return json.dumps(self.catalog.getSnapshot())
+            elif (str(uri[0]) == "project_info"):
                 # Return project info
                 p_name = json.dumps(self.catalog.gerProjectName())
                 p_owner = json.dumps(self.catalog.gerProjectOwner())
@@ -479,7 +1483,10 @@ class ServicesCatalogWebService():
             
             elif (str(uri[0]) == "users"):
                 # Return info of all users
-                return json.dumps(self.catalog.getUsers())
+                if len(params) == 0:
+                    return self.cachedResponse("users", self.catalog.getUsers)
+                else:
+                    return self.query("users", params)
             elif (str(uri[0]) == "user"):
                 # Return info of specified user
                 if "id" in params:
@@ -494,9 +1501,11 @@ class ServicesCatalogWebService():
             
             elif (str(uri[0]) == "greenhouses"):
                 if len(params) == 0:
-                    return json.dumps(self.catalog.getGreenhouses())
+                    return self.cachedResponse("greenhouses", self.catalog.getGreenhouses)
                 else:
-                    if len(params) == 1 and str(params.keys()[0]) == 'usr_id':
+                    if 'usr_id' not in params:
+                        return self.query("greenhouses", params)
+                    elif len(params) == 1:
                         usr_ID = int(params["usr_id"])
                         out_gh = self.catalog.getUserGreenhouses(usr_ID)
                         if out_gh == {}:
@@ -505,6 +1514,9 @@ class ServicesCatalogWebService():
                             return json.dumps(out_gh)
                     else:
                         raise cherrypy.HTTPError(400, "Missing/wrong parameters")
+            elif (str(uri[0]) == "greenhouse" and len(uri) == 3 and str(uri[2]) == "context"):
+                # Greenhouse, owner and device in a single response
+                return json.dumps(self.greenhouseContext(uri[1]))
             elif (str(uri[0]) == "greenhouse"):
                 if "id" in params:
                     gh_ID = int(params["id"])
@@ -517,7 +1529,10 @@ class ServicesCatalogWebService():
                     raise cherrypy.HTTPError(400, "Missing/wrong parameters")
 
             elif (str(uri[0]) == "services"):
-                return json.dumps(self.catalog.getServices())
+                if len(params) == 0:
+                    return self.cachedResponse("services", self.catalog.getServices)
+                else:
+                    return self.query("services", params)
             elif (str(uri[0]) == "service"):
                 s_found = {}
                 s_obj = None
@@ -540,33 +1555,34 @@ class ServicesCatalogWebService():
                 else:
                     raise cherrypy.HTTPError(400, "Missing/wrong parameters")
 
+            elif (str(uri[0]) == "watch"):
+                # Long polling: wait for changes after the specified version
+                try:
+                    since = int(params.get("since", self.catalog.getVersion()))
+                    epoch = int(params["epoch"]) if "epoch" in params else None
+                    timeout = min(float(params.get("timeout", self._watch_timeout)), self._watch_max_timeout)
+                except ValueError:
+                    raise cherrypy.HTTPError(400, "Missing/wrong parameters")
+                return json.dumps(self.catalog.waitForChanges(since, timeout, epoch))
+
             elif (str(uri[0]) == "new_user_id"):
                 # Return next ID:
-                self.checkUnusedUserID()
-                out = {}
-                out["id"] = self._next_userID
-                self._next_userID += 1
-                return json.dumps(out)
+                return self.newIDs("users", params)
             
             elif (str(uri[0]) == "new_greenhouse_id"):
                 # Return next greenhouse ID:
-                self.checkUnusedGreenhouseID()
-                out = {}
-                out["id"] = self._next_ghID
-                self._next_ghID += 1
-                return json.dumps(out)
+                return self.newIDs("greenhouses", params)
             
             elif (str(uri[0]) == "new_serv_id"):
                 # Return next ID:
-                self.checkUnusedServiceID()
-                out = {}
-                out["id"] = self._next_servID
-                self._next_servID += 1
-                return json.dumps(out)
+                return self.newIDs("services", params)
 
         else:       # Default case
             return "Available commands: " + json.dumps(self.API["methods"][0])
 
+    @timed
+    @admitted
+    @writes
     def POST(self, *uri, **params):
         """ 
         Used to add new records (users/devices)
@@ -578,7 +1594,7 @@ class ServicesCatalogWebService():
                 if self.catalog.addDevCat(body) != 0:
                     out = self.msg_ok.copy()
                     out["msg"] = "Device catalog was successfully added!"
-                    self.catalog.saveAsJson()
+                    self.catalog.saveChanges()
                     cherrypy.response.status = 201
                     return json.dumps(out)
                 else:
@@ -591,7 +1607,7 @@ class ServicesCatalogWebService():
                 if self.catalog.addUser(body) != 0:
                     out = self.msg_ok.copy()
                     out["msg"] = "User " + str(body["id"]) + " was added"
-                    self.catalog.saveAsJson()
+                    self.catalog.saveChanges()
                     cherrypy.response.status = 201
                     return json.dumps(out)
                 else:
@@ -604,7 +1620,7 @@ class ServicesCatalogWebService():
                 if self.catalog.addGreenhouse(body) > 0:
                     out = self.msg_ok.copy()
                     out["msg"] = "Greenhouse " + str(body["id"]) + " was added"
-                    self.catalog.saveAsJson()
+                    self.catalog.saveChanges()
                     cherrypy.response.status = 201
                     return json.dumps(out)
                 else:
@@ -613,11 +1629,14 @@ class ServicesCatalogWebService():
                     cherrypy.response.status = 400
                     return json.dumps(out)
             
+            elif (str(uri[0]) == "batch"):
+                return self.batch(body)
+
             elif (str(uri[0]) == "service"):
                 if self.catalog.addService(body) != 0:
                     out = self.msg_ok.copy()
                     out["msg"] = "Service " + str(body["id"]) + " was added"
-                    self.catalog.saveAsJson()
+                    self.catalog.saveChanges()
                     cherrypy.response.status = 201
                     return json.dumps(out)
                 else:
@@ -629,6 +1648,9 @@ class ServicesCatalogWebService():
         else:
             return "Available commands: " + json.dumps(self.API["methods"][1])
 
+    @timed
+    @admitted
+    @writes
     def PUT(self, *uri, **params):
         """
         Used to update existing records
@@ -642,7 +1664,7 @@ class ServicesCatalogWebService():
                 if rc != 0:
                     out = self.msg_ok.copy()
                     out["msg"] = "Device catalog was successfully updated!"
-                    self.catalog.saveAsJson()
+                    self.catalog.saveChanges()
                     cherrypy.response.status = 200
                     return json.dumps(out)
                 else:
@@ -655,7 +1677,7 @@ class ServicesCatalogWebService():
                 if self.catalog.updateUser(body) != 0:
                     out = self.msg_ok.copy()
                     out["msg"] = "User " + str(body["id"]) + " was updated"
-                    self.catalog.saveAsJson()
+                    self.catalog.saveChanges()
                     cherrypy.response.status = 200
                     return json.dumps(out)
                 else:
@@ -669,7 +1691,7 @@ class ServicesCatalogWebService():
                     if rc != 0:
                         out = self.msg_ok.copy()
                         out["msg"] = "Greenhouse " + str(body["id"]) + " was updated"
-                        self.catalog.saveAsJson()
+                        self.catalog.saveChanges()
                         cherrypy.response.status = 200
                         return json.dumps(out)
                     else:
@@ -684,7 +1706,7 @@ class ServicesCatalogWebService():
                         out = self.msg_ok.copy()
                         out["msg"] = "Service " + str(body["id"]) + " was updated"
 
-                        self.catalog.saveAsJson()
+                        self.catalog.saveChanges()
                         cherrypy.response.status = 200
                         return json.dumps(out)
                     else:
@@ -694,23 +1716,296 @@ class ServicesCatalogWebService():
                         cherrypy.response.status = 400
                         return json.dumps(out)
 
+            elif (str(uri[0]) == "heartbeat"):
+                return self.heartbeat(body)
+
         return "Available commands: " + json.dumps(self.API["methods"][2])
 
+    def batch(self, body):
+        """
+        Apply the list of operations in the body (see 
+        `ServicesCatalog.applyBatch()`) and write them to disk at once.
+        The response (200) contains the outcome of each operation in 
+        "results", in the same order.
+        """
+        if not isinstance(body, list):
+            out = self.msg_ko.copy()
+            out["msg"] = "The batch must be a list of operations"
+            cherrypy.response.status = 400
+            return json.dumps(out)
+        if len(body) > self._max_batch:
+            out = self.msg_ko.copy()
+            out["msg"] = f"Too many operations (max {self._max_batch})"
+            cherrypy.response.status = 413
+            return json.dumps(out)
+
+        results = self.catalog.applyBatch(body)
+        self.catalog.saveChanges()
+
+        n_ok = len([res for res in results if res["code"] < 300])
+        out = self.msg_ok.copy()
+        out["msg"] = f"Applied {n_ok} of {len(results)} operation(s)"
+        out["results"] = results
+        cherrypy.response.status = 200
+        return json.dumps(out)
+
+    def heartbeat(self, body):
+        """
+        Renew the leases of the records listed in the body, e.g.:
+            {"services": [1, 2], "greenhouses": [3], "device_catalog": true}
+        No field is re-validated and nothing is written to disk at this 
+        time (renewals are journaled at the next cleanup).
+        The response contains, for each collection, the renewed IDs, the 
+        unknown ones (to be registered again) and the lease TTL in seconds.
+        """
+        ttls = {
+            "users": self._user_gh_timeout,
+            "greenhouses": self._user_gh_timeout,
+            "services": self._dev_cat_timeout
+        }
+        out = self.msg_ok.copy()
+        out["renewed"] = {}
+        out["unknown"] = {}
+        out["ttl"] = {}
+        n_renewed = 0
+        try:
+            for coll in ttls:
+                if coll in body:
+                    ids = body[coll]
+                    if not isinstance(ids, list):
+                        ids = [ids]
+                    renewed = self.catalog.renewLeases(coll, ids)
+                    out["renewed"][coll] = renewed
+                    renewed_set = set(renewed)
+                    out["unknown"][coll] = [rec_id for rec_id in ids if rec_id not in renewed_set]
+                    out["ttl"][coll] = ttls[coll]
+                    n_renewed += len(renewed)
+            if body.get("device_catalog", False):
+                if self.catalog.renewDevCat() == 1:
+                    out["renewed"]["device_catalog"] = True
+                    out["ttl"]["device_catalog"] = self._dev_cat_timeout
+                    n_renewed += 1
+                else:
+                    out["unknown"]["device_catalog"] = True
+        except (AttributeError, TypeError):
+            out = self.msg_ko.copy()
+            out["msg"] = "Invalid heartbeat body"
+            cherrypy.response.status = 400
+            return json.dumps(out)
+
+        out["msg"] = f"Renewed {n_renewed} lease(s)"
+        cherrypy.response.status = 200
+        return json.dumps(out)
+
+    def query(self, coll, params):
+        """
+        Handle a GET on a collection with query parameters:
+        - fields=a,b,...: only return these fields of each record
+        - limit=..., offset=...: pagination
+        - any other parameter is an equality filter on the record fields
+        The total number of matching records is given in the header 
+        X-Total-Count.
+        """
+        filters = params.copy()
+        fields = None
+        limit = None
+        offset = 0
+        try:
+            if "fields" in filters:
+                fields = [f.strip() for f in str(filters.pop("fields")).split(",") if f.strip() != ""]
+            if "limit" in filters:
+                limit = int(filters.pop("limit"))
+            if "offset" in filters:
+                offset = int(filters.pop("offset"))
+            if (limit is not None and limit < 0) or offset < 0:
+                raise ValueError
+            total, records = self.catalog.queryRecords(coll, filters, fields, limit, offset)
+        except (KeyError, ValueError):
+            raise cherrypy.HTTPError(400, "Missing/wrong parameters")
+
+        cherrypy.response.headers["X-Total-Count"] = str(total)
+        return json.dumps(records)
+
+    def greenhouseContext(self, gh_id):
+        """
+        Return the greenhouse `gh_id` with its owner (user record) and its 
+        device (record of the device catalog):
+            {"greenhouse": {...}, "user": {...} or null, "device": {...} or null}
+        If the device catalog cannot be reached, the device is null and 
+        "device_error" explains why.
+        The admission slot is released before requesting the device, so
+        that a slow device catalog cannot use up the slots of this catalog.
+        """
+        context = self.catalog.getGreenhouseContext(gh_id)
+        if context == {}:
+            raise cherrypy.HTTPError(404, f"Greenhouse {gh_id} not found")
+
+        context["device"] = None
+        dev_cat = self.catalog.getDevCatalog()
+        if dev_cat == {}:
+            context["device_error"] = "Device catalog not registered"
+            return context
+        addr = "http://" + dev_cat["ip"] + ":" + str(dev_cat["port"]) + "/device?id=" + str(context["greenhouse"]["device_id"])
+        self.admission.leave()
+        try:
+            r = requests.get(addr, timeout=self._dev_cat_req_timeout)
+            if r.ok:
+                context["device"] = r.json()
+            elif r.status_code != 404:
+                context["device_error"] = f"Device catalog returned {r.status_code}"
+        except (requests.RequestException, ValueError):
+            context["device_error"] = "Unable to reach the device catalog"
+        return context
+
+    def notModified(self, coll, max_age=None):
+        """
+        Set the ETag, Last-Modified and X-Resource-Version headers of the 
+        response according to the version of collection `coll`, and the
+        Cache-Control header according to its max-age (or `max_age`, if
+        not None).
+        If the client already has the current version (If-None-Match), the 
+        status is set to 304 and True is returned: no need to build the body.
+        """
+        etag = self.catalog.getETag(coll)
+        cherrypy.response.headers["ETag"] = etag
+        cherrypy.response.headers["Last-Modified"] = httputil.HTTPDate(self.catalog.getLastModified(coll))
+        cherrypy.response.headers["X-Resource-Version"] = str(self.catalog.getVersion(coll))
+        if max_age is None:
+            max_age = self._max_age.get(coll, 0)
+        if max_age > 0:
+            cherrypy.response.headers["Cache-Control"] = f"max-age={max_age}"
+        else:
+            # Clients can keep a copy, but need to revalidate it (ETag)
+            cherrypy.response.headers["Cache-Control"] = "no-cache"
+
+        if_none_match = cherrypy.request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            client_tags = [tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")]
+            if etag in client_tags or "*" in client_tags:
+                cherrypy.response.status = 304
+                return True
+        return False
+
+    def forward(self, method, uri, params):
+        """
+        Forward the current request to the primary catalog and return its
+        response (status, body and the relevant headers).
+        If the primary reports its version after a change, wait (shortly)
+        for the replica to reach it, so that the client can read its own
+        writes from the replica.
+        """
+        addr = self.primary + "/" + "/".join(str(elem) for elem in uri)
+        body = cherrypy.request.body.read() if method != "GET" else None
+        try:
+            r = requests.request(method, addr, params=params, data=body, timeout=self._forward_timeout)
+        except requests.RequestException:
+            raise cherrypy.HTTPError(502, "Unable to reach the primary catalog")
+
+        for header in ["Content-Type", "Retry-After", "X-Catalog-Version", "X-Total-Count"]:
+            if header in r.headers:
+                cherrypy.response.headers[header] = r.headers[header]
+        if "X-Catalog-Version" in r.headers:
+            self.catalog.waitForVersion(int(r.headers["X-Catalog-Version"]), self._forward_wait)
+        cherrypy.response.status = r.status_code
+        return r.content
+
+    def followLoop(self):
+        """
+        Replica main loop: download the snapshot of the primary, then wait
+        for its changes (/watch, long polling) and apply them.
+        The snapshot is downloaded again if the changes are not available 
+        any more, or the primary was restarted (different epoch).
+        """
+        since = None
+        epoch = None
+        while True:
+            try:
+                if since is None:
+                    r = requests.get(self.primary + "/snapshot", timeout=self._forward_timeout)
+                    r.raise_for_status()
+                    snapshot = r.json()
+                    self.catalog.loadSnapshot(snapshot)
+                    since = snapshot["version"]
+                    epoch = snapshot["epoch"]
+                    print(f"Replica loaded version {since} from {self.primary}")
+
+                r = requests.get(self.primary + "/watch", params={"since": since, "epoch": epoch, "timeout": self._watch_timeout},
+                                 timeout=self._watch_timeout + self._forward_timeout)
+                if r.status_code == 429:
+                    # Too many watchers at the primary
+                    time.sleep(int(r.headers.get("Retry-After", self._retry_time)))
+                    continue
+                r.raise_for_status()
+                changes = r.json()
+                if changes["reset"] or changes["epoch"] != epoch:
+                    since = None
+                    continue
+                self.catalog.applyChanges(changes)
+                since = changes["version"]
+            except (requests.RequestException, ValueError, KeyError):
+                print(f"Unable to reach the primary catalog at {self.primary} - retrying in {self._retry_time} s")
+                time.sleep(self._retry_time)
+
+    def cachedResponse(self, coll, build):
+        """
+        Return the body of the full collection `coll`; `build` returns the 
+        list of records (of the current view, not copied).
+        The body comes from the response cache (encoded again only if the
+        collection changed); lists larger than `self._stream_threshold` are
+        streamed, 500 records per chunk, and cached as their list of chunks.
+        The gzip variant is returned if the client accepts it.
+        """
+        # The ETag includes the epoch, so that the versions are never reused
+        version = self.catalog.getETag(coll)
+        records = build()
+        use_gzip = acceptsGzip(cherrypy.request.headers.get("Accept-Encoding", ""))
+        cherrypy.response.headers["Vary"] = "Accept-Encoding"
+        if len(records) > self._stream_threshold:
+            cherrypy.response.stream = True
+            if use_gzip:
+                cherrypy.response.headers["Content-Encoding"] = "gzip"
+            return self._cache.stream(coll, version, lambda: streamList(records, use_gzip=use_gzip), use_gzip)
+
+        body, encoding = self._cache.get(coll, version, lambda: records, use_gzip)
+        if encoding is not None:
+            cherrypy.response.headers["Content-Encoding"] = encoding
+        return body
+
     ############ Private methods ###################
 
     def cleanRecords(self):
-        ## Check for old records (> 2 min)
+        """
+        Remove the expired records; only the records which actually 
+        expired are looked at.
+        Returns the number of evicted records and the duration of the
+        sweep (seconds).
+        """
         curr_time = time.time()
 
         rem_d = self.catalog.cleanDevCat(curr_time, self._dev_cat_timeout)
         rem_u = self.catalog.cleanUsers(curr_time, self._user_gh_timeout)
         rem_gh = self.catalog.cleanGreenhouses(curr_time, self._user_gh_timeout)
         rem_s = self.catalog.cleanServices(curr_time, self._dev_cat_timeout)
-        
-        if rem_d > 0 or rem_u > 0 or rem_gh > 0 or rem_s > 0:
-            self.catalog.saveAsJson()
+        n_rem = rem_d + rem_u + rem_gh + rem_s
+        sweep_time = time.time() - curr_time
 
-        print(f"\n%%%%%%%%%%%%%%%%%%%%\nRemoved {rem_d+rem_u+rem_gh+rem_s} element(s)\n%%%%%%%%%%%%%%%%%%%%\n")
+        for coll, n in [("device_catalog", rem_d), ("users", rem_u), ("greenhouses", rem_gh), ("services", rem_s)]:
+            self.metrics.inc("expired_records_total", n, collection=coll)
+        self.metrics.observe("cleanup_duration_seconds", sweep_time)
+        
+        # Always called, since it also writes the pending lease renewals
+        self.catalog.saveChanges()
+
+        print(f"\n%%%%%%%%%%%%%%%%%%%%\nRemoved {n_rem} element(s) in {sweep_time*1000:.2f} ms\n%%%%%%%%%%%%%%%%%%%%\n")
+        return n_rem, sweep_time
+
+    def countRecords(self):
+        # Size of the collections, for the metrics
+        return {
+            (("collection", "users"),): self.catalog.countUsers(),
+            (("collection", "greenhouses"),): self.catalog.countGreenhouses(),
+            (("collection", "services"),): self.catalog.countServices()
+        }
 
     def cleanupLoop(self, refresh_rate):
         while True:
@@ -723,56 +2018,66 @@ class ServicesCatalogWebService():
     def getMyPort(self):
         return self.my_info["port"]
 
-    def checkUnusedUserID(self):
-        """
-        Used to verify the current 'next user id' is not taken already
-        """
-        # self._next_devID
-
-        # Get list of currently used IDs:
-        ids = []
-
-        for dev in self.catalog.getUsers():
-            ids.append(dev['id'])
-        
-        while self._next_userID in ids:
-            self._next_userID += 1
-
-    def checkUnusedGreenhouseID(self):
+    def newIDs(self, coll, params):
         """
-        Used to verify the current 'next greenhouse id' is not taken already
+        Reserve new IDs for collection `coll`; the optional parameter 
+        'count' is the number of IDs (default 1, max 1000).
+        Returns {"id": <first ID>}; if 'count' was specified, "ids" also
+        contains the list of all the reserved IDs.
         """
-        # self._next_devID
-
-        # Get list of currently used IDs:
-        ids = []
-
-        for dev in self.catalog.getGreenhouses():
-            ids.append(dev['id'])
-        
-        while self._next_ghID in ids:
-            self._next_ghID += 1
-
-    def checkUnusedServiceID(self):
-        """
-        Used to verify the current 'next service id' is not taken already
-        """
-        # self._next_devID
-
-        # Get list of currently used IDs:
-        ids = []
-
-        for dev in self.catalog.getServices():
-            ids.append(dev['id'])
-        
-        while self._next_servID in ids:
-            self._next_servID += 1
+        try:
+            count = int(params.get("count", 1))
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid count")
+        if count < 1 or count > self._max_id_block:
+            raise cherrypy.HTTPError(400, f"The count must be between 1 and {self._max_id_block}")
+
+        first = self.catalog.allocateIDs(coll, count)
+        self.metrics.inc("allocated_ids_total", count, collection=coll)
+        # The new high-water mark is journaled before handing out the IDs
+        self.catalog.saveChanges()
+        out = {}
+        out["id"] = first
+        if "count" in params:
+            out["ids"] = list(range(first, first + count))
+        return json.dumps(out)
 #
 #
 #
 #
 #
 
+def addServer(host, port, reuse_port=False, thread_pool=64):
+    """
+    Serve the mounted applications (`cherrypy.tree`) on one more address,
+    with a cheroot HTTP server started and stopped by the CherryPy engine.
+    With `reuse_port`, the port is shared with other processes (SO_REUSEPORT,
+    Linux - the kernel spreads the connections among them): the server is 
+    then registered without its address, as CherryPy refuses to start on a
+    port which is already in use.
+    """
+    httpserver = cheroot.wsgi.Server((host, port), cherrypy.tree, numthreads=thread_pool, reuse_port=reuse_port)
+    server = ServerAdapter(cherrypy.engine, httpserver, None if reuse_port else (host, port))
+    server.subscribe()
+    return server
+
+
+def startWorkers(catalog_path, n, port, writer_addr):
+    """
+    Start `n` read workers: processes running as read replicas of the writer
+    (reachable at `writer_addr`) and listening on the same port, which the
+    kernel shares among them (SO_REUSEPORT).
+    Return the list of processes (subprocess.Popen).
+    """
+    workers = []
+    for i in range(n):
+        cmd = [sys.executable, os.path.abspath(__file__), catalog_path,
+               "--follow", writer_addr, "--port", str(port), "--reuse-port"]
+        workers.append(subprocess.Popen(cmd))
+    print(f"Started {n} read workers")
+    return workers
+
+
 if __name__ == "__main__":
     conf = {
         '/':{
@@ -784,17 +2089,61 @@ if __name__ == "__main__":
     # Ideally in the final application the initial catalog is passed to the 
     # application a a parameter, to allow users to use their own file and prevent
     # from storing cleartext paswords
-    if len(sys.argv) > 1:
-        WebService = ServicesCatalogWebService(sys.argv[1], "cmdList.json")
-    else:
-        WebService = ServicesCatalogWebService("serv_catalog.json", "cmdList.json")
+    parser = argparse.ArgumentParser(description="Services catalog")
+    parser.add_argument("catalog", nargs="?", default="serv_catalog.json", help="initial catalog (JSON)")
+    parser.add_argument("--follow", metavar="PRIMARY", default=None,
+                        help="run as read replica of the primary catalog at this address (e.g., http://10.0.0.1:8080)")
+    parser.add_argument("--port", type=int, default=None, help="port of the web service (default: the one in the catalog)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes sharing the port (Linux, SO_REUSEPORT): this process is the writer, "
+                             "and starts N-1 read workers, each a full read replica of the writer in its own "
+                             "process, following its changes (default: 1)")
+    parser.add_argument("--writer-port", type=int, default=None,
+                        help="port on 127.0.0.1 where the writer also listens, for the workers only: they forward "
+                             "the writes and follow the changes there (default: port + 1, must be free)")
+    # Set on the workers: share the port with the other processes
+    parser.add_argument("--reuse-port", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1 and args.follow is not None:
+        parser.error("--workers cannot be used together with --follow")
+
+    WebService = ServicesCatalogWebService(args.catalog, "cmdList.json", primary=args.follow)
+    port = args.port if args.port is not None else WebService.getMyPort()
 
     cherrypy.tree.mount(WebService, '/', conf)
     cherrypy.config.update({'server.socket_host': WebService.getMyIP()})
-    cherrypy.config.update({'server.socket_port': WebService.getMyPort()})
+    cherrypy.config.update({'server.socket_port': port})
+    # Queued and pending /watch requests hold a thread - make room for them
+    thread_pool = WebService.admission.threadsNeeded()
+    cherrypy.config.update({'server.thread_pool': thread_pool})
+
+    if args.workers > 1 or args.reuse_port:
+        # Replace the default server with one sharing the port
+        cherrypy.server.unsubscribe()
+        addServer(WebService.getMyIP(), port, reuse_port=True, thread_pool=thread_pool)
+
+    writer_port = None
+    if args.workers > 1:
+        # Private address of the writer: the workers forward the updates and
+        # follow the changes here, and not on the shared port (where the
+        # request could reach another worker)
+        writer_port = args.writer_port if args.writer_port is not None else port + 1
+        addServer("127.0.0.1", writer_port, thread_pool=thread_pool)
+
     cherrypy.engine.start()
+    workers = []
+    if writer_port is not None:
+        workers = startWorkers(args.catalog, args.workers - 1, port, f"http://127.0.0.1:{writer_port}")
     try:
-        WebService.cleanupLoop(30)
+        if WebService.primary is not None:
+            # Records only expire on the primary
+            WebService.followLoop()
+        else:
+            WebService.cleanupLoop(30)
     except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        # Fold the journal into the snapshot before leaving
+        WebService.catalog.saveChanges()
+        WebService.catalog.saveAsJson()
         cherrypy.engine.stop()
-
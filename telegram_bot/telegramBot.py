@@ -3,6 +3,9 @@ from telepot.loop import MessageLoop
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 import json
 import requests
+from sub.http_cache import HTTPCache
+from sub.retry import retryDelay
+from sub.lease import renewLease
 import time
 import cherrypy
 from datetime import datetime
@@ -18,10 +21,11 @@ class RESTBot:
     def __init__(self, conf_dict):
         self.serv_cat_addr = str(conf_dict["services_catalog"]["ip"])+":"+ str(conf_dict["services_catalog"]["port"])
         self.myIP = str(conf_dict["telegram"]["endpoints_details"][0]["ip"]) +":"+ str(conf_dict["telegram"]["endpoints_details"][0]["port"])
-        self.tokenBot=requests.get("http://" + self.serv_cat_addr + "/telegram").json()["telegram_token"]
+        self._http_cache = HTTPCache()
+        self.tokenBot=self._http_cache.get("http://" + self.serv_cat_addr + "/telegram").json()["telegram_token"]
         self.bot = telepot.Bot(self.tokenBot)
         self.currentGH = None
-        self.databaseIP = requests.get("http://" + self.serv_cat_addr + "/service?name=mongoDB").json()["endpoints_details"]["address"]
+        self.databaseIP = self._http_cache.get("http://" + self.serv_cat_addr + "/service?name=mongoDB").json()["endpoints_details"]["address"]
         self.myDict = conf_dict["telegram"]
         
         self._registered_at_catalog = False
@@ -480,6 +484,10 @@ with the following format:\n/getGraph\n<type_of_graph>\nThe type of graph can be
         - 0: fail
         - -1: had to register
         """
+        if self._last_update_serv > 0 and renewLease('http://' + self.serv_cat_addr, {"services": [self.myDict["id"]]}) == 1:
+            self._last_update_serv = time.time()
+            return 1
+
         updated = False
         tries = 0
         addr = 'http://' + self.serv_cat_addr + '/service'
@@ -510,63 +518,46 @@ with the following format:\n/getGraph\n<type_of_graph>\nThe type of graph can be
         return 0
     
     def updateUsers(self, max_tries=10):
-        addr = "http://" + self.serv_cat_addr + "/user"
-        for current in self._users_local:    
-            tries = 0
-            curr_reg = False
-            while tries < max_tries and not curr_reg:
-                tries += 1
-                try:
-                    resp = requests.put(addr, data=json.dumps(current))
-                    if resp.ok:
-                        # User was registered correctly
-                        print(f"Updated user {current['id']}")
-                        curr_reg = True
-                    else:
-                        tries_2 = 0
-                        curr_re_reg = False
-                        while tries_2 < max_tries and not curr_re_reg:
-                            tries_2 += 1
-                            try:
-                                r_up = requests.post(addr, data=json.dumps(current))
-                                if r_up:
-                                    curr_re_reg = True
-                                    curr_reg = True
-                                else:
-                                    time.sleep(3)
-                            except:
-                                time.sleep(3)
-                except:
-                    time.sleep(3)
+        # All users are sent in a single batch: each one is updated, or 
+        # added if the catalog does not have it (anymore)
+        ops = [{"op": "upsert", "coll": "users", "rec": current} for current in self._users_local]
+        self.sendBatch(ops, "user", max_tries)
 
     def updateGreenhouses(self, max_tries=10):
-        addr = "http://" + self.serv_cat_addr + "/greenhouse"
-        for current in self._gh_local:    
+        ops = [{"op": "upsert", "coll": "greenhouses", "rec": current} for current in self._gh_local]
+        self.sendBatch(ops, "greenhouse", max_tries)
+
+    def sendBatch(self, ops, rec_type, max_tries=10, batch_size=500):
+        """
+        Send the operations to the services catalog with `POST /batch`, 
+        `batch_size` operations per request; each request is tried again 
+        only if the catalog cannot be reached or rejects it (after 3 seconds,
+        or the Retry-After of a 429).
+        Returns the number of successful operations.
+        """
+        addr = "http://" + self.serv_cat_addr + "/batch"
+        n_ok = 0
+        for ind in range(0, len(ops), batch_size):
+            chunk = ops[ind:ind+batch_size]
             tries = 0
-            curr_reg = False
-            while tries < max_tries and not curr_reg:
+            sent = False
+            while tries < max_tries and not sent:
                 tries += 1
                 try:
-                    resp = requests.put(addr, data=json.dumps(current))
+                    resp = requests.post(addr, data=json.dumps(chunk))
                     if resp.ok:
-                        print(f"Updated greenhouse {current['id']}")
-                        curr_reg = True
+                        sent = True
+                        for op, res in zip(chunk, resp.json()["results"]):
+                            if res["code"] < 300:
+                                print(f"Updated {rec_type} {op['rec']['id']}")
+                                n_ok += 1
+                            else:
+                                print(f"Unable to update {rec_type} {op['rec']['id']}: {res['msg']}")
                     else:
-                        tries_2 = 0
-                        curr_re_reg = False
-                        while tries_2 < max_tries and not curr_re_reg:
-                            tries_2 += 1
-                            try:
-                                r_up = requests.post(addr, data=json.dumps(current))
-                                if r_up:
-                                    curr_re_reg = True
-                                    curr_reg = True
-                                else:
-                                    time.sleep(3)
-                            except:
-                                time.sleep(3)
+                        time.sleep(retryDelay(resp, 3))
                 except:
-                    time.sleep(3)
+                    time.sleep(retryDelay(None, 3))
+        return n_ok
             
     def updatePipeline(self):
         self.updateServCatalog()
@@ -1,6 +1,9 @@
 import json
 import paho.mqtt.client as PahoMQTT
 from sub.MyMQTT import MyMQTT
+from sub.retry import retryDelay
+from sub.http_cache import HTTPCache
+from sub.lease import renewLease
 import requests
 import time
 import warnings
@@ -30,6 +33,7 @@ class WaterDeliveryStrategy():
                 self._conf = json.load(f)
 
         self._serv_cat_addr = "http://" + self._conf["services_catalog"]["ip"] + ":" + str(self._conf["services_catalog"]["port"])    # Address of services catalog
+        self._http_cache = HTTPCache()
         self.whoami = self._conf["water_delivery"]         # Own information - to be sent to the services catalog
 
         self._out_conf_path = out_conf
@@ -282,10 +286,10 @@ class WaterDeliveryStrategy():
                 else:
                     # Should not happen
                     print("Error - unable to get ID from server!")
-                    time.sleep(3)
+                    time.sleep(retryDelay(r_id, 3))
             except:
                 print("Unable to reach service catalog to retrieve ID")
-                time.sleep(3)
+                time.sleep(retryDelay(None, 3))
 
         if self.id is not None:
             print("ID already assigned")
@@ -329,10 +333,10 @@ class WaterDeliveryStrategy():
                     return -1
                 else:
                     print(f"Status code: {reg.status_code}")
-                time.sleep(5)
+                time.sleep(retryDelay(reg, 5))
             except:
                 print("Tried to connect to services catalog - failed to establish a connection!")
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
 
     def updateServiceCatalog(self, max_tries=10):
         """
@@ -351,6 +355,10 @@ class WaterDeliveryStrategy():
         if self.id is None:
             self.getServiceID()
 
+        if self._last_update_serv > 0 and renewLease(self._serv_cat_addr, {"services": [self.whoami["id"]]}) == 1:
+            self._last_update_serv = time.time()
+            return 1
+
         updated = False
         count_fail = 0
 
@@ -375,7 +383,7 @@ class WaterDeliveryStrategy():
             except:
                 print("Tried to connect to services catalog - failed to establish a connection!")
                 count_fail += 1
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
         
         # If here, then it was not possible to update nor register information
         # within the maximum number of iterations, which means it was not possible 
@@ -403,13 +411,18 @@ class WaterDeliveryStrategy():
         while tries <= max_tries and self._broker_info == {}:
             tries += 1
             addr = self._serv_cat_addr + "/broker"
-            r = requests.get(addr)
-            if r.ok:
-                self._broker_info = r.json()
-                print("Broker info retrieved!")
-                return 1
-            else:
-                print(f"Error {r.status_code} ☀︎")
+            try:
+                r = self._http_cache.get(addr)
+                if r.ok:
+                    self._broker_info = r.json()
+                    print("Broker info retrieved!")
+                    return 1
+                else:
+                    print(f"Error {r.status_code} ☀︎")
+                    time.sleep(retryDelay(r, 5))
+            except:
+                print("Unable to reach services catalog - retrying")
+                time.sleep(retryDelay(None, 5))
         
         if self._broker_info != {}:
             return 1
@@ -436,18 +449,22 @@ class WaterDeliveryStrategy():
         while self._dev_cat_info == {} and tries < max_tries:
             tries += 1
             try:
-                r = requests.get(addr)
-                if r.ok:
+                r = self._http_cache.get(addr)
+                if r.ok and r.json() != {}:
                     self._dev_cat_info = r.json()
                     self._dev_cat_info["last_update"] = time.time()
                     print("Device catalog info retrieved!")
                     return 1
+                elif r.ok:
+                    # Not registered at the services catalog (yet)
+                    print("No device catalog found at services catalog!")
+                    time.sleep(5)
                 else:
                     print(f"Error {r.status_code}")
-                    time.sleep(5)
+                    time.sleep(retryDelay(r, 5))
             except:
                 print("Unable to reach services catalog - retrying")
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
         
         if self._dev_cat_info != {}:
             return 1
@@ -465,6 +482,15 @@ class WaterDeliveryStrategy():
             if (curr_time - self._dev_cat_info["last_update"]) > timeout:
                 self._dev_cat_info = {}
 
+    def dropDevCatInfo(self):
+        """
+        Forget the device catalog information, e.g., if the device catalog
+        cannot be reached (it may have moved): the next request to the
+        services catalog skips the local HTTP cache.
+        """
+        self._dev_cat_info = {}
+        self._http_cache.invalidate(self._serv_cat_addr + "/device_catalog")
+
     def getTelegramInfo(self, max_tries=10):
         """
         Obtain the telegram bot information from the services
@@ -484,7 +510,7 @@ class WaterDeliveryStrategy():
         while self._telegram_bot_info == {} and tries < max_tries:
             tries += 1
             try:
-                r = requests.get(addr)
+                r = self._http_cache.get(addr)
                 if r.ok:
                     self._telegram_bot_info = r.json()
                     self._telegram_bot_info["last_update"] = time.time()
@@ -492,10 +518,10 @@ class WaterDeliveryStrategy():
                     return 1
                 else:
                     print(f"Error {r.status_code} - could not get telegram info")
-                    time.sleep(5)
+                    time.sleep(retryDelay(r, 5))
             except:
                 print("Unable to reach services catalog - retrying")
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
         
         if self._telegram_bot_info != {}:
             return 1
@@ -541,51 +567,25 @@ class WaterDeliveryStrategy():
             while tries < max_tries:
                 tries += 1
                 try:
+                    # Only the devices having the moisture sensor and the water 
+                    # actuator, with their MQTT topics
                     dc_addr = "http://" + self._dev_cat_info["ip"] + ":" + str(self._dev_cat_info["port"]) + "/devices"
-                    r = requests.get(dc_addr)
+                    r = requests.get(dc_addr, params={"sensor": "Soil Moisture", "actuator": "act_water", "fields": "topics"})
                     
                     if r.ok:
                         dev_list = r.json()
 
-                        # Only keep the ones which have the correct sensor and actuator
                         for d in dev_list:
-                            # Look for light sensor
-                            sens_ok = False
-                            top_s = ""
-                            for s in d["resources"]["sensors"]:
-                                if "Soil Moisture" in s["measure_type"]:
-                                    if "MQTT" in s["available_services"]:
-                                        for ser in s["services_details"]:
-                                            if ser["service_type"] == "MQTT":
-                                                for top in ser["topic"]:
-                                                    if top.endswith("soil_moisture"):
-                                                        sens_ok = True
-                                                        top_s = top
-
-                            # Look for tank (not compulsory)
-                            tank_ok = False
-                            top_tank = ""
-                            for s in d["resources"]["sensors"]:
-                                if "Tank Weight" in s["measure_type"]:
-                                    if "MQTT" in s["available_services"]:
-                                        for ser in s["services_details"]:
-                                            if ser["service_type"] == "MQTT":
-                                                for top in ser["topic"]:
-                                                    if top.endswith("tank_weight"):
-                                                        tank_ok = True
-                                                        top_tank = top
-
-                            # Look for actuator
-                            act_ok = False
-                            top_a = ""
-                            for s in d["resources"]["actuators"]:
-                                if "MQTT" in s["available_services"]:
-                                    for det in s["services_details"]:
-                                        if det["service_type"] == "MQTT":
-                                            for top in det["topic"]:
-                                                if top.endswith("act_water"):
-                                                    act_ok = True
-                                                    top_a = top                           
+                            # The device catalog resolves the topics (the query
+                            # only returns the devices having both)
+                            top_s = d["topics"].get("Soil Moisture", [""])[0]
+                            sens_ok = top_s != ""
+                            top_a = d["topics"].get("act_water", [""])[0]
+                            act_ok = top_a != ""
+
+                            # Tank (not compulsory)
+                            top_tank = d["topics"].get("Tank Weight", [""])[0]
+                            tank_ok = top_tank != ""
                             
                             # If both have been found, add the topics to self._devices
                             if sens_ok and act_ok:
@@ -661,6 +661,8 @@ class WaterDeliveryStrategy():
         else:
             print("Empty device catalog info coming from services catalog!")
         
+        # The device catalog may have moved: get its address again
+        self.dropDevCatInfo()
         return 0
             
     def sendTankNotif(self, senml, dev_dict, max_tries=15):
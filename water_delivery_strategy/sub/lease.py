@@ -0,0 +1,39 @@
+import json
+import requests
+
+"""
+Leases
+--------------------------------------------------------------------------
+The records at the services catalog expire unless they are refreshed.
+After the first full update (PUT of the whole description), a service only
+needs to renew its lease with a heartbeat (`PUT /heartbeat`): the catalog
+does not re-validate nor write the record, and the request is a few bytes.
+The full description is sent again only if the catalog does not know the
+record anymore (e.g., it expired, or the catalog was restarted).
+--------------------------------------------------------------------------
+"""
+
+
+def renewLease(serv_cat_addr, records):
+    """
+    Renew records at the services catalog by means of a heartbeat, without
+    sending their description.
+    ---
+    - serv_cat_addr: address of the services catalog ("http://<ip>:<port>")
+    - records: body of the heartbeat, e.g., {"services": [3]} or
+      {"device_catalog": True}
+    ---
+    Return values:
+    - 1: all the records were renewed
+    - 0: not renewed (record unknown to the catalog - to be sent again -
+      or unreachable server)
+    """
+    try:
+        hb = requests.put(serv_cat_addr + '/heartbeat', data=json.dumps(records))
+        if hb.status_code == 200:
+            out = hb.json()
+            if len(out["renewed"]) > 0 and not any(out["unknown"].values()):
+                return 1
+    except:
+        pass
+    return 0
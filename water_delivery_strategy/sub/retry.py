@@ -0,0 +1,34 @@
+import random
+
+"""
+Retry hints
+--------------------------------------------------------------------------
+When the catalogs are overloaded (e.g., all services registering at the 
+same time after a restart), they answer 429 with a 'Retry-After' header 
+(seconds). Clients wait at least that long before trying again, plus a 
+random jitter, so that the retries are spread over time.
+--------------------------------------------------------------------------
+"""
+
+
+def retryDelay(resp=None, default=3, max_delay=60):
+    """
+    Return the time (seconds) to wait before retrying a failed request.
+    ---
+    - resp: response of the failed request (None if the server could not
+      be reached)
+    - default: wait when the server gives no hint
+    - max_delay: upper bound of the wait (before the jitter)
+    ---
+    The wait is the 'Retry-After' value (or `default`) plus a random 
+    jitter of up to the same amount.
+    """
+    delay = default
+    if resp is not None and "Retry-After" in resp.headers:
+        try:
+            delay = max(0, float(resp.headers["Retry-After"]))
+        except ValueError:
+            # HTTP-date format, not used by the catalogs
+            pass
+    delay = min(delay, max_delay)
+    return delay + random.uniform(0, delay)
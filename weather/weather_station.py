@@ -5,6 +5,9 @@ import pandas as pd
 from datetime import datetime, timedelta
 import sys
 from sub.MyMQTT import MyMQTT
+from sub.retry import retryDelay
+from sub.http_cache import HTTPCache
+from sub.lease import renewLease
 import requests
 import warnings
 from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
@@ -508,6 +511,7 @@ class WeatherStationWS():
                 self._conf = json.load(f)
 
         self._serv_cat_addr = "http://" + self._conf["services_catalog"]["ip"] + ":" + str(self._conf["services_catalog"]["port"])    # Address of services catalog
+        self._http_cache = HTTPCache()
         self.whoami = self._conf["weather_station"]         # Own information - to be sent to the services catalog
 
         self.out_conf = out_conf
@@ -663,10 +667,10 @@ class WeatherStationWS():
                 else:
                     # Should not happen
                     print("Error - unable to get ID from server!")
-                    time.sleep(3)
+                    time.sleep(retryDelay(r_id, 3))
             except:
                 print("Unable to reach service catalog to retrieve ID")
-                time.sleep(3)
+                time.sleep(retryDelay(None, 3))
 
         if self.id is not None:
             print("ID already assigned")
@@ -710,10 +714,10 @@ class WeatherStationWS():
                     return -1
                 else:
                     print(f"Status code: {reg.status_code}")
-                time.sleep(5)
+                time.sleep(retryDelay(reg, 5))
             except:
                 print("Tried to connect to services catalog - failed to establish a connection!")
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
 
     def updateServiceCatalog(self, max_tries=10):
         """
@@ -732,6 +736,10 @@ class WeatherStationWS():
         if self.id is None:
             self.getServiceID()
 
+        if self._last_update_serv > 0 and renewLease(self._serv_cat_addr, {"services": [self.whoami["id"]]}) == 1:
+            self._last_update_serv = time.time()
+            return 1
+
         updated = False
         count_fail = 0
 
@@ -756,7 +764,7 @@ class WeatherStationWS():
             except:
                 print("Tried to connect to services catalog - failed to establish a connection!")
                 count_fail += 1
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
         
         # If here, then it was not possible to update nor register information
         # within the maximum number of iterations, which means it was not possible 
@@ -784,13 +792,18 @@ class WeatherStationWS():
         while tries <= max_tries and self._broker_info == {}:
             tries += 1
             addr = self._serv_cat_addr + "/broker"
-            r = requests.get(addr)
-            if r.ok:
-                self._broker_info = r.json()
-                print("Broker info retrieved!")
-                return 1
-            else:
-                print(f"Error {r.status_code} ☀︎")
+            try:
+                r = self._http_cache.get(addr)
+                if r.ok:
+                    self._broker_info = r.json()
+                    print("Broker info retrieved!")
+                    return 1
+                else:
+                    print(f"Error {r.status_code} ☀︎")
+                    time.sleep(retryDelay(r, 5))
+            except:
+                print("Unable to reach services catalog - retrying")
+                time.sleep(retryDelay(None, 5))
         
         if self._broker_info != {}:
             return 1
@@ -817,18 +830,22 @@ class WeatherStationWS():
         while self._dev_cat_info == {} and tries < max_tries:
             tries += 1
             try:
-                r = requests.get(addr)
-                if r.ok:
+                r = self._http_cache.get(addr)
+                if r.ok and r.json() != {}:
                     self._dev_cat_info = r.json()
                     self._dev_cat_info["last_update"] = time.time()
                     print("Device catalog info retrieved!")
                     return 1
+                elif r.ok:
+                    # Not registered at the services catalog (yet)
+                    print("No device catalog found at services catalog!")
+                    time.sleep(5)
                 else:
                     print(f"Error {r.status_code}")
-                    time.sleep(5)
+                    time.sleep(retryDelay(r, 5))
             except:
                 print("Unable to reach services catalog - retrying")
-                time.sleep(5)
+                time.sleep(retryDelay(None, 5))
         
         if self._dev_cat_info != {}:
             return 1
@@ -846,6 +863,15 @@ class WeatherStationWS():
             if (curr_time - self._dev_cat_info["last_update"]) > timeout:
                 self._dev_cat_info = {}
 
+    def dropDevCatInfo(self):
+        """
+        Forget the device catalog information, e.g., if the device catalog
+        cannot be reached (it may have moved): the next request to the
+        services catalog skips the local HTTP cache.
+        """
+        self._dev_cat_info = {}
+        self._http_cache.invalidate(self._serv_cat_addr + "/device_catalog")
+
     def getListOfDevices(self, max_tries=25, info_timeout=120):
         """
         Get the list of connected devices from the device catalog.
@@ -873,7 +899,8 @@ class WeatherStationWS():
             while tries < max_tries:
                 tries += 1
                 try:
-                    r = requests.get(dc_addr)
+                    # Only the device IDs and their MQTT topics are needed
+                    r = requests.get(dc_addr, params={"fields": "topics"})
                     if r.ok:
                         # The response is the list
                         self._devices["list"] = r.json()
@@ -882,14 +909,16 @@ class WeatherStationWS():
                         return 1
                     else:
                         print(f"Error {r.status_code}")
-                        time.sleep(5)
+                        time.sleep(retryDelay(r, 5))
                 except:
                     print("Unable to reach device catalog!")
-                    time.sleep(5)
+                    time.sleep(retryDelay(None, 5))
             
             print("Unable to retrieve devices list")
         except:
             print("No device catalog found at services catalog!")
+        # The device catalog may have moved: get its address again
+        self.dropDevCatInfo()
         return 0
     
     def clearDevicesList(self, info_timeout=120):
@@ -925,25 +954,20 @@ class WeatherStationWS():
             self.getListOfDevices()
 
         if self._devices["list"] != []:
-            # Iterate over the list of sensors and get topics
-            # Before subbing, check the topic is not already in the list of topics
-            # self.topics_list and only sub if the last element in the topic 
-            # is an element of self.weather_station.relevant_meas_short
-
-            # Reach the topics list
+            # The topics of each device are listed by measure type (resolved
+            # by the device catalog): only sub to the ones of the measurements
+            # in self.weather_station.relevant_meas, after checking the topic 
+            # is not already in the list of topics self.topics_list
             n_sub = 0
             for dev in self._devices["list"]:
-                for sens in dev["resources"]["sensors"]:
-                    if "MQTT" in sens["available_services"]:
-                        for det in sens["services_details"]:
-                            if det["service_type"] == "MQTT":
-                                for top in det["topic"]:
-                                    if top.split('/')[-1] in self.weather_station.relevant_meas_short and top not in self.topics_list:
-                                        # Sub to the topic
-                                        self.mqtt_cli.mySubscribe(top)
-                                        # Add topic to the list
-                                        self.topics_list.append(top)
-                                        n_sub += 1
+                for meas in self.weather_station.relevant_meas:
+                    for top in dev["topics"].get(meas, []):
+                        if top not in self.topics_list:
+                            # Sub to the topic
+                            self.mqtt_cli.mySubscribe(top)
+                            # Add topic to the list
+                            self.topics_list.append(top)
+                            n_sub += 1
             
             return n_sub
 